@@ -0,0 +1,238 @@
+"""Reads package archives one member at a time, within a budget.
+
+Every member of a wheel or tarball goes through a Member_Budget before any
+of its data is used.  Members no plugin can do anything with are skipped up
+front and recorded: anything over the per-member size cap, files with a
+known binary extension, and files whose first few KB contain a NUL byte.
+A package that would expand to more than the per-package cap, more than
+MAX_RATIO times the size of its archive, or to more members than allowed
+is rejected outright with Archive_Rejected, so a decompression bomb stops
+as soon as it crosses a limit instead of filling the disk or memory.
+
+Tarballs are read as a forward only stream and kept members are copied a
+chunk at a time, so no single member has to fit in memory when it is
+extracted.  The names of all members are kept in a Member_List, one
+buffer plus an offset per member instead of a Python string each.
+
+@author u/gatewaynode
+@website https://reddit.com/r/pipsecurity
+"""
+
+import os
+import array
+import tarfile
+import zipfile
+from collections.abc import Sequence
+
+DEFAULT_MAX_MEMBER_BYTES = 64 * 1024**2
+DEFAULT_MAX_PACKAGE_BYTES = 2 * 1024**3
+DEFAULT_MAX_MEMBERS = 100000
+
+# Uncompressed size allowed per byte of archive.  Tiny archives are measured
+# as if they were RATIO_FLOOR bytes, real packages rarely pass 20.
+MAX_RATIO = 100
+RATIO_FLOOR = 1024**2
+
+# How much of a member is read to tell text from binary
+SNIFF_BYTES = 8192
+
+CHUNK_BYTES = 1024**2
+
+# Skipped members beyond this many are counted but not named
+MAX_RECORDED_SKIPS = 1000
+
+BINARY_SUFFIXES = (
+    ".so",
+    ".pyd",
+    ".dll",
+    ".dylib",
+    ".exe",
+    ".a",
+    ".lib",
+    ".o",
+    ".pyc",
+    ".pyo",
+    ".png",
+    ".jpg",
+    ".jpeg",
+    ".gif",
+    ".bmp",
+    ".ico",
+    ".webp",
+    ".pdf",
+    ".zip",
+    ".gz",
+    ".bz2",
+    ".xz",
+    ".whl",
+    ".egg",
+    ".jar",
+    ".ttf",
+    ".otf",
+    ".woff",
+    ".woff2",
+    ".mo",
+    ".npy",
+    ".npz",
+    ".pkl",
+    ".h5",
+    ".sqlite",
+)
+
+
+class Archive_Rejected(Exception):
+    pass
+
+
+class Member_List(Sequence):
+    def __init__(self, names=()):
+        self._data = bytearray()
+        self._ends = array.array("Q")
+        for name in names:
+            self.append(name)
+
+    def append(self, name):
+        self._data += name.encode("utf-8", "surrogateescape")
+        self._ends.append(len(self._data))
+
+    def __len__(self):
+        return len(self._ends)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        start = self._ends[index - 1] if index else 0
+        return self._data[start : self._ends[index]].decode("utf-8", "surrogateescape")
+
+    def __repr__(self):
+        return f"Member_List({len(self)} members)"
+
+
+class Member_Budget:
+    def __init__(
+        self,
+        archive_size,
+        max_member_bytes=DEFAULT_MAX_MEMBER_BYTES,
+        max_package_bytes=DEFAULT_MAX_PACKAGE_BYTES,
+        max_members=DEFAULT_MAX_MEMBERS,
+    ):
+        self.max_member_bytes = max_member_bytes
+        self.max_package_bytes = min(
+            max_package_bytes, MAX_RATIO * max(archive_size, RATIO_FLOOR)
+        )
+        self.max_members = max_members
+        self.names = Member_List()
+        self.members = 0
+        self.total_bytes = 0
+        self.kept_bytes = 0
+        self.skipped = []
+        self.skipped_count = 0
+
+    def admit(self, name, size, regular=True):
+        # True if the member is to be used.  Skipped members still count
+        # towards the package's budget, the stream has to get past them.
+        self.members += 1
+        self.total_bytes += size
+        if self.members > self.max_members:
+            raise Archive_Rejected(f"more than {self.max_members} members")
+        if self.total_bytes > self.max_package_bytes:
+            raise Archive_Rejected(
+                f"expands to more than {self.max_package_bytes} bytes"
+            )
+        if not regular:
+            return False  # Directories, links and devices are never written
+        self.names.append(name)
+        if size > self.max_member_bytes:
+            return self.skip(name, "too big")
+        if name.lower().endswith(BINARY_SUFFIXES):
+            return self.skip(name, "binary")
+        self.kept_bytes += size
+        return True
+
+    def skip(self, name, reason, size=0):
+        self.kept_bytes -= size
+        self.skipped_count += 1
+        if len(self.skipped) < MAX_RECORDED_SKIPS:
+            self.skipped.append((name, reason))
+        return False
+
+
+def _sniffed(budget, name, size, file):
+    head = file.read(SNIFF_BYTES)
+    if b"\0" in head:
+        budget.skip(name, "binary", size)
+        return
+    yield name, size, head, file
+
+
+def iter_members(archive_path, budget):
+    # Yields (name, size, head, file) for every member the budget keeps.  head
+    # is what has been read of it already, file the rest and only good until
+    # the next member is asked for.
+    if archive_path.endswith(".whl"):
+        with zipfile.ZipFile(archive_path, "r") as zip_ref:
+            for info in zip_ref.infolist():
+                if budget.admit(info.filename, info.file_size, not info.is_dir()):
+                    with zip_ref.open(info) as file:
+                        yield from _sniffed(budget, info.filename, info.file_size, file)
+    elif archive_path.endswith(".tar.gz"):
+        with tarfile.open(archive_path, "r|*") as tar_ref:
+            for member in tar_ref:
+                if budget.admit(member.name, member.size, member.isfile()):
+                    file = tar_ref.extractfile(member)
+                    yield from _sniffed(budget, member.name, member.size, file)
+
+
+def read_members(archive_path, budget):
+    # (name, bytes) of every kept member, one member in memory at a time
+    for name, size, head, file in iter_members(archive_path, budget):
+        yield name, head + file.read()
+
+
+def expanded_size(archive_path):
+    # What the archive says it unpacks to, before any of it is read: the
+    # sizes in a wheel's zip directory, or the length gzip records at the end
+    # of a tarball (modulo 4GB, far past the package cap anyway)
+    if archive_path.endswith(".whl"):
+        with zipfile.ZipFile(archive_path, "r") as zip_ref:
+            return sum(info.file_size for info in zip_ref.infolist())
+    with open(archive_path, "rb") as file:
+        file.seek(-4, os.SEEK_END)
+        return int.from_bytes(file.read(4), "little")
+
+
+def member_path(root, name):
+    # Where a member is extracted to under root (a realpath), None when its
+    # name points outside of it
+    target = os.path.realpath(os.path.join(root, name))
+    if not target.startswith(root + os.sep):
+        return None
+    return target
+
+
+def copy_member(head, file, out=None, digest=None):
+    # Copies the rest of a member from iter_members a chunk at a time, into
+    # out and/or a hashlib digest
+    chunk = head
+    while chunk:
+        if out:
+            out.write(chunk)
+        if digest:
+            digest.update(chunk)
+        chunk = file.read(CHUNK_BYTES)
+
+
+def write_members(archive_path, output_dir, budget):
+    # Extracts the kept members under output_dir, never outside of it
+    root = os.path.realpath(output_dir)
+    for name, size, head, file in iter_members(archive_path, budget):
+        target = member_path(root, name)
+        if target is None:
+            continue
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        with open(target, "wb") as out:
+            copy_member(head, file, out)
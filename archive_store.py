@@ -0,0 +1,172 @@
+"""Content addressed store of downloaded package archives.
+
+Every archive the fetcher downloads is kept here under its sha256, shared
+by all download workers and by later runs (several processes can point at
+the same directory).  Before going to the network the fetcher asks the
+store for the archive the index points at, by its published sha256 or,
+for indexes that publish no hashes, by its URL, and hardlinks it into the
+package's scratch directory.  Re-auditing a package with a new or updated
+plugin therefore never downloads it again.
+
+The store is trimmed least recently used first once it grows past its
+size cap.  Evicting an archive only drops the store's link to it, copies
+already linked into scratch directories stay valid.
+
+@author u/gatewaynode
+@website https://reddit.com/r/pipsecurity
+"""
+
+import os
+import time
+import shutil
+import sqlite3
+import threading
+
+DEFAULT_MAX_BYTES = 10 * 1024**3
+
+INDEX_FILE = "index.db"
+
+
+class Archive_Store:
+    def __init__(self, root, max_bytes=DEFAULT_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self._db = sqlite3.connect(
+            os.path.join(root, INDEX_FILE), check_same_thread=False, timeout=30
+        )
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("""CREATE TABLE IF NOT EXISTS archives (
+                    sha256 TEXT PRIMARY KEY,
+                    url TEXT,
+                    size INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )""")
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS archives_url ON archives (url)"
+            )
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS archives_last_used ON archives (last_used)"
+            )
+            self._total = self._db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM archives"
+            ).fetchone()[0]
+
+    def path(self, sha256):
+        # Fanned out over 256 directories so none of them gets huge
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def find(self, sha256=None, url=None):
+        # The sha256 of a stored archive matching the index entry, or None
+        with self._lock, self._db:
+            if sha256:
+                row = self._db.execute(
+                    "SELECT sha256 FROM archives WHERE sha256 = ?", (sha256,)
+                ).fetchone()
+            elif url:
+                row = self._db.execute(
+                    "SELECT sha256 FROM archives WHERE url = ?"
+                    " ORDER BY last_used DESC LIMIT 1",
+                    (url,),
+                ).fetchone()
+            else:
+                row = None
+            if not row:
+                return None
+            if not os.path.isfile(self.path(row[0])):
+                # Removed behind our back, forget it
+                self._forget([row[0]])
+                return None
+            self._db.execute(
+                "UPDATE archives SET last_used = ? WHERE sha256 = ?",
+                (time.time(), row[0]),
+            )
+            return row[0]
+
+    def link(self, sha256, path):
+        # Hardlinks the stored archive to path, copying it when path is on
+        # another filesystem.  False if the archive is gone (e.g. evicted by
+        # another process since find()).
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.lexists(path):
+            os.remove(path)
+        try:
+            os.link(self.path(sha256), path)
+        except FileNotFoundError:
+            return False
+        except OSError:
+            try:
+                shutil.copyfile(self.path(sha256), path)
+            except FileNotFoundError:
+                return False
+        return True
+
+    def add(self, path, sha256, url=None):
+        # Keeps the (already verified) archive at path in the store
+        stored = self.path(sha256)
+        size = os.path.getsize(path)
+        if not os.path.isfile(stored):
+            os.makedirs(os.path.dirname(stored), exist_ok=True)
+            partial = f"{stored}.{os.getpid()}.{threading.get_ident()}.part"
+            try:
+                os.link(path, partial)
+            except OSError:
+                shutil.copyfile(path, partial)
+            # Read only, so a scanner can't change the shared copy through
+            # its hardlink in a scratch directory
+            os.chmod(partial, 0o444)
+            os.replace(partial, stored)
+        now = time.time()
+        with self._lock, self._db:
+            known = self._db.execute(
+                "SELECT size FROM archives WHERE sha256 = ?", (sha256,)
+            ).fetchone()
+            if known:
+                self._db.execute(
+                    "UPDATE archives SET url = COALESCE(?, url), last_used = ?"
+                    " WHERE sha256 = ?",
+                    (url, now, sha256),
+                )
+                return
+            self._db.execute(
+                "INSERT INTO archives VALUES (?, ?, ?, ?, ?)",
+                (sha256, url, size, now, now),
+            )
+            self._total += size
+            self._evict()
+
+    def _forget(self, hashes):
+        for sha256 in hashes:
+            row = self._db.execute(
+                "SELECT size FROM archives WHERE sha256 = ?", (sha256,)
+            ).fetchone()
+            if row:
+                self._total -= row[0]
+            self._db.execute("DELETE FROM archives WHERE sha256 = ?", (sha256,))
+            if os.path.isfile(self.path(sha256)):
+                os.remove(self.path(sha256))
+
+    def _evict(self):
+        # Least recently used archives go first once the store is over budget,
+        # trimming down to 90% so we are not evicting on every download.
+        if self._total <= self.max_bytes:
+            return
+        target = int(self.max_bytes * 0.9)
+        rows = self._db.execute(
+            "SELECT sha256, size FROM archives ORDER BY last_used"
+        ).fetchall()
+        expired = []
+        total = self._total
+        for sha256, size in rows:
+            if total <= target:
+                break
+            expired.append(sha256)
+            total -= size
+        self._forget(expired)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,333 @@
+"""Long lived audit service, so small packages don't pay for startup.
+
+Auditing one package with `pip_audit.py -p NAME` spends most of its time
+starting up: importing everything, finding and loading the plugins and
+reading the typo-squatting reference list.  `--serve ADDRESS` does all of
+that once and then keeps one pipeline running, fed by audit requests over
+HTTP on a Unix socket (an ADDRESS with a / in it) or a local TCP port
+(HOST:PORT).  Requests from different clients share the pipeline, so their
+packages are downloaded, extracted and scanned side by side.
+
+  POST /audit   {"packages": ["six", ...]}  audits them and answers with a
+                result per package (see job_result)
+  GET /health   the loaded plugins and how many packages were audited
+
+`pip_audit.py --connect ADDRESS -p NAME` is the matching client.
+
+@author u/gatewaynode
+@website https://reddit.com/r/pipsecurity
+"""
+
+import os
+import json
+import stat
+import queue
+import socket
+import logging
+import threading
+import traceback
+import collections
+import socketserver
+import http.client
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from concurrent.futures import Future
+
+DEFAULT_HOST = "127.0.0.1"
+
+# Biggest request body accepted, a list of a few hundred thousand names
+MAX_REQUEST_BYTES = 16 * 1024**2
+
+
+class Daemon_Error(Exception):
+    pass
+
+
+class Daemon_Stopped(Daemon_Error):
+    pass
+
+
+def is_unix_address(address):
+    return "/" in address
+
+
+def _tcp_address(address):
+    host, _, port = address.rpartition(":")
+    return (host or DEFAULT_HOST, int(port))
+
+
+def _remove_stale_socket(path):
+    # A socket left behind by a daemon that didn't shut down cleanly is
+    # replaced, one that still answers is not
+    try:
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            raise Daemon_Error(f"{path} exists and is not a socket")
+    except FileNotFoundError:
+        return
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except OSError:
+        os.unlink(path)
+        return
+    finally:
+        probe.close()
+    raise Daemon_Error(f"another daemon is serving on {path}")
+
+
+def _read_report(path):
+    with open(path, "rb") as file:
+        data = file.read()
+    if path.endswith(".json"):
+        try:
+            return json.loads(data.decode("utf-8"))
+        except ValueError:
+            pass
+    return data.decode("utf-8", errors="replace")
+
+
+def job_result(job):
+    # What a client gets back for a finished package.  With a results store
+    # the plugins' findings come along, otherwise their report files, read
+    # from the package's report directory like the scan cache does (files at
+    # the top of it, leaving out files of the package itself when they were
+    # kept there with --save_files).
+    package_meta = job["package_meta"]
+    result = {
+        "package": job["raw_input"],
+        "project": package_meta.get("project"),
+        "version": package_meta.get("version"),
+        "archive_sha256": package_meta.get("archive_sha256"),
+        "scan_errors": job["scan_errors"],
+        "timings": job["timings"],
+        "plugin_timings": job["plugin_timings"],
+        "report_dir": job["scratch_dir"],
+    }
+    if package_meta.get("archive_rejected"):
+        result["archive_rejected"] = package_meta["archive_rejected"]
+    if job.get("findings") is not None:
+        result["findings"] = job["findings"]
+        return result
+    package_files = set(package_meta.get("archive_file_list") or ())
+    package_files.add(os.path.basename(package_meta.get("saved_file_name") or ""))
+    reports = {}
+    if os.path.isdir(job["scratch_dir"]):
+        for entry in sorted(os.scandir(job["scratch_dir"]), key=lambda e: e.name):
+            if entry.is_file() and entry.name not in package_files:
+                try:
+                    reports[entry.name] = _read_report(entry.path)
+                except Exception as e:
+                    logging.error(traceback.format_exc())
+    result["reports"] = reports
+    return result
+
+
+class Audit_Daemon:
+    # Hands the packages clients asked for to the pipeline (through
+    # targets()) and each finished job back to whoever is waiting for it.
+    def __init__(self, address, verbose=False, debug=False):
+        self.address = address
+        self.plugins = []
+        self.verbose = verbose
+        self.debug = debug
+        self.audited = 0
+        self._incoming = queue.Queue()
+        self._waiting = collections.defaultdict(collections.deque)
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._server = None
+        self._thread = None
+        self._watcher = None
+
+    def start(self, plugins=()):
+        # Answers requests from here on, plugins are the names /health lists
+        self.plugins = list(plugins)
+        handler = type("Handler", (_Audit_Handler,), {"daemon": self})
+        if is_unix_address(self.address):
+            _remove_stale_socket(self.address)
+            self._server = _Unix_HTTP_Server(self.address, handler)
+        else:
+            self._server = _TCP_HTTP_Server(_tcp_address(self.address), handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        self._watcher = threading.Thread(
+            target=self._shut_down_when_stopped, daemon=True
+        )
+        self._watcher.start()
+
+    def _shut_down_when_stopped(self):
+        self._stopping.wait()
+        self._incoming.put(None)
+        self._server.shutdown()
+
+    def stop(self):
+        # Stops taking requests, the pipeline finishes what it already has.
+        # Only sets an event and leaves the rest to the watcher thread, so it
+        # takes no lock the interrupted main thread might be holding.
+        self._stopping.set()
+
+    def submit(self, raw_inputs):
+        # One future per package, resolved with its job_result()
+        futures = []
+        with self._lock:
+            if self._stopping.is_set():
+                raise Daemon_Stopped("the audit daemon is shutting down")
+            for raw_input in raw_inputs:
+                future = Future()
+                self._waiting[raw_input].append(future)
+                futures.append(future)
+                self._incoming.put(raw_input)
+        return futures
+
+    def targets(self):
+        # The pipeline's targets, blocks until a client asks for a package
+        while True:
+            raw_input = self._incoming.get()
+            if raw_input is None:
+                return
+            yield raw_input
+
+    def finished(self, job):
+        with self._lock:
+            self.audited += 1
+            waiting = self._waiting.get(job["raw_input"])
+            future = waiting.popleft() if waiting else None
+            if waiting is not None and not waiting:
+                del self._waiting[job["raw_input"]]
+        if future is not None:
+            try:
+                future.set_result(job_result(job))
+            except Exception as e:
+                future.set_exception(e)
+
+    def close(self):
+        # Once the pipeline is done.  Anyone still waiting (it died) gets an
+        # error, then the answers still being sent are waited for.
+        self.stop()
+        if self._watcher:
+            self._watcher.join()
+        with self._lock:
+            waiting, self._waiting = self._waiting, {}
+        for futures in waiting.values():
+            for future in futures:
+                future.set_exception(Daemon_Stopped("the audit daemon stopped"))
+        if self._server:
+            self._server.server_close()
+            if is_unix_address(self.address) and os.path.exists(self.address):
+                os.unlink(self.address)
+
+    def health(self):
+        with self._lock:
+            in_flight = sum(len(futures) for futures in self._waiting.values())
+            return {
+                "status": "stopping" if self._stopping.is_set() else "ok",
+                "pid": os.getpid(),
+                "plugins": self.plugins,
+                "audited": self.audited,
+                "in_flight": in_flight,
+            }
+
+
+# Request threads are joined on close, so answers aren't cut off on the way
+# out (HTTP/1.0, a connection is done once it is answered)
+class _Unix_HTTP_Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = False
+    block_on_close = True
+
+
+class _TCP_HTTP_Server(ThreadingHTTPServer):
+    daemon_threads = False
+    block_on_close = True
+
+
+class _Audit_Handler(BaseHTTPRequestHandler):
+    daemon = None  # Set on the subclass Audit_Daemon.start() makes
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else "local"
+
+    def log_message(self, format, *args):
+        if self.daemon.debug:
+            print(f"{self.address_string()} {format % args}")
+
+    def _respond(self, status, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._respond(200, self.daemon.health())
+        else:
+            self._respond(404, {"error": f"no such endpoint {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/audit":
+            self._respond(404, {"error": f"no such endpoint {self.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length") or 0)
+            if length > MAX_REQUEST_BYTES:
+                raise ValueError(f"request is over {MAX_REQUEST_BYTES} bytes")
+            body = json.loads(self.rfile.read(length).decode("utf-8"))
+            raw_inputs = body.get("packages") or [body["package"]]
+            if not all(isinstance(name, str) and name for name in raw_inputs):
+                raise ValueError("packages have to be non-empty strings")
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            self._respond(400, {"error": f"expected {{'packages': [names]}}: {e}"})
+            return
+        if self.daemon.verbose:
+            print(f"-> Audit requested for {', '.join(raw_inputs)}")
+        try:
+            futures = self.daemon.submit(raw_inputs)
+        except Daemon_Stopped as e:
+            self._respond(503, {"error": str(e)})
+            return
+        results = []
+        for raw_input, future in zip(raw_inputs, futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append({"package": raw_input, "error": str(e)})
+        self._respond(200, {"results": results})
+
+
+class _Unix_HTTP_Connection(http.client.HTTPConnection):
+    def __init__(self, path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+def request(address, method, path, body=None, timeout=None):
+    # Client side: sends a request to a daemon, returns (status, decoded JSON)
+    if is_unix_address(address):
+        connection = _Unix_HTTP_Connection(address, timeout)
+    else:
+        host, port = _tcp_address(address)
+        connection = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        data = None if body is None else json.dumps(body).encode("utf-8")
+        headers = {"Content-Type": "application/json"} if data is not None else {}
+        connection.request(method, path, body=data, headers=headers)
+        response = connection.getresponse()
+        return response.status, json.loads(response.read().decode("utf-8"))
+    finally:
+        connection.close()
+
+
+def audit(address, raw_inputs, timeout=None):
+    # Results of auditing raw_inputs on the daemon at address, in order
+    status, body = request(
+        address, "POST", "/audit", {"packages": list(raw_inputs)}, timeout
+    )
+    if status != 200:
+        raise Daemon_Error(body.get("error") or f"audit daemon answered {status}")
+    return body["results"]
@@ -0,0 +1,362 @@
+#!/usr/bin/env python3.7
+"""Offline benchmark of the audit pipeline on a synthetic package corpus.
+
+Generates sdists and wheels of known size and file count (including a huge
+setup.py, a tarball with thousands of members and a package carrying a
+large vendored data file), lays them out as a PEP 503 simple index in a
+local directory and runs pip_audit.py against it with --metrics-json, so
+every stage and every plugin is timed without touching the network.
+
+Each benchmark is saved as JSON under local_files/benchmarks, and --compare
+with an earlier one reports how much each stage and plugin got slower or
+faster, failing when anything regressed by more than --tolerance.
+
+@author u/gatewaynode
+@website https://reddit.com/r/pipsecurity
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import click
+import random
+import hashlib
+import logging
+import platform
+import statistics
+import subprocess
+import tarfile
+import traceback
+import zipfile
+
+VERSION = "1.0.0"
+
+# name, archive type, python files, bytes per python file, setup.py bytes,
+# bytes of vendored (non python) data
+DEFAULT_CORPUS = (
+    ("bench-small", "sdist", 5, 2000, 500, 0),
+    ("bench-many-members", "sdist", 2000, 1000, 500, 0),
+    ("bench-big-setup", "sdist", 10, 2000, 1000000, 0),
+    ("bench-wheel", "wheel", 200, 4000, 0, 0),
+    ("bench-vendored-data", "sdist", 20, 2000, 500, 5000000),
+)
+
+# Every so often generated code trips bandit and detect-secrets, so the
+# plugins have findings to report and not just files to read.
+_SNIPPETS = (
+    "def function_{n}(value):\n    total = value * {n}\n    return total + {n}\n\n",
+    "def run_{n}(command):\n    import subprocess\n    return subprocess.call(command, shell=True)\n\n",
+    "def check_{n}(value):\n    assert value != {n}\n    return value\n\n",
+    'PASSWORD_{n} = "{secret}"\n\n',
+    "class Model{n}:\n    def __init__(self):\n        self.items = list(range({n}))\n\n",
+)
+
+
+def _python_source(rng, size):
+    chunks = []
+    written = 0
+    n = 0
+    while written < size:
+        snippet = rng.choice(_SNIPPETS).format(
+            n=n, secret="%032x" % rng.getrandbits(128)
+        )
+        chunks.append(snippet)
+        written += len(snippet)
+        n += 1
+    return "".join(chunks).encode("utf-8")
+
+
+def _setup_py(name, size):
+    lines = [
+        "from setuptools import setup, find_packages\n\n",
+        "# Padding to make setup.py as big as the corpus asks for\n",
+    ]
+    written = sum(len(line) for line in lines)
+    n = 0
+    while written < size:
+        line = f"_PADDING_{n} = {n!r}\n"
+        lines.append(line)
+        written += len(line)
+        n += 1
+    lines.append(
+        f'\nsetup(name="{name}", version="{VERSION}", packages=find_packages())\n'
+    )
+    return "".join(lines).encode("utf-8")
+
+
+def _members(spec, rng):
+    # (archive member name, bytes) for one package of the corpus
+    name, archive, files, file_size, setup_size, data_size = spec
+    module = name.replace("-", "_")
+    root = f"{name}-{VERSION}/" if archive == "sdist" else ""
+    members = []
+    for number in range(files):
+        members.append(
+            (f"{root}{module}/module_{number}.py", _python_source(rng, file_size))
+        )
+    if data_size:
+        row = b'{"id": %d, "value": "%s"},\n'
+        data = bytearray(b"[\n")
+        while len(data) < data_size:
+            data += row % (len(data), b"%032x" % rng.getrandbits(128))
+        members.append((f"{root}{module}/data/vendored.json", bytes(data) + b"{}]\n"))
+    metadata = f"Metadata-Version: 2.1\nName: {name}\nVersion: {VERSION}\n".encode()
+    if archive == "sdist":
+        members.append((f"{root}setup.py", _setup_py(name, setup_size)))
+        members.append((f"{root}PKG-INFO", metadata))
+    else:
+        dist_info = f"{module}-{VERSION}.dist-info"
+        members.append((f"{dist_info}/METADATA", metadata))
+        members.append(
+            (f"{dist_info}/WHEEL", b"Wheel-Version: 1.0\nTag: py3-none-any\n")
+        )
+        members.append((f"{dist_info}/RECORD", b""))
+    return members
+
+
+def _write_archive(spec, members, packages_dir):
+    name, archive = spec[0], spec[1]
+    if archive == "sdist":
+        file_name = f"{name}-{VERSION}.tar.gz"
+        with tarfile.open(os.path.join(packages_dir, file_name), "w:gz") as tar:
+            for member, data in members:
+                info = tarfile.TarInfo(member)
+                info.size = len(data)
+                info.mtime = 0
+                tar.addfile(info, io.BytesIO(data))
+    else:
+        file_name = f"{name.replace('-', '_')}-{VERSION}-py3-none-any.whl"
+        with zipfile.ZipFile(
+            os.path.join(packages_dir, file_name), "w", zipfile.ZIP_DEFLATED
+        ) as wheel:
+            for member, data in members:
+                wheel.writestr(member, data)
+    return file_name
+
+
+def generate_corpus(corpus_dir, corpus=DEFAULT_CORPUS, scale=1.0, seed=0):
+    # Writes packages/, simple/ (the index), targets.json and top_list.json
+    # into corpus_dir.  The same corpus, scale and seed give the same files.
+    packages_dir = os.path.join(corpus_dir, "packages")
+    os.makedirs(packages_dir, exist_ok=True)
+    rng = random.Random(seed)
+    names = []
+    for spec in corpus:
+        name, archive, files, file_size, setup_size, data_size = spec
+        spec = (
+            name,
+            archive,
+            max(1, int(files * scale)),
+            file_size,
+            int(setup_size * scale),
+            int(data_size * scale),
+        )
+        file_name = _write_archive(spec, _members(spec, rng), packages_dir)
+        with open(os.path.join(packages_dir, file_name), "rb") as file:
+            sha256 = hashlib.sha256(file.read()).hexdigest()
+        project_dir = os.path.join(corpus_dir, "simple", name)
+        os.makedirs(project_dir, exist_ok=True)
+        with open(os.path.join(project_dir, "index.html"), "w") as file:
+            file.write(
+                f'<a href="../../packages/{file_name}#sha256={sha256}">{file_name}</a>\n'
+            )
+        names.append(name)
+
+    with open(os.path.join(corpus_dir, "targets.json"), "w") as file:
+        json.dump(names, file, indent=4)
+    # Reference list for the typo-squatting plugin, so it never downloads one
+    with open(os.path.join(corpus_dir, "top_list.json"), "w") as file:
+        json.dump(["requests", "six", "bench-smal", "numpy"], file, indent=4)
+    return names
+
+
+def run_once(corpus_dir, pip_audit_args=()):
+    # One pip_audit.py run over the corpus in a fresh process, returns its
+    # --metrics-json summary plus the wall time seen from outside.
+    root = os.path.dirname(os.path.abspath(__file__))
+    corpus_dir = os.path.abspath(corpus_dir)
+    metrics_path = os.path.join(corpus_dir, "metrics.json")
+    command = [
+        sys.executable,
+        os.path.join(root, "pip_audit.py"),
+        "-i",
+        os.path.join(corpus_dir, "targets.json"),
+        "-o",
+        os.path.join(corpus_dir, "output"),
+        "--index-url",
+        os.path.join(corpus_dir, "simple"),
+        "--metrics-json",
+        metrics_path,
+    ] + list(pip_audit_args)
+    env = dict(
+        os.environ,
+        PIP_AUDIT_TOP_LIST=os.path.join(corpus_dir, "top_list.json"),
+        PIP_AUDIT_TOP_LIST_MAX_AGE=str(10 * 365 * 24 * 60 * 60),
+    )
+    started = time.perf_counter()
+    subprocess.run(
+        command,
+        cwd=root,
+        env=env,
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.DEVNULL,
+        check=True,
+    )
+    wall_seconds = time.perf_counter() - started
+    with open(metrics_path, "r") as file:
+        metrics = json.load(file)
+    metrics["process_seconds"] = round(wall_seconds, 3)
+    return metrics
+
+
+def _medians(runs):
+    # Median over the runs of the process time and each stage/plugin's total
+    result = {
+        "process_seconds": statistics.median(run["process_seconds"] for run in runs),
+        "stages": {},
+        "plugins": {},
+    }
+    for group in ("stages", "plugins"):
+        for name in runs[0][group]:
+            result[group][name] = statistics.median(
+                run[group].get(name, {}).get("sum", 0) for run in runs
+            )
+    return result
+
+
+def compare(baseline, current, tolerance=0.1):
+    # (label, old seconds, new seconds, regressed) for everything timed
+    rows = [
+        (
+            "process",
+            baseline["process_seconds"],
+            current["process_seconds"],
+        )
+    ]
+    for group in ("stages", "plugins"):
+        for name, seconds in sorted(current[group].items()):
+            if name in baseline[group]:
+                rows.append((name, baseline[group][name], seconds))
+    return [
+        (label, old, new, old > 0 and new > old * (1 + tolerance))
+        for label, old, new in rows
+    ]
+
+
+@click.command(context_settings=dict(ignore_unknown_options=True))
+@click.option(
+    "-c",
+    "--corpus-dir",
+    "corpus_dir",
+    help="Where to build the synthetic index.",
+    default="local_files/benchmark_corpus",
+)
+@click.option(
+    "--scale",
+    "scale",
+    help="Multiply file counts and sizes of the corpus by this.",
+    default=1.0,
+    type=click.FloatRange(min=0.01),
+)
+@click.option("--seed", "seed", help="Seed for the generated content.", default=0)
+@click.option(
+    "-r",
+    "--repeat",
+    "repeat",
+    help="Runs to take the median of.",
+    default=3,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "-o",
+    "--output",
+    "output_file",
+    help="Where to save the results, defaults to a timestamped file in local_files/benchmarks.",
+    default=None,
+)
+@click.option(
+    "--compare",
+    "baseline_file",
+    help="Earlier results to compare against.",
+    default=None,
+)
+@click.option(
+    "--tolerance",
+    "tolerance",
+    help="With --compare, fail when something is this much slower (0.1 = 10%).",
+    default=0.1,
+)
+@click.option("-v", "--verbose", "verbose", help="Show more information.", is_flag=True)
+@click.argument("pip_audit_args", nargs=-1, type=click.UNPROCESSED)
+def main(
+    corpus_dir,
+    scale,
+    seed,
+    repeat,
+    output_file,
+    baseline_file,
+    tolerance,
+    verbose,
+    pip_audit_args,
+):
+    """Anything after the options (e.g. -- --stream --scan-workers 4) is
+    passed on to pip_audit.py."""
+    if verbose:
+        print(f"-> Generating corpus in {corpus_dir}")
+    names = generate_corpus(corpus_dir, scale=scale, seed=seed)
+
+    runs = []
+    for number in range(repeat):
+        if verbose:
+            print(
+                f"-> Run {number + 1}/{repeat}: pip_audit.py {' '.join(pip_audit_args)}"
+            )
+        try:
+            runs.append(run_once(corpus_dir, pip_audit_args))
+        except Exception as e:
+            logging.error(traceback.format_exc())
+            raise SystemExit(1)
+
+    results = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "corpus": {"packages": names, "scale": scale, "seed": seed},
+        "pip_audit_args": list(pip_audit_args),
+        "runs": runs,
+        "median": _medians(runs),
+    }
+    if not output_file:
+        output_file = time.strftime(
+            "local_files/benchmarks/benchmark_%Y%m%d-%H%M%S.json"
+        )
+    if os.path.dirname(output_file):
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    with open(output_file, "w") as file:
+        json.dump(results, file, indent=4)
+
+    median = results["median"]
+    print(f"Process: {median['process_seconds']:.3f}s (median of {repeat})")
+    for group in ("stages", "plugins"):
+        for name, seconds in median[group].items():
+            print(f"  {name}: {seconds:.3f}s")
+    print(f"Saved to {output_file}")
+
+    if baseline_file:
+        with open(baseline_file, "r") as file:
+            baseline = json.load(file)["median"]
+        regressions = 0
+        for label, old, new, regressed in compare(baseline, median, tolerance):
+            change = (new / old - 1) * 100 if old else 0
+            flag = "  REGRESSION" if regressed else ""
+            print(f"  {label}: {old:.3f}s -> {new:.3f}s ({change:+.1f}%){flag}")
+            regressions += regressed
+        if regressions:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
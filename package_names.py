@@ -0,0 +1,178 @@
+"""Finds the names a package is published under, without extracting it.
+
+The typo-squatting plugin needs the package's registered name.  The names
+are read from the package's own metadata first: PKG-INFO at the root of an
+sdist (or in its egg-info) and METADATA in a wheel's dist-info, picked
+straight out of the archive members while the archive is listed.  Only
+when there is no metadata is setup.py consulted, and then it is parsed with
+`ast` instead of being pattern matched, so nested parentheses, comments and
+`name=NAME` constants defined at module level don't trip it up.  Nothing
+in setup.py is ever executed.
+
+The pipeline stores the result in package_meta["package_names"], so it is
+worked out once per package however many plugins want it.
+
+@author u/gatewaynode
+@website https://reddit.com/r/pipsecurity
+"""
+
+import os
+import ast
+import glob
+from email.parser import HeaderParser
+
+METADATA_FILES = ("PKG-INFO", "METADATA")
+
+# Larger metadata or setup.py files are not read at all
+MAX_FILE_BYTES = 8 * 1024**2
+
+# Where read_tree() looks in an extracted package, the same files wanted()
+# picks out of an archive
+TREE_PATTERNS = (
+    "*/setup.py",
+    "*/PKG-INFO",
+    "*/METADATA",
+    "*/*.egg-info/PKG-INFO",
+    "*/src/*.egg-info/PKG-INFO",
+)
+
+
+def wanted(path):
+    # True for the archive members names are read from.  Metadata of
+    # vendored packages sits deeper than the package's own and is left out.
+    parts = path.strip("/").split("/")
+    if parts[-1] == "setup.py":
+        return len(parts) == 2
+    if parts[-1] not in METADATA_FILES:
+        return False
+    if len(parts) == 2:
+        return True
+    return parts[-2].endswith(".egg-info") and parts[1:-2] in ([], ["src"])
+
+
+def metadata_name(data):
+    # The Name header of a PKG-INFO or METADATA file, None if it has none
+    text = data.decode("utf-8", "replace") if isinstance(data, bytes) else data
+    name = HeaderParser().parsestr(text, headersonly=True).get("Name")
+    return (name.strip() or None) if name else None
+
+
+def _string(node, constants):
+    if isinstance(node, ast.Name):
+        return constants.get(node.id)
+    if isinstance(node, ast.Constant) and isinstance(node.value, str):
+        return node.value
+    if type(node).__name__ == "Str":  # Python 3.7
+        return node.s
+    return None
+
+
+def setup_names(source):
+    # One entry per setup() call in setup.py, the name it passes or None.
+    # Names given as a string constant assigned at module level are resolved,
+    # anything computed is not.  Raises SyntaxError for unparsable files.
+    tree = ast.parse(source)
+    constants = {}
+    for node in tree.body:
+        if isinstance(node, ast.Assign):
+            value = _string(node.value, {})
+            for target in node.targets:
+                if isinstance(target, ast.Name) and value is not None:
+                    constants[target.id] = value
+    names = []
+    for node in ast.walk(tree):
+        if not isinstance(node, ast.Call):
+            continue
+        func = node.func
+        callee = getattr(func, "id", None) or getattr(func, "attr", None)
+        if callee != "setup":
+            continue
+        name = None
+        for keyword in node.keywords:
+            if keyword.arg == "name":
+                name = _string(keyword.value, constants)
+        names.append(name)
+    return names
+
+
+def read_tree(root):
+    # (path, bytes) of the name files in an extracted package, looked up
+    # directly instead of walking the whole tree
+    for pattern in TREE_PATTERNS:
+        for path in sorted(glob.glob(os.path.join(glob.escape(root), pattern))):
+            if os.path.isfile(path) and os.path.getsize(path) <= MAX_FILE_BYTES:
+                with open(path, "rb") as file:
+                    yield os.path.relpath(path, root).replace(os.sep, "/"), file.read()
+
+
+def resolve(files, top_dirs):
+    # files are (path, bytes) pairs, anything wanted() rejects is skipped, and
+    # top_dirs the package's top level directories (the plugins' scan_list).
+    # Returns the names, where they came from, the warnings worth reporting
+    # and how many of those are suspicious enough to count as scan errors.
+    metadata = {}
+    setups = {}
+    for path, data in files:
+        path = path.strip("/")
+        if not wanted(path) or len(data) > MAX_FILE_BYTES:
+            continue
+        if path.endswith("/setup.py"):
+            setups[path.split("/")[0]] = data
+        else:
+            metadata[path] = metadata_name(data)
+
+    resolved = {"names": [], "source": "metadata", "warnings": [], "suspicious": 0}
+
+    def _warn(message, suspicious=True):
+        resolved["warnings"].append(message)
+        resolved["suspicious"] += suspicious
+
+    def _add(name):
+        if name not in resolved["names"]:
+            resolved["names"].append(name)
+
+    for path in sorted(metadata):
+        if metadata[path]:
+            _add(metadata[path])
+        else:
+            _warn(
+                f"The METADATA file at {path} doesn't seem to contain the name of the package, which is suspicious and may lead to parsing mistakes from this script."
+            )
+    if resolved["names"]:
+        return resolved
+
+    resolved["source"] = "setup.py"
+    for pkg_dir in top_dirs:
+        if pkg_dir not in setups:
+            _warn(
+                f"Neither a setup.py file nor package metadata naming the package could be found in {pkg_dir}.",
+                suspicious=False,
+            )
+            _add(pkg_dir)
+            continue
+        try:
+            names = setup_names(setups[pkg_dir])
+        except (SyntaxError, ValueError, RecursionError) as e:
+            _warn(
+                f"The setup.py file in {pkg_dir} could not be parsed ({e.__class__.__name__}), which may lead to parsing mistakes from this script."
+            )
+            _add(pkg_dir)
+            continue
+        if not names:
+            _warn(
+                f"The setup.py file in {pkg_dir} doesn't contain any call of setup, which is suspicious and may lead to parsing mistakes from this script."
+            )
+            _add(pkg_dir)
+            continue
+        if len(names) > 1:
+            _warn(
+                f"The setup.py file in {pkg_dir} contains more than one call of setup, which is suspicious and may lead to parsing mistakes from this script."
+            )
+        if not names[0]:
+            _warn(
+                f"The setup call in the setup.py file in {pkg_dir} doesn't seem to contain the name of the package, which is suspicious and may lead to parsing mistakes from this script."
+            )
+        _add(names[0] or pkg_dir)
+    if not setups:
+        resolved["source"] = "directory"
+    return resolved
@@ -8,16 +8,61 @@
 import os
 import sys
 import shutil
-import subprocess
 import string
 import click
 import json
-import tarfile
-import zipfile
 import traceback
 import logging
-from yapsy.PluginManager import PluginManager
+import queue
+import threading
+import tempfile
+import hashlib
+import itertools
+import functools
+import time
+import signal
+import cProfile
+import concurrent.futures
 from pprint import pprint
+from pypi_fetcher import Package_Fetcher, DEFAULT_INDEX_URL, normalize_name
+from scan_cache import (
+    Scan_Cache,
+    DEFAULT_MAX_BYTES,
+    plugin_key,
+    read_new_reports,
+    write_reports,
+)
+from archive_store import Archive_Store, DEFAULT_MAX_BYTES as DEFAULT_STORE_BYTES
+from scratch_space import Scratch_Space
+from run_journal import Run_Journal, DEFAULT_MAX_ATTEMPTS
+from work_queue import Work_Queue, Queue_Worker, DEFAULT_LEASE_SECONDS
+from scheduler import Size_Scheduler, DEFAULT_WINDOW
+from results_store import Results_Store, FINDINGS_REPORT
+from run_metrics import Run_Metrics
+from plugin_api import Plugin_Runner, adapt, scan_request
+from archive_members import (
+    Archive_Rejected,
+    Member_Budget,
+    iter_members,
+    read_members,
+    member_path,
+    copy_member,
+    expanded_size,
+    DEFAULT_MAX_MEMBER_BYTES,
+    DEFAULT_MAX_PACKAGE_BYTES,
+    DEFAULT_MAX_MEMBERS,
+)
+from package_names import (
+    resolve as resolve_package_names,
+    wanted as wanted_name_file,
+    MAX_FILE_BYTES as MAX_NAME_FILE_BYTES,
+)
+from prefetcher import (
+    Prefetcher,
+    DEFAULT_PREFETCH_BYTES,
+    DEFAULT_PER_HOST,
+    DEFAULT_RETRIES,
+)
 
 
 def init():
@@ -25,99 +70,276 @@ def init():
         os.makedirs("local_files")
 
 
-def _decode_json_file(input_list, verbose=False, debug=False, output_json=False):
+def _target_name(item):
+    # List entries are plain names, or objects in the top-pypi-packages format
+    if isinstance(item, dict):
+        return item.get("project") or item.get("name")
+    return item
+
+
+def _iter_json_array(file, buffer="", chunk_size=1024 * 64):
+    # Yields the items of a top level JSON list one at a time, so only a chunk
+    # of the file is in memory however long the list is.
+    decoder = json.JSONDecoder()
+    buffer = buffer.lstrip()[1:]  # Drop the opening [
+    eof = False
+    while True:
+        buffer = buffer.lstrip(" \t\r\n,")
+        if buffer.startswith("]"):
+            return
+        try:
+            item, end = decoder.raw_decode(buffer)
+        except ValueError:
+            if eof:
+                raise
+            end = None
+        # A number cut in half at the end of a chunk still decodes, so only
+        # trust values that are followed by the next separator.
+        if end is None or not (eof or buffer[end:].lstrip()[:1] in (",", "]")):
+            more = file.read(chunk_size)
+            eof = not more
+            buffer += more
+            continue
+        yield item
+        buffer = buffer[end:]
+
+
+def _iter_jsonl(lines):
+    # One target per line, either a JSON value or just the bare name
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        yield json.loads(line) if line[0] in '"{' else line
+
+
+def _iter_targets(input_list, verbose=False, debug=False, output_json=False):
+    # Lazily reads targets from a JSON list, a JSONL file or stdin ("-"),
+    # the first package can start before the rest of the list is read.
     try:
-        with open(input_list, "r") as file:
-            targets_from_file = json.load(file)
+        if input_list == "-":
+            file = sys.stdin
+        else:
+            file = open(input_list, "r", encoding="utf-8")
+        try:
+            head = file.readline()
+            while head and not head.strip():
+                head = file.readline()
+            if head.lstrip().startswith("["):
+                items = _iter_json_array(file, head)
+            else:
+                items = _iter_jsonl(itertools.chain([head], file))
+            for item in items:
+                name = _target_name(item)
+                if name:
+                    yield name
+        finally:
+            if file is not sys.stdin:
+                file.close()
     except Exception as e:
         logging.error(traceback.format_exc())
-        return False
 
-    return targets_from_file
 
+def _parse_shard(ctx, param, value):
+    # "--shard 2/4" is the second of four slices, returned as (1, 4)
+    if value is None:
+        return None
+    try:
+        index, count = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise click.BadParameter("expected i/N, e.g. 1/4")
+    if not 1 <= index <= count:
+        raise click.BadParameter("i must be between 1 and N")
+    return (index - 1, count)
+
+
+def _in_shard(raw_input, shard):
+    # Stable across hosts and runs (unlike hash()), and spellings of the same
+    # project always land in the same slice.
+    index, count = shard
+    digest = hashlib.sha256(normalize_name(raw_input).encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % count == index
+
+
+_fetcher = None
+_fetcher_lock = threading.Lock()
+
+
+def _default_fetcher():
+    # One shared PyPI fetcher per process so its connection pools are reused
+    global _fetcher
+    with _fetcher_lock:
+        if _fetcher is None:
+            _fetcher = Package_Fetcher(DEFAULT_INDEX_URL)
+        return _fetcher
 
-def _pip_download(raw_input, output_dir, verbose=False, debug=False, output_json=False):
+
+def _sanitize_package_name(raw_input):
     # Sanitize input (ref: https://www.python.org/dev/peps/pep-0008/#package-and-module-names)
     exclude = set(string.punctuation.replace("_", "").replace("-", "") + " ")
-    input = "".join(character for character in raw_input if character not in exclude)
-
-    download_package = [
-        "pip3",
-        "download",
-        "--no-binary",
-        "--no-deps",
-        "--dest",
-        output_dir,
-        input,
-    ]
+    return "".join(character for character in raw_input if character not in exclude)
+
+
+def _pip_download(
+    raw_input,
+    output_dir,
+    verbose=False,
+    debug=False,
+    output_json=False,
+    fetcher=None,
+    entry=None,
+    saved_dir=None,
+):
+    input = _sanitize_package_name(raw_input)
+    if fetcher is None:
+        fetcher = _default_fetcher()
 
     try:
-        output = subprocess.run(download_package, capture_output=True)
+        if entry:
+            output = fetcher.download(entry, output_dir, saved_dir)
+        else:
+            output = fetcher.fetch(input, output_dir, saved_dir)
     except Exception as e:
         logging.error(traceback.format_exc())
         return False
 
+    if debug:
+        pprint(output)
     return output
 
 
-def _extract_archives(
-    output, output_dir, package_meta, verbose=False, debug=False, output_json=False
-):
-    stdout = output.stdout.decode("utf-8")
-    if "Saved " in stdout:
-        package_meta["saved_file_name"] = (
-            stdout.split("Saved ")[1].split("\n")[0].replace("./", "")
-        )
-    else:
-        print("File already downloaded or pip transaction failed!")
-        return (False, package_meta)
-    if package_meta["saved_file_name"].endswith(".whl"):
-        if verbose and not output_json:
-            print(f"-> Unzipping downloaded wheel: {package_meta['saved_file_name']}")
-        zip_ref = zipfile.ZipFile(package_meta["saved_file_name"], "r")
-        package_meta["archive_file_list"] = zip_ref.namelist()
-        package_meta["total_package_files"] = len(package_meta["archive_file_list"])
-        parsed_raw_dir_list = list(
-            file for file in package_meta["archive_file_list"] if file.endswith(".py")
-        )
-
-        try:
-            zip_ref.extractall(f"{output_dir}/")
-        except Exception as e:
-            logging.error(traceback.format_exc())
-            zip_ref.close()
-            return (False, package_meta)
+def _resolve_package(raw_input, fetcher, verbose=False, debug=False, output_json=False):
+    # Index lookup only, tells us which archive (and its sha256) we would get
+    try:
+        entry = fetcher.resolve(_sanitize_package_name(raw_input))
+    except Exception as e:
+        logging.error(traceback.format_exc())
+        return False
 
-        zip_ref.close()
-        return (parsed_raw_dir_list, package_meta)
+    if debug:
+        pprint(entry)
+    return entry
 
-    elif package_meta["saved_file_name"].endswith(".tar.gz"):
-        if verbose and not output_json:
-            print(f"-> Extracting tarball: {package_meta['saved_file_name']}")
-        tar_ref = tarfile.open(package_meta["saved_file_name"], "r")
-        package_meta["archive_file_list"] = tar_ref.getnames()
-        package_meta["total_package_files"] = len(package_meta["archive_file_list"])
 
-        parsed_raw_dir_list = list(
-            file for file in package_meta["archive_file_list"] if file.endswith(".py")
+def _resolve_names(package_meta, files, parsed_raw_dir_list):
+    # The package's names are read from the listed archive, before anything
+    # is extracted, and shared by every plugin through package_meta.
+    try:
+        package_meta["package_names"] = resolve_package_names(
+            files, sorted(set(file.split("/")[0] for file in parsed_raw_dir_list))
         )
+    except Exception as e:
+        logging.error(traceback.format_exc())
 
-        try:
-            tar_ref.extractall(f"{output_dir}/")
-        except Exception as e:
-            logging.error(traceback.format_exc())
-            tar_ref.close()
-            return (False, package_meta)
 
-        tar_ref.close()
-        return (parsed_raw_dir_list, package_meta)
+def _member_budget(archive_path, limits=None):
+    return Member_Budget(os.path.getsize(archive_path), **(limits or {}))
 
+
+def _extract_archives(
+    output,
+    output_dir,
+    package_meta,
+    verbose=False,
+    debug=False,
+    output_json=False,
+    extract=True,
+    scratch=None,
+    limits=None,
+    manifest=None,
+):
+    if not output:
+        print("Download failed, nothing to extract!")
+        return (False, package_meta)
+    package_meta["saved_file_name"] = output["path"]
+    package_meta["archive_sha256"] = output["sha256"]
+    package_meta["archive_size"] = output["size"]
+    package_meta["project"] = output["project"]
+    package_meta["version"] = output["version"]
+    archive_path = package_meta["saved_file_name"]
+    if archive_path.endswith(".whl"):
+        action = "Unzipping" if extract else "Listing"
+        kind = "downloaded wheel"
+    elif archive_path.endswith(".tar.gz"):
+        action = "Extracting" if extract else "Listing"
+        kind = "tarball"
     else:
         if verbose and not output_json:
             print(
-                f"{package_meta['saved_file_name']} found. Not a wheel or tarball, can't handle anything else yet."
+                f"{archive_path} found. Not a wheel or tarball, can't handle anything else yet."
             )
-        return False
+        return (False, package_meta)
+    if verbose and not output_json:
+        print(f"-> {action} {kind}: {archive_path}")
+
+    # One pass over the archive, through its member budget: each kept member
+    # is written out (when extracting) and hashed into manifest (when given)
+    # as it is read, and only the names of the files the package names are
+    # read from are kept in memory on the way.  A bomb is turned away as soon
+    # as it crosses a limit, whatever was written by then goes with the
+    # package's scratch directory.
+    budget = _member_budget(archive_path, limits)
+    parsed_raw_dir_list = []
+    name_files = []
+    try:
+        if extract:
+            if scratch:
+                scratch.reserve(
+                    output_dir,
+                    package_meta["archive_size"]
+                    + min(expanded_size(archive_path), budget.max_package_bytes),
+                )
+            root = os.path.realpath(output_dir)
+        for name, size, head, file in iter_members(archive_path, budget):
+            if name.endswith(".py"):
+                parsed_raw_dir_list.append(name)
+            if wanted_name_file(name) and size <= MAX_NAME_FILE_BYTES:
+                head += file.read()
+                name_files.append((name, head))
+            target = member_path(root, name) if extract else None
+            digest = hashlib.sha256() if manifest is not None else None
+            if target:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                with open(target, "wb") as out:
+                    copy_member(head, file, out, digest)
+            elif digest:
+                copy_member(head, file, digest=digest)
+            if digest:
+                name = os.path.normpath(name)
+                manifest[_release_path(name, package_meta.get("version"))] = (
+                    name,
+                    digest.hexdigest(),
+                )
+    except Archive_Rejected as e:
+        package_meta["archive_rejected"] = str(e)
+        logging.error(f"Rejected {archive_path}: {e}")
+        return (False, package_meta)
+    except Exception as e:
+        logging.error(traceback.format_exc())
+        return (False, package_meta)
+    package_meta["archive_file_list"] = budget.names
+    package_meta["total_package_files"] = len(budget.names)
+    package_meta["extracted_size"] = budget.kept_bytes
+    if budget.skipped_count:
+        package_meta["skipped_members"] = budget.skipped
+        package_meta["skipped_member_count"] = budget.skipped_count
+        if verbose and not output_json:
+            print(f"-> Skipped {budget.skipped_count} binary or oversized files")
+    _resolve_names(package_meta, name_files, parsed_raw_dir_list)
+
+    return (parsed_raw_dir_list, package_meta)
+
+
+def _iter_archive_members(archive_path, limits=None):
+    # Yields (name, bytes) for every file the extract stage keeps, without
+    # writing anything to disk.  Tarballs are read as a forward only stream.
+    return read_members(archive_path, _member_budget(archive_path, limits))
+
+
+def _default_stream_root():
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return tempfile.gettempdir()
 
 
 def _retrieve_directories_to_scan(
@@ -134,40 +356,653 @@ def _retrieve_directories_to_scan(
     return (scan_list, package_meta)
 
 
-def _clean_up_downloads(
-    package_meta, output_dir, verbose=False, debug=False, output_json=False
-):
-    # Empty the files first
-    for file in package_meta["archive_file_list"]:
-        file_target = os.path.join(output_dir, file)
-        if debug:
-            print(f"Trying to delete: {file_target}")
-        if os.path.isfile(file_target):
+def _package_identity(job):
+    package_meta = job["package_meta"]
+    return (
+        package_meta.get("project") or job["raw_input"],
+        package_meta.get("version"),
+        package_meta.get("archive_sha256"),
+    )
+
+
+def _release_path(name, version):
+    # Archive member name without an sdist's "{name}-{version}/" root, so the
+    # same file lines up across releases
+    root, _, rest = name.partition("/")
+    if rest and version and root.endswith(f"-{version}"):
+        return rest
+    return name
+
+
+def _carry_findings(findings, version, unchanged):
+    # Findings of the previous release in files that have not changed, moved
+    # to wherever those files are in this release
+    carried = []
+    for target, finding in findings:
+        name = unchanged.get(_release_path(finding["file"] or "", version))
+        if name is None:
+            continue
+        details = finding["details"]
+        if isinstance(details, dict) and details.get("filename") == finding["file"]:
+            details = dict(details, filename=name)
+        carried.append((name.split("/")[0], dict(finding, file=name, details=details)))
+    return carried
+
+
+def _usable_hits(hits, results=None):
+    # Entries cached with a results store hold findings instead of report
+    # files, only reuse the ones that match how this run saves its output.
+    return {
+        key: hit
+        for key, hit in hits.items()
+        if (FINDINGS_REPORT in hit[1]) == bool(results)
+    }
+
+
+def _timed_stage(name):
+    # Adds the time a job spends in the decorated stage to job["timings"]
+    def decorator(stage):
+        @functools.wraps(stage)
+        def wrapper(job, *args, **kwargs):
+            started = time.perf_counter()
             try:
-                os.remove(file_target)
-            except Exception as e:
-                logging.error(traceback.format_exc())
+                return stage(job, *args, **kwargs)
+            finally:
+                timings = job.setdefault("timings", {})
+                timings[name] = timings.get(name, 0) + time.perf_counter() - started
+
+        return wrapper
+
+    return decorator
+
 
-    # Remove the directories
-    dirs = set(dirs.split("/")[0] for dirs in package_meta["archive_file_list"])
-    for dir in dirs:
-        directory = os.path.join(output_dir, dir)
-        if os.path.isdir(directory):
+def _restore_cached_results(
+    job, hits, results=None, verbose=False, debug=False, output_json=False
+):
+    for (name, version), (scan_errors, reports) in hits.items():
+        if verbose and not output_json:
+            print(f"-> Cached {name} {version} results for {job['raw_input']}")
+        if results:
+            findings = json.loads(reports[FINDINGS_REPORT].decode("utf-8"))
+            _keep_findings(job, name, findings)
+            results.add(
+                _package_identity(job),
+                (name, version),
+                scan_errors,
+                [tuple(finding) for finding in findings],
+            )
+        else:
+            write_reports(job["scratch_dir"], reports)
+        job["scan_errors"] += scan_errors
+
+
+_REUSED_FROM = {"store": "archive store", "output_dir": "output directory"}
+
+
+@_timed_stage("download")
+def _download_stage(
+    job,
+    fetcher,
+    cache=None,
+    plugins=(),
+    results=None,
+    scratch=None,
+    verbose=False,
+    debug=False,
+    output_json=False,
+):
+    entry = None
+    if cache:
+        # When the index publishes the archive hash we can tell whether we
+        # already audited this exact archive before downloading anything.
+        entry = _resolve_package(job["raw_input"], fetcher, verbose, debug, output_json)
+        if entry and entry["sha256"]:
+            # Keys are taken for every job, a plugin's cache_tag() can change
+            # during a run
+            plugin_keys = [plugin_key(plugin) for plugin in plugins]
+            job["cache_hits"] = _usable_hits(
+                cache.lookup(entry["sha256"], plugin_keys), results
+            )
+            if plugin_keys and len(job["cache_hits"]) == len(plugin_keys):
+                job["package_meta"]["project"] = entry["project"]
+                job["package_meta"]["version"] = entry["version"]
+                job["package_meta"]["archive_sha256"] = entry["sha256"]
+                _restore_cached_results(
+                    job, job["cache_hits"], results, verbose, debug, output_json
+                )
+                job["skip"] = True
+                return
+
+    if verbose and not output_json:
+        print(f"-> Downloading {job['raw_input']}")
+    if debug:
+        pprint(job["raw_input"])
+    if scratch:
+        job["work_dir"] = scratch.create(job["scratch_name"])
+    if entry is False:
+        job["output"] = False
+    else:
+        job["output"] = _pip_download(
+            raw_input=job["raw_input"],
+            output_dir=job["work_dir"],
+            verbose=verbose,
+            debug=debug,
+            output_json=output_json,
+            fetcher=fetcher,
+            entry=entry,
+            saved_dir=job["scratch_dir"],
+        )
+    if job["output"] and job["output"]["source"] != "index":
+        if verbose and not output_json:
+            print(
+                f"-> Reusing {job['output']['file_name']} from the {_REUSED_FROM[job['output']['source']]}"
+            )
+    if not job["output"]:
+        if verbose and not output_json:
+            print(f"! Download failed for {job['raw_input']}")
+        job["scan_errors"] += 1
+        job["skip"] = True
+
+
+@_timed_stage("extract")
+def _extract_stage(
+    job,
+    stream_root=None,
+    stream_tree=False,
+    scratch=None,
+    limits=None,
+    incremental=False,
+    verbose=False,
+    debug=False,
+    output_json=False,
+):
+    if verbose and not output_json:
+        print(f"-> Extracting archives and meta for {job['raw_input']}")
+    # In streaming mode nothing goes to the output directory.  When a plugin
+    # needs a directory tree the same pass that lists the archive writes one
+    # to tmpfs instead, which the scan stage drops once the plugins are done.
+    output_dir = job["work_dir"]
+    if stream_root:
+        output_dir = None
+        if stream_tree:
+            output_dir = job["tree_dir"] = tempfile.mkdtemp(
+                prefix="pip_audit_", dir=stream_root
+            )
+    # The file hashes incremental scanning diffs releases by
+    if incremental:
+        job["manifest"] = {}
+    parsed_raw_dir_list, job["package_meta"] = _extract_archives(
+        output=job["output"],
+        output_dir=output_dir,
+        package_meta=job["package_meta"],
+        verbose=verbose,
+        debug=debug,
+        output_json=output_json,
+        extract=output_dir is not None,
+        scratch=None if stream_root else scratch,
+        limits=limits,
+        manifest=job.get("manifest"),
+    )
+    if job["package_meta"].get("archive_rejected"):
+        if verbose and not output_json:
+            print(
+                f"! {job['raw_input']} rejected: {job['package_meta']['archive_rejected']}"
+            )
+        job["scan_errors"] += 1
+
+    if verbose and not output_json:
+        print(f"-> Parsing out the scan list for {job['raw_input']}")
+    if debug:
+        pprint(parsed_raw_dir_list)
+    if not parsed_raw_dir_list:
+        job["skip"] = True
+        return
+
+    scan_list = _retrieve_directories_to_scan(
+        parsed_raw_dir_list=parsed_raw_dir_list,
+        package_meta=job["package_meta"],
+        verbose=verbose,
+        debug=debug,
+        output_json=output_json,
+    )
+    if scan_list:
+        job["scan_list"], job["package_meta"] = scan_list
+    else:
+        job["skip"] = True
+
+
+def _record_findings(findings, target, items):
+    findings.extend((target, item) for item in items)
+
+
+def _keep_findings(job, plugin_name, findings):
+    # A job's findings from all its plugins, for whoever asked for the
+    # package (see audit_daemon)
+    job.setdefault("findings", []).extend(
+        dict(finding, plugin=plugin_name, target=target) for target, finding in findings
+    )
+
+
+@_timed_stage("scan")
+def _scan_stage(
+    job,
+    all_plugins,
+    stream_root=None,
+    cache=None,
+    results=None,
+    scratch=None,
+    incremental=False,
+    runner=None,
+    limits=None,
+    verbose=False,
+    debug=False,
+    output_json=False,
+):
+    package_meta = job["package_meta"]
+    report_dir = job["scratch_dir"]
+    os.makedirs(report_dir, exist_ok=True)
+
+    # Plugins with a cached result for this exact archive and plugin version
+    # are not run again, their reports are restored instead.
+    hits = job.get("cache_hits")
+    if cache and hits is None:
+        hits = _usable_hits(
+            cache.lookup(
+                package_meta.get("archive_sha256"),
+                [plugin_key(plugin) for plugin in all_plugins],
+            ),
+            results,
+        )
+    hits = hits or {}
+    to_run = [plugin for plugin in all_plugins if plugin_key(plugin) not in hits]
+
+    responses = []
+    if hits:
+        _restore_cached_results(job, hits, results, verbose, debug, output_json)
+
+    # stream_root is only set in streaming mode: plugins that can read archive
+    # members get them straight from the archive, the rest share the tmpfs
+    # copy the extract stage wrote, dropped as soon as they are done.
+    members = None
+    tree_dir = job.get("tree_dir", job["work_dir"])
+    if stream_root:
+        archive_path = package_meta["saved_file_name"]
+        members = lambda: _iter_archive_members(archive_path, limits)
+
+    # With incremental scanning the archive is diffed against the project's
+    # last audited release.  Plugins that can scan single files only get the
+    # ones that changed, their findings in the rest are carried over.
+    previous = None
+    manifest = job.pop("manifest", None) or {}
+    if incremental and results and to_run:
+        identity = _package_identity(job)
+        previous = results.previous_release(identity[0], identity[2])
+        results.add_manifest(
+            identity, {path: digest for path, (name, digest) in manifest.items()}
+        )
+    if previous:
+        changed = set()
+        unchanged = {}
+        for path, (name, digest) in manifest.items():
+            if previous[2].get(path) == digest:
+                unchanged[path] = name
+            else:
+                changed.add(name)
+        package_meta["incremental_base"] = previous[0]
+        package_meta["changed_files"] = len(changed)
+        if verbose and not output_json:
+            print(
+                f"-> {len(changed)} of {len(manifest)} files changed since {identity[0]} {previous[0]}"
+            )
+
+    def _plugin_done(plugin, request, findings, carried, response, seconds):
+        # Runs on the plugin's executor once it has scanned the package
+        job["plugin_timings"][plugin.name] = seconds
+        findings.extend(carried)
+        if results:
+            _keep_findings(job, plugin.name, findings)
+            results.add(_package_identity(job), plugin_key(plugin), response, findings)
+        if cache:
+            # Each plugin wrote into a directory of its own, so everything in
+            # there is its report
+            reports = read_new_reports(request["report_dir"], {})
+            write_reports(report_dir, reports)
+            shutil.rmtree(request["report_dir"], ignore_errors=True)
+            # Only clean scans are kept, a failed one is run again next time
+            # instead of its failure being replayed
+            if response == 0:
+                if results:
+                    reports[FINDINGS_REPORT] = json.dumps(findings).encode("utf-8")
+                cache.store(
+                    package_meta.get("archive_sha256"),
+                    plugin_key(plugin),
+                    response,
+                    reports,
+                )
+        return response
+
+    # Every plugin is handed to the runner at once, which runs them side by
+    # side (and batches them with other packages' scans where it can).
+    futures = []
+    try:
+        for plugin in to_run:
+            needs_filesystem = getattr(plugin.plugin_object, "needs_filesystem", True)
+            only_files = None
+            carried = []
+            if previous and getattr(plugin.plugin_object, "incremental", False):
+                earlier = results.findings_of(previous[1], plugin_key(plugin))
+                if earlier is not None:
+                    only_files = changed
+                    carried = _carry_findings(earlier, previous[0], unchanged)
+            plugin_report_dir = report_dir
+            if cache:
+                plugin_report_dir = tempfile.mkdtemp(prefix=".reports-", dir=report_dir)
+            # With a results store plugins hand over their findings instead of
+            # writing report files, as (target, finding dict) pairs.
+            findings = []
+            record_findings = None
+            if results:
+                record_findings = functools.partial(_record_findings, findings)
+            request = scan_request(
+                job["scan_list"],
+                package_meta,
+                tree_dir if needs_filesystem or not members else report_dir,
+                verbose,
+                debug,
+                output_json,
+                report_dir=plugin_report_dir,
+                members=members,
+                record_findings=record_findings,
+                only_files=only_files,
+            )
+            done = functools.partial(_plugin_done, plugin, request, findings, carried)
+            # A job's profile is enabled on this thread only, so with
+            # --profile its plugins run here instead of on the runner's
+            # executors, or their work would not show up in it
+            if runner and not job.get("profile"):
+                futures.append(runner.submit(plugin.name, request, done))
+            else:
+                started = time.perf_counter()
+                response = adapt(plugin.plugin_object).scan_batch([request])[0]
+                responses.append(done(response, time.perf_counter() - started))
+        for future in futures:
+            responses.append(future.result())
+    finally:
+        concurrent.futures.wait(futures)
+        job.pop("tree_dir", None)
+        if tree_dir != job["work_dir"]:
+            if scratch:
+                scratch.drop(tree_dir)
+            else:
+                shutil.rmtree(tree_dir, ignore_errors=True)
+    job["scan_errors"] += sum(responses)
+    if debug:
+        pprint(responses)
+
+
+@_timed_stage("cleanup")
+def _cleanup_stage(job, scratch, verbose=False, debug=False, output_json=False):
+    # Runs for every job, including the ones an earlier stage gave up on, so a
+    # half extracted package does not linger on scratch.  Without scratch
+    # (--save_files) the files stay next to the reports.  A --stream tree the
+    # scan stage never got to goes too.
+    tree_dir = job.pop("tree_dir", None)
+    if tree_dir:
+        if scratch:
+            scratch.drop(tree_dir)
+        else:
+            shutil.rmtree(tree_dir, ignore_errors=True)
+    if not scratch or job["work_dir"] == job["scratch_dir"]:
+        return
+    if verbose and not output_json:
+        print(f"-> Cleaning up downloaded files for {job['raw_input']}")
+    if debug:
+        pprint(job["package_meta"])
+    scratch.drop(job["work_dir"])
+
+
+def _journaled_targets(
+    targets,
+    journal,
+    resume=False,
+    max_attempts=DEFAULT_MAX_ATTEMPTS,
+    verbose=False,
+    debug=False,
+    output_json=False,
+):
+    # On resume the packages that already finished cleanly, or failed
+    # max_attempts times, are left out
+    for raw_input in targets:
+        if resume and not journal.should_run(raw_input, max_attempts):
             if debug:
-                print(f"Trying to delete dir: {directory}")
+                print(f"Skipping {raw_input}, journal has {journal.status(raw_input)}")
+            continue
+        yield raw_input
+
+
+def _started_in_journal(targets, journal):
+    # Packages are marked as started (using up an attempt) as the pipeline
+    # takes them, not while they wait in a scheduling window
+    for raw_input in targets:
+        journal.start(raw_input)
+        yield raw_input
+
+
+def _finish_in_journal(journal, jobs):
+    if journal:
+        for job in jobs:
+            journal.finish(
+                job["raw_input"], job["scan_errors"], sum(job["timings"].values())
+            )
+
+
+def _pull_from_queue(
+    work_queue, worker_id=None, verbose=False, debug=False, output_json=False
+):
+    # Worker side of --queue, the pipeline's targets are leased packages
+    worker = Queue_Worker(work_queue, worker_id)
+    if verbose and not output_json:
+        print(f"-> Working on {work_queue.path} as {worker.worker}")
+    return worker, worker.targets(verbose, debug, output_json)
+
+
+def _ack_in_queue(worker, jobs):
+    if worker:
+        for job in jobs:
+            worker.done(job["raw_input"], job["scan_errors"])
+
+
+def _enable_profile(profile):
+    # A job's profile follows it through every stage's thread.  Where the
+    # profiler is process wide (Python 3.12+) only one stage can be profiled
+    # at a time, the others just run unprofiled.
+    if profile is None:
+        return None
+    try:
+        profile.enable()
+    except ValueError:
+        return None
+    return profile
+
+
+def _save_profile(job, profile_dir, threshold):
+    # Keep the profile of packages whose stages took threshold seconds or more
+    profile, job["profile"] = job.get("profile"), None
+    if profile and sum(job["timings"].values()) >= threshold:
+        os.makedirs(profile_dir, exist_ok=True)
+        profile.dump_stats(os.path.join(profile_dir, f"{job['scratch_name']}.prof"))
+
+
+def _stage_worker(stage, run_skipped, in_queue, out_queue, on_exit):
+    while True:
+        job = in_queue.get()
+        if job is None:
+            break
+        if run_skipped or not job["skip"]:
+            profile = _enable_profile(job.get("profile"))
             try:
-                shutil.rmtree(directory)
+                stage(job)
             except Exception as e:
                 logging.error(traceback.format_exc())
+                job["scan_errors"] += 1
+                job["skip"] = True
+            finally:
+                if profile:
+                    profile.disable()
+        out_queue.put(job)
+    on_exit()
 
-    # delete archive
-    if debug:
-        print(f"Trying to delete: {package_meta['saved_file_name']}")
-    if os.path.isfile(package_meta["saved_file_name"]):
-        try:
-            os.remove(package_meta["saved_file_name"])
-        except Exception as e:
-            logging.error(traceback.format_exc())
+
+def _new_job(raw_input, output_dir, in_flight, in_flight_lock, profile=False):
+    # Every package gets its own directory so concurrent downloads and
+    # extractions never write into the same tree.  Its reports go there, and
+    # so do its files unless the download stage moves them to a work_dir on
+    # the scratch space.  The same name queued twice
+    # while the first copy is still in the pipeline gets a numbered sibling.
+    name = _sanitize_package_name(raw_input)
+    with in_flight_lock:
+        scratch_name = name
+        duplicate = 1
+        while scratch_name in in_flight:
+            duplicate += 1
+            scratch_name = f"{name}-{duplicate}"
+        in_flight.add(scratch_name)
+    return {
+        "raw_input": raw_input,
+        "scratch_name": scratch_name,
+        "scratch_dir": os.path.join(output_dir, scratch_name),
+        "work_dir": os.path.join(output_dir, scratch_name),
+        "package_meta": {},
+        "scan_list": [],
+        "scan_errors": 0,
+        "skip": False,
+        "timings": {},
+        "plugin_timings": {},
+        "profile": cProfile.Profile() if profile else None,
+    }
+
+
+def _run_pipeline(
+    targets, stages, output_dir, queue_size=4, profile=False, source=None
+):
+    # Push targets through the stages, yielding each finished job.  stages is
+    # a list of (callable, worker count, run_skipped) tuples.  Every stage
+    # reads from a bounded queue and writes to the next, so a slow stage
+    # applies back pressure instead of letting jobs pile up in memory.
+    # source, if given, wraps the stream of new jobs before the first stage
+    # (the prefetcher downloads them there).
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    queues.append(queue.Queue(maxsize=queue_size))
+    in_flight = set()
+    in_flight_lock = threading.Lock()
+
+    def _feed():
+        jobs = (
+            _new_job(raw_input, output_dir, in_flight, in_flight_lock, profile)
+            for raw_input in targets
+        )
+        for job in source(jobs) if source else jobs:
+            queues[0].put(job)
+        for _ in range(stages[0][1]):
+            queues[0].put(None)
+
+    def _make_on_exit(index, workers):
+        # The last worker of a stage to exit hands one sentinel per worker on
+        # to the next stage (or a single one to the result reader).
+        remaining = [workers]
+        lock = threading.Lock()
+
+        def _on_exit():
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                next_workers = stages[index + 1][1] if index + 1 < len(stages) else 1
+                for _ in range(next_workers):
+                    queues[index + 1].put(None)
+
+        return _on_exit
+
+    threads = [threading.Thread(target=_feed, daemon=True)]
+    for index, (stage, workers, run_skipped) in enumerate(stages):
+        on_exit = _make_on_exit(index, workers)
+        for _ in range(workers):
+            threads.append(
+                threading.Thread(
+                    target=_stage_worker,
+                    args=(
+                        stage,
+                        run_skipped,
+                        queues[index],
+                        queues[index + 1],
+                        on_exit,
+                    ),
+                    daemon=True,
+                )
+            )
+    for thread in threads:
+        thread.start()
+
+    while True:
+        job = queues[-1].get()
+        if job is None:
+            break
+        with in_flight_lock:
+            in_flight.discard(job["scratch_name"])
+        yield job
+
+    for thread in threads:
+        thread.join()
+
+
+def _load_plugins(verbose=False, debug=False, output_json=False):
+    # (yapsy plugin infos, version 2 plugin objects by name).  yapsy is
+    # imported here, it is slow to import and not every run loads plugins.
+    from yapsy.PluginManager import PluginManager
+
+    if verbose and not output_json:
+        print("-> Loading scan plugins")
+    scan_plugins = PluginManager()
+    scan_plugins.setPluginPlaces(["plugins"])
+    scan_plugins.collectPlugins()
+    all_plugins = scan_plugins.getAllPlugins()
+    for plugin in all_plugins:
+        # Plugins do their one-off setup (e.g. loading reference data) here
+        scan_plugins.activatePluginByName(plugin.name)
+    # Old style plugins are wrapped to look like version 2 ones, see plugin_api
+    plugin_objects = {
+        plugin.name: adapt(plugin.plugin_object) for plugin in all_plugins
+    }
+    for plugin_object in plugin_objects.values():
+        plugin_object.setup()
+    return all_plugins, plugin_objects
+
+
+def _audit_remotely(address, targets, verbose=False, debug=False, output_json=False):
+    # --connect: the daemon does the auditing, this just prints its results
+    from audit_daemon import audit, Daemon_Error
+
+    targets = list(targets)
+    if not targets:
+        return
+    if verbose and not output_json:
+        print(f"-> Sending {len(targets)} packages to the audit daemon at {address}")
+    try:
+        results = audit(address, targets)
+    except (OSError, Daemon_Error) as e:
+        raise click.ClickException(f"audit daemon at {address}: {e}")
+    if output_json:
+        print(json.dumps(results))
+        return
+    for result in results:
+        if verbose or debug:
+            print(json.dumps(result, indent=4))
+        elif "error" in result:
+            print(f"{result['package']}: {result['error']}")
+        else:
+            print(
+                f"{result['package']} {result['version']}: {result['scan_errors']} errors, reports in {result['report_dir']}"
+            )
 
 
 @click.command()
@@ -192,7 +1027,7 @@ def _clean_up_downloads(
     "-i",
     "--input",
     "input_list",
-    help="Input list file, in json format, of packages to scan.",
+    help="Input list of packages to scan, a JSON list or JSONL file, or - for stdin.",
 )
 @click.option(
     "-s",
@@ -201,101 +1036,575 @@ def _clean_up_downloads(
     help="CAUTION! Don't clean up the pip downloads and extracted archive files.  Careful, the whole PyPI archive has over 2 million files",
     is_flag=True,
 )
-def main(package_name, output_dir, verbose, debug, output_json, input_list, save_files):
+@click.option(
+    "--index-url",
+    "index_url",
+    help="Simple (PEP 503/691) index to download from, a URL or a local directory.",
+    default=DEFAULT_INDEX_URL,
+)
+@click.option(
+    "--download-workers",
+    "download_workers",
+    help="Number of packages downloaded at the same time.",
+    default=1,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--extract-workers",
+    "extract_workers",
+    help="Number of archives extracted at the same time.",
+    default=1,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--scan-workers",
+    "scan_workers",
+    help="Number of packages run through the scan plugins at the same time.",
+    default=1,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--queue-size",
+    "queue_size",
+    help="How many packages may wait between two pipeline stages.",
+    default=4,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--stream",
+    "stream",
+    help="Scan straight out of the archives instead of extracting them to disk.",
+    is_flag=True,
+)
+@click.option(
+    "--stream-tmp",
+    "stream_tmp",
+    help="Where to unpack packages for plugins that need a directory tree in --stream mode (defaults to /dev/shm).",
+    default=None,
+)
+@click.option(
+    "--scratch-root",
+    "scratch_root",
+    help="Where packages are downloaded and extracted, e.g. /dev/shm/pip_audit (defaults to .scratch in the output directory).  Runs can share it, each works in a directory of its own.",
+    default=None,
+)
+@click.option(
+    "--scratch-max-bytes",
+    "scratch_max_bytes",
+    help="Hold back extracting while packages on scratch take up this many bytes.",
+    default=None,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--cache",
+    "cache_path",
+    help="SQLite file caching plugin results by archive sha256 and plugin version.",
+    default=None,
+)
+@click.option(
+    "--cache-max-bytes",
+    "cache_max_bytes",
+    help="Evict least recently used cache entries above this size.",
+    default=DEFAULT_MAX_BYTES,
+    type=click.IntRange(min=0),
+)
+@click.option(
+    "--archive-store",
+    "store_dir",
+    help="Directory keeping downloaded archives by sha256, checked before downloading.",
+    default=None,
+)
+@click.option(
+    "--archive-store-max-bytes",
+    "store_max_bytes",
+    help="Evict least recently used archives from the store above this size.",
+    default=DEFAULT_STORE_BYTES,
+    type=click.IntRange(min=0),
+)
+@click.option(
+    "--shard",
+    "shard",
+    help="Only audit slice i of N of the targets (e.g. 1/4), for splitting a list across hosts.",
+    default=None,
+    callback=_parse_shard,
+)
+@click.option(
+    "--journal",
+    "journal_path",
+    help="SQLite file recording the status, errors and timing of every package.",
+    default=None,
+)
+@click.option(
+    "--resume",
+    "resume",
+    help="Skip packages the journal has as done, retry the failed ones.",
+    is_flag=True,
+)
+@click.option(
+    "--max-attempts",
+    "max_attempts",
+    help="With --resume or --queue, give up on a package after this many attempts.",
+    default=DEFAULT_MAX_ATTEMPTS,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--largest-first",
+    "largest_first",
+    help="Audit the biggest packages first (by their archive size or their time in the --journal), so they don't hold up the end of the run.",
+    is_flag=True,
+)
+@click.option(
+    "--schedule-window",
+    "schedule_window",
+    help="With --largest-first, reorder this many packages of the list at a time (0 for the whole list).",
+    default=DEFAULT_WINDOW,
+    type=click.IntRange(min=0),
+)
+@click.option(
+    "--serve",
+    "serve",
+    help="Run as a daemon auditing the packages clients send to this Unix socket path or [HOST:]PORT.",
+    default=None,
+)
+@click.option(
+    "--connect",
+    "connect",
+    help="Have the daemon at this Unix socket path or [HOST:]PORT audit the -p/-i packages.",
+    default=None,
+)
+@click.option(
+    "--queue",
+    "queue_path",
+    help="SQLite work queue shared by workers: without -p/-i, lease packages from it and audit them.",
+    default=None,
+)
+@click.option(
+    "--enqueue",
+    "enqueue",
+    help="Add the -p/-i packages to the --queue for workers and exit.",
+    is_flag=True,
+)
+@click.option(
+    "--lease-seconds",
+    "lease_seconds",
+    help="With --queue, how long a package stays leased without a heartbeat before it is redelivered.",
+    default=DEFAULT_LEASE_SECONDS,
+    type=click.FloatRange(min=1),
+)
+@click.option(
+    "--worker-id",
+    "worker_id",
+    help="With --queue, the name leases are held under (defaults to host-pid).",
+    default=None,
+)
+@click.option(
+    "--results-db",
+    "results_path",
+    help="SQLite file collecting every plugin's findings, instead of report files.",
+    default=None,
+)
+@click.option(
+    "--incremental",
+    "incremental",
+    help="With --results-db, only scan the files that changed since the project's last audited release.",
+    is_flag=True,
+)
+@click.option(
+    "--metrics-json",
+    "metrics_json",
+    help="Write per stage and per plugin timing percentiles to this JSON file.",
+    default=None,
+)
+@click.option(
+    "--metrics-textfile",
+    "metrics_textfile",
+    help="Write the same metrics as a Prometheus textfile (node_exporter textfile collector).",
+    default=None,
+)
+@click.option(
+    "--metrics-interval",
+    "metrics_interval",
+    help="Seconds between metrics file updates during the run.",
+    default=60.0,
+    type=click.FloatRange(min=0),
+)
+@click.option(
+    "--profile",
+    "profile_dir",
+    help="Directory to write a cProfile .prof file to for every slow package.",
+    default=None,
+)
+@click.option(
+    "--profile-threshold",
+    "profile_threshold",
+    help="With --profile, only keep packages that took at least this many seconds.",
+    default=30.0,
+    type=click.FloatRange(min=0),
+)
+@click.option(
+    "--prefetch",
+    "prefetch",
+    help="Download this many archives ahead of the scanners with the asyncio prefetcher (replaces --download-workers).",
+    default=0,
+    type=click.IntRange(min=0),
+)
+@click.option(
+    "--prefetch-max-bytes",
+    "prefetch_max_bytes",
+    help="Stop reading ahead while this many bytes of prefetched archives are waiting.",
+    default=DEFAULT_PREFETCH_BYTES,
+    type=click.IntRange(min=0),
+)
+@click.option(
+    "--per-host-connections",
+    "per_host_connections",
+    help="With --prefetch, most requests to one host at the same time.",
+    default=DEFAULT_PER_HOST,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--retries",
+    "retries",
+    help="With --prefetch, retries with backoff for connection errors, 429s and 5xx responses.",
+    default=DEFAULT_RETRIES,
+    type=click.IntRange(min=0),
+)
+@click.option(
+    "--max-member-bytes",
+    "max_member_bytes",
+    help="Files in a package bigger than this are skipped instead of extracted and scanned.",
+    default=DEFAULT_MAX_MEMBER_BYTES,
+    type=click.IntRange(min=0),
+)
+@click.option(
+    "--max-package-bytes",
+    "max_package_bytes",
+    help="Reject packages that expand to more than this (or to over 100 times their archive size).",
+    default=DEFAULT_MAX_PACKAGE_BYTES,
+    type=click.IntRange(min=0),
+)
+@click.option(
+    "--max-members",
+    "max_members",
+    help="Reject packages with more files than this.",
+    default=DEFAULT_MAX_MEMBERS,
+    type=click.IntRange(min=1),
+)
+def main(
+    package_name,
+    output_dir,
+    verbose,
+    debug,
+    output_json,
+    input_list,
+    save_files,
+    download_workers,
+    extract_workers,
+    scan_workers,
+    queue_size,
+    index_url,
+    stream,
+    stream_tmp,
+    scratch_root,
+    scratch_max_bytes,
+    cache_path,
+    cache_max_bytes,
+    store_dir,
+    store_max_bytes,
+    journal_path,
+    resume,
+    max_attempts,
+    largest_first,
+    schedule_window,
+    serve,
+    connect,
+    queue_path,
+    enqueue,
+    lease_seconds,
+    worker_id,
+    shard,
+    results_path,
+    incremental,
+    metrics_json,
+    metrics_textfile,
+    metrics_interval,
+    profile_dir,
+    profile_threshold,
+    prefetch,
+    prefetch_max_bytes,
+    per_host_connections,
+    retries,
+    max_member_bytes,
+    max_package_bytes,
+    max_members,
+):
+    if resume and not journal_path:
+        raise click.UsageError("--resume needs the --journal of the run to resume.")
+    if incremental and not results_path:
+        raise click.UsageError(
+            "--incremental needs a --results-db to keep earlier findings in."
+        )
+
+    if serve and (package_name or input_list or queue_path or connect):
+        raise click.UsageError(
+            "--serve gets its packages from clients, not from -p/-i, --queue or --connect."
+        )
+    if serve and (resume or largest_first or shard):
+        raise click.UsageError(
+            "--resume, --largest-first and --shard don't work with --serve."
+        )
+    if connect and not (package_name or input_list):
+        raise click.UsageError("--connect needs packages to audit, from -p or -i.")
+
+    # A --largest-first worker would lease a whole window before starting
+    # and leave the other workers nothing, the queue is put in size order by
+    # --enqueue --largest-first instead
+    if queue_path and not enqueue and (shard or resume or largest_first):
+        raise click.UsageError(
+            "--shard, --resume and --largest-first don't work for --queue workers, the queue already hands out each package once (biggest first when filled with --enqueue --largest-first)."
+        )
+    if enqueue and not queue_path:
+        raise click.UsageError("--enqueue needs a --queue to add the packages to.")
+    if enqueue and not (package_name or input_list):
+        raise click.UsageError("--enqueue needs packages to add, from -p or -i.")
+
     # Normalize targeting options
+    flags = dict(verbose=verbose, debug=debug, output_json=output_json)
+    if connect:
+        targets = [package_name] if package_name else _iter_targets(input_list, **flags)
+        if shard:
+            targets = (target for target in targets if _in_shard(target, shard))
+        _audit_remotely(connect, targets, **flags)
+        return
+
+    work_queue = (
+        Work_Queue(queue_path, lease_seconds, max_attempts) if queue_path else None
+    )
+    worker = None
     targets = []
     if package_name:
         targets.append(package_name)
     elif input_list:
-        targets = _decode_json_file(input_list)
-    # else:
-    # targets = _pull_from_queue()
+        targets = _iter_targets(input_list, verbose, debug, output_json)
+    elif work_queue:
+        worker, targets = _pull_from_queue(work_queue, worker_id, **flags)
+    if shard:
+        targets = (target for target in targets if _in_shard(target, shard))
 
-    if verbose and not output_json:
-        print("-> Loading scan plugins")
-    scan_plugins = PluginManager()
-    scan_plugins.setPluginPlaces(["plugins"])
-    scan_plugins.collectPlugins()
-    all_plugins = scan_plugins.getAllPlugins()
+    # The coordinator only fills the queue, workers do the auditing.  With
+    # --largest-first workers lease the biggest packages first.
+    if enqueue:
+        cost = None
+        if largest_first:
+            fetcher = Package_Fetcher(index_url)
+            scheduler = Size_Scheduler(
+                window=0,
+                lookup=lambda raw_input: fetcher.resolve(
+                    _sanitize_package_name(raw_input)
+                ),
+            )
+            targets = list(scheduler.order(targets, action="Enqueue", **flags))
+            cost = scheduler.estimates.get
+        added = work_queue.put(targets, cost)
+        if verbose and not output_json:
+            print(f"-> Added {added} packages to {queue_path}")
+            print(f"Queue {queue_path}: {work_queue.summary()}")
+        work_queue.close()
+        return
 
-    # Fire!
-    scan_errors = 0
-    for raw_input in targets:
-        scan_list = []
-        package_meta = {}
+    # A daemon's targets are whatever its clients send, see audit_daemon.
+    # Imported here so other runs don't pay for the http modules.
+    daemon = None
+    if serve:
+        from audit_daemon import Audit_Daemon, Daemon_Error
 
-        if verbose and not output_json:
-            print(f"-> Using pip to download {raw_input}")
-        if debug:
-            pprint(raw_input)
-        output = _pip_download(
-            raw_input=raw_input,
-            output_dir=output_dir,
-            verbose=verbose,
-            debug=debug,
-            output_json=output_json,
+        daemon = Audit_Daemon(serve, verbose and not output_json, debug)
+        targets = daemon.targets()
+
+    journal = Run_Journal(journal_path) if journal_path else None
+    if journal:
+        targets = _journaled_targets(targets, journal, resume, max_attempts, **flags)
+
+    store = Archive_Store(store_dir, store_max_bytes) if store_dir else None
+    fetcher = Package_Fetcher(index_url, store=store)
+    # Looking a package up for its size leaves the entry with the fetcher
+    # for the download stage
+    scheduler = None
+    if largest_first:
+        scheduler = Size_Scheduler(
+            scan_workers,
+            schedule_window,
+            journal,
+            lambda raw_input: fetcher.lookahead(_sanitize_package_name(raw_input)),
         )
+        targets = scheduler.order(targets, **flags)
+    if journal:
+        targets = _started_in_journal(targets, journal)
 
-        if verbose and not output_json:
-            print("-> Extracting archives and meta")
-        if debug:
-            pprint(output)
-        if output:
-            parsed_raw_dir_list, package_meta = _extract_archives(
-                output=output,
-                output_dir=output_dir,
-                package_meta=package_meta,
-                verbose=verbose,
-                debug=debug,
-                output_json=output_json,
-            )
+    all_plugins, plugin_objects = _load_plugins(**flags)
+    runner = Plugin_Runner(plugin_objects, max_batch=scan_workers)
 
-            if verbose and not output_json:
-                print("-> Parsing out the scan list")
-            if debug:
-                pprint(parsed_raw_dir_list)
-            if parsed_raw_dir_list:
-                scan_list, package_meta = _retrieve_directories_to_scan(
-                    parsed_raw_dir_list=parsed_raw_dir_list,
-                    package_meta=package_meta,
-                    verbose=verbose,
-                    debug=debug,
-                    output_json=output_json,
-                )
+    # Download, extract, scan and clean up run as separate stages joined by
+    # bounded queues, so the network, the disk and the scanners stay busy at
+    # the same time.
+    stream_root = (stream_tmp or _default_stream_root()) if stream else None
+    stream_tree = any(
+        getattr(plugin.plugin_object, "needs_filesystem", True)
+        for plugin in all_plugins
+    )
+    # Packages are worked on in throwaway directories dropped in one go,
+    # unless their files are meant to stay in the output directory.
+    scratch = None
+    if not save_files:
+        scratch = Scratch_Space(
+            scratch_root or os.path.join(output_dir, ".scratch"), scratch_max_bytes
+        )
+    # What a single package may expand to, see archive_members
+    limits = dict(
+        max_member_bytes=max_member_bytes,
+        max_package_bytes=max_package_bytes,
+        max_members=max_members,
+    )
+    cache = Scan_Cache(cache_path, cache_max_bytes) if cache_path else None
+    results = Results_Store(results_path) if results_path else None
+    stages = [
+        (
+            lambda job: _download_stage(
+                job, fetcher, cache, all_plugins, results, scratch, **flags
+            ),
+            download_workers,
+            False,
+        ),
+        (
+            lambda job: _extract_stage(
+                job,
+                stream_root,
+                stream_tree,
+                scratch,
+                limits,
+                incremental,
+                **flags,
+            ),
+            extract_workers,
+            False,
+        ),
+        (
+            lambda job: _scan_stage(
+                job,
+                all_plugins,
+                stream_root,
+                cache,
+                results,
+                scratch,
+                incremental,
+                runner,
+                limits,
+                **flags,
+            ),
+            scan_workers,
+            False,
+        ),
+        (lambda job: _cleanup_stage(job, scratch, **flags), 1, True),
+    ]
 
-                if scan_list and package_meta:
-                    responses = []
-                    for plugin in all_plugins:
-                        responses.append(
-                            plugin.plugin_object.scan(
-                                scan_list,
-                                package_meta,
-                                output_dir,
-                                verbose,
-                                debug,
-                                output_json,
-                            )
-                        )
-                    scan_errors += sum(responses)
-                    if debug:
-                        pprint(responses)
-                    # @TODO add package cleanup routine
-                    # package_meta["saved_file_name"]
-                    if not save_files and package_meta:
-                        if verbose and not output_json:
-                            print("-> Cleaning up downloaded files")
-                        if debug:
-                            pprint(package_meta)
-                        _clean_up_downloads(
-                            package_meta, output_dir, verbose, debug, output_json
-                        )
+    # With --prefetch the download stage runs on the asyncio prefetcher
+    # instead, which keeps the next few archives downloading in order ahead
+    # of the (synchronous) extract and scan stages.
+    source = None
+    if prefetch:
+        archive_prefetcher = Prefetcher(
+            fetcher, prefetch, prefetch_max_bytes, per_host_connections, retries
+        )
+        source = lambda jobs: archive_prefetcher.run(
+            jobs,
+            lambda job, fetcher: _download_stage(
+                job, fetcher, cache, all_plugins, results, scratch, **flags
+            ),
+        )
+        stages = stages[1:]
 
-        else:
-            if verbose and not output_json:
-                print(f"! Pip download failed for {raw_input}")
-            scan_errors += 1
+    # Plugins are loaded and everything is set up, time to take requests.
+    # Stopping the daemon lets the pipeline finish what it has first.
+    if daemon:
+        try:
+            daemon.start([plugin.name for plugin in all_plugins])
+        except (OSError, Daemon_Error) as e:
+            raise click.ClickException(f"can't serve on {serve}: {e}")
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, lambda signum, frame: daemon.stop())
+        if verbose and not output_json:
+            print(f"-> Serving audits on {serve}")
+
+    # Fire!
+    scan_errors = 0
+    unflushed = []
+    metrics = Run_Metrics()
+    metrics_written = time.time()
+    # Whatever a worker still has leased when the run is cut short goes
+    # back to the queue right away
+    try:
+        for job in _run_pipeline(
+            targets, stages, output_dir, queue_size, bool(profile_dir), source
+        ):
+            scan_errors += job["scan_errors"]
+            metrics.add_job(job)
+            if scheduler:
+                scheduler.finished(job)
+                metrics.predicted_seconds = scheduler.predicted_seconds()
+            _save_profile(job, profile_dir, profile_threshold)
+            if time.time() - metrics_written >= metrics_interval:
+                metrics.write(metrics_json, metrics_textfile)
+                metrics_written = time.time()
+            unflushed.append(job)
+            # Findings are written in batches, a package only counts as done in
+            # the journal once its findings are safely in the results store.  A
+            # daemon's client is answered once they are.
+            if results:
+                if not (daemon or results.due()):
+                    continue
+                results.flush()
+            _finish_in_journal(journal, unflushed)
+            _ack_in_queue(worker, unflushed)
+            if daemon:
+                daemon.finished(job)
+            unflushed = []
+        if daemon:
+            daemon.close()
+        if results:
+            results.close()
+        _finish_in_journal(journal, unflushed)
+        _ack_in_queue(worker, unflushed)
+    finally:
+        if worker:
+            worker.close()
+    if cache:
+        cache.close()
+    if store:
+        store.close()
+    if scratch:
+        scratch.close()
+    runner.close()
+    for plugin_object in plugin_objects.values():
+        plugin_object.teardown()
+    metrics.write(metrics_json, metrics_textfile)
     if verbose and not output_json:
+        for stage, histogram in list(metrics.stages.items()) + sorted(
+            metrics.plugins.items()
+        ):
+            if histogram.count:
+                summary = histogram.summary()
+                print(
+                    f"-> {stage}: {summary['count']} runs, p50 {summary['p50']:.3f}s, p95 {summary['p95']:.3f}s, max {summary['max']:.3f}s"
+                )
         print(f"Scan complete! {scan_errors} errors.")
+        if journal:
+            print(f"Journal {journal_path}: {journal.summary()}")
+        if work_queue:
+            print(f"Queue {queue_path}: {work_queue.summary()}")
+    if journal:
+        journal.close()
+    if work_queue:
+        work_queue.close()
 
 
 if __name__ == "__main__":
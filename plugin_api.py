@@ -0,0 +1,281 @@
+"""Version 2 of the scan plugin interface.
+
+The original interface is a yapsy IPlugin with a
+`scan(scan_list, package_meta, output_dir, verbose, debug, output_json,
+**kwargs)` method, called once per package for one plugin after another.
+Plugins written against version 2 subclass Scan_Plugin instead and get:
+
+  * setup() and teardown(), called once per run around all of its scans,
+    for loading rules, starting process pools and the like;
+  * scan_batch(requests), which is handed up to batch_size packages at once
+    (out of those being scanned at the same time) and returns the error
+    count of each.  Plugins that scan one package at a time override
+    scan_request(request) instead, plugins that override neither are
+    refused;
+  * resource_class, one of CPU_BOUND, IO_BOUND or SUBPROCESS, deciding which
+    of the runner's executors the plugin's scans go to.  A package's plugins
+    run side by side, each class with its own limit, so a network bound
+    plugin never waits behind a CPU bound one and CPU bound ones don't
+    oversubscribe the cores.
+
+A request is a dict holding what the old scan() was given: scan_list,
+package_meta, output_dir, verbose, debug, output_json, report_dir, members,
+record_findings and only_files.  Old style plugins keep working through
+Legacy_Plugin_Adapter, which looks like any other version 2 plugin to the
+pipeline.
+
+@author u/gatewaynode
+@website https://reddit.com/r/pipsecurity
+"""
+
+import os
+import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from yapsy.IPlugin import IPlugin
+
+API_VERSION = 2
+
+CPU_BOUND = "cpu"
+IO_BOUND = "io"
+SUBPROCESS = "subprocess"
+
+# Longest a batch capable plugin's first package waits for more to fill a
+# batch
+DEFAULT_BATCH_WAIT = 0.05
+
+# What scan() got as keyword arguments on top of the positional ones
+REQUEST_KWARGS = ("report_dir", "members", "record_findings", "only_files")
+
+
+def scan_request(
+    scan_list,
+    package_meta,
+    output_dir,
+    verbose=False,
+    debug=False,
+    output_json=False,
+    **kwargs,
+):
+    request = {
+        "scan_list": scan_list,
+        "package_meta": package_meta,
+        "output_dir": output_dir,
+        "verbose": verbose,
+        "debug": debug,
+        "output_json": output_json,
+    }
+    for key in REQUEST_KWARGS:
+        request[key] = kwargs.get(key)
+    return request
+
+
+def default_workers():
+    # Concurrent scans per resource class
+    cpus = os.cpu_count() or 1
+    return {CPU_BOUND: cpus, IO_BOUND: 4 * cpus, SUBPROCESS: cpus}
+
+
+def _overrides(plugin, method):
+    return getattr(type(plugin), method) is not getattr(Scan_Plugin, method)
+
+
+def _check_plugin(name, plugin):
+    # A version 2 plugin has to scan somehow.  Plugins overriding scan_batch
+    # don't need scan_request, so one that overrides neither is refused here,
+    # by both Plugin_Runner and scan(), instead of the default scan_request
+    # quietly answering None for every package.
+    if (
+        isinstance(plugin, Scan_Plugin)
+        and not _overrides(plugin, "scan_batch")
+        and not _overrides(plugin, "scan_request")
+    ):
+        raise TypeError(
+            f"scan plugin {name} overrides neither scan_batch nor scan_request"
+        )
+
+
+class Scan_Plugin(IPlugin):
+    api_version = API_VERSION
+    resource_class = CPU_BOUND
+    batch_size = 1
+    needs_filesystem = True
+    incremental = False
+
+    def setup(self):
+        pass
+
+    def teardown(self):
+        pass
+
+    def scan_batch(self, requests):
+        return [self.scan_request(request) for request in requests]
+
+    def scan_request(self, request):
+        """Scans the package of one request, returns its error count.
+
+        Called by the default scan_batch() for each request in turn, so only
+        plugins that override scan_batch() can leave it out.
+        """
+
+    def scan(
+        self,
+        scan_list=[],
+        package_meta={},
+        output_dir="",
+        verbose=False,
+        debug=False,
+        output_json=False,
+        **kwargs,
+    ):
+        # Old style entry point, for callers that still use version 1
+        _check_plugin(type(self).__name__, self)
+        if not self.is_activated:
+            self.activate()
+            self.setup()
+        request = scan_request(
+            scan_list, package_meta, output_dir, verbose, debug, output_json, **kwargs
+        )
+        return self.scan_batch([request])[0]
+
+
+class Legacy_Plugin_Adapter:
+    api_version = API_VERSION
+    batch_size = 1
+
+    def __init__(self, plugin):
+        self.plugin = plugin
+        self.resource_class = getattr(plugin, "resource_class", CPU_BOUND)
+        self.needs_filesystem = getattr(plugin, "needs_filesystem", True)
+        self.incremental = getattr(plugin, "incremental", False)
+
+    def setup(self):
+        pass  # yapsy's activate() is where these do their setup
+
+    def teardown(self):
+        pass
+
+    def scan_batch(self, requests):
+        return [
+            self.plugin.scan(
+                request["scan_list"],
+                request["package_meta"],
+                request["output_dir"],
+                request["verbose"],
+                request["debug"],
+                request["output_json"],
+                **{key: request[key] for key in REQUEST_KWARGS},
+            )
+            for request in requests
+        ]
+
+
+def adapt(plugin_object):
+    if getattr(plugin_object, "api_version", 1) >= API_VERSION:
+        return plugin_object
+    return Legacy_Plugin_Adapter(plugin_object)
+
+
+class _Batcher:
+    # Gathers the requests scan workers make of one batch capable plugin.  A
+    # batch goes to the executor as soon as it is full, or once its first
+    # request has waited `wait` seconds, so nothing sits on an executor
+    # thread while waiting for company.
+    def __init__(self, plugin, batch_size, wait, submit):
+        self.plugin = plugin
+        self.batch_size = batch_size
+        self.wait = wait
+        self._submit = submit
+        self._lock = threading.Lock()
+        self._pending = []
+        self._generation = 0
+
+    def add(self, request, done, future):
+        with self._lock:
+            self._pending.append((request, done, future))
+            if len(self._pending) >= self.batch_size:
+                batch = self._take()
+            else:
+                batch = None
+                if len(self._pending) == 1:
+                    timer = threading.Timer(
+                        self.wait, self._expire, (self._generation,)
+                    )
+                    timer.daemon = True
+                    timer.start()
+        if batch:
+            self._submit(self._run, batch)
+
+    def _take(self):
+        batch, self._pending = self._pending, []
+        self._generation += 1
+        return batch
+
+    def _expire(self, generation):
+        with self._lock:
+            batch = self._take() if generation == self._generation else None
+        if batch:
+            self._submit(self._run, batch)
+
+    def _run(self, batch):
+        started = time.perf_counter()
+        try:
+            responses = self.plugin.scan_batch([request for request, _, _ in batch])
+        except Exception as e:
+            for _, _, future in batch:
+                future.set_exception(e)
+            return
+        # Each package is charged its share of the batch
+        seconds = (time.perf_counter() - started) / len(batch)
+        for (_, done, future), response in zip(batch, responses):
+            try:
+                future.set_result(done(response, seconds))
+            except Exception as e:
+                future.set_exception(e)
+
+
+def _scan_one(plugin, request, done):
+    started = time.perf_counter()
+    response = plugin.scan_batch([request])[0]
+    return done(response, time.perf_counter() - started)
+
+
+class Plugin_Runner:
+    def __init__(self, plugins, workers=None, max_batch=1, batch_wait=None):
+        # plugins is {name: version 2 plugin}.  max_batch caps batches at the
+        # number of packages that can be in the scan stage at once.
+        workers = workers or default_workers()
+        batch_wait = DEFAULT_BATCH_WAIT if batch_wait is None else batch_wait
+        self._executors = {
+            resource_class: ThreadPoolExecutor(
+                max_workers=count, thread_name_prefix=f"plugins-{resource_class}"
+            )
+            for resource_class, count in workers.items()
+        }
+        self._plugins = plugins
+        self._batchers = {}
+        for name, plugin in plugins.items():
+            _check_plugin(name, plugin)
+            batch_size = min(plugin.batch_size, max_batch)
+            if batch_size > 1:
+                self._batchers[name] = _Batcher(
+                    plugin, batch_size, batch_wait, self._executor(plugin).submit
+                )
+
+    def _executor(self, plugin):
+        return self._executors.get(plugin.resource_class) or self._executors[CPU_BOUND]
+
+    def submit(self, name, request, done=None):
+        # Future of done(response, seconds), the caller's bookkeeping for the
+        # plugin's answer, or of just the response
+        done = done or (lambda response, seconds: response)
+        if name in self._batchers:
+            future = Future()
+            self._batchers[name].add(request, done, future)
+            return future
+        plugin = self._plugins[name]
+        return self._executor(plugin).submit(_scan_one, plugin, request, done)
+
+    def close(self):
+        for executor in self._executors.values():
+            executor.shutdown()
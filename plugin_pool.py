@@ -0,0 +1,43 @@
+"""Process pools for scan plugins, safe to start in the middle of a run.
+
+By the time a plugin wants a pool the run has pipeline stage threads, plugin
+executors and timers going.  A pool forked from that can inherit a lock
+(logging's, the import lock) another thread was holding and hang on it, so
+plugin pools start their processes from a forkserver instead, which is
+started clean and has no threads of its own.
+
+Those processes don't inherit the plugin: yapsy loads plugin modules under
+made up names (yapsy_loaded_plugin_...) nothing can import.  Each pool
+process loads the plugin's file again under the same name before running
+its initializer, so the functions handed to the pool unpickle there.
+
+@author u/gatewaynode
+@website https://reddit.com/r/pipsecurity
+"""
+
+import sys
+import importlib.util
+import multiprocessing
+
+START_METHOD = "forkserver"
+
+
+def _load_plugin_module(name, path, initializer):
+    # Runs first thing in every pool process
+    if name not in sys.modules:
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+    getattr(sys.modules[name], initializer)()
+
+
+def plugin_pool(processes, initializer):
+    # A multiprocessing.Pool of processes running initializer, a module level
+    # function of the plugin, once each
+    module = sys.modules[initializer.__module__]
+    return multiprocessing.get_context(START_METHOD).Pool(
+        processes,
+        initializer=_load_plugin_module,
+        initargs=(module.__name__, module.__file__, initializer.__name__),
+    )
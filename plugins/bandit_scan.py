@@ -1,10 +1,254 @@
-import subprocess
+import os
+import re
+import ast
 import logging
+import threading
 import traceback
 from yapsy.IPlugin import IPlugin
+from prefilter import Prefilter, enabled as prefilter_enabled
+from plugin_pool import plugin_pool
+from bandit.core import config as b_config
+from bandit.core import constants as b_constants
+from bandit.core import manager as b_manager
+from bandit.core import meta_ast as b_meta_ast
+from bandit.core import metrics as b_metrics
+from bandit.plugins.general_hardcoded_password import RE_WORDS
+
+# Context lines per issue, same as the bandit CLI default
+CONTEXT_LINES = 3
+
+# Packages are scanned in a process pool of PIP_AUDIT_BANDIT_PROCESSES
+# processes (the CPU count by default, 1 scans in the worker thread).  Ones
+# with at least this many python files are split over it, smaller ones go to
+# one process whole, they are not worth pickling in pieces.
+POOL_MIN_FILES = 64
+
+_pool_manager = None
+
+# What each of bandit's tests looks for in the source, a file with none of
+# it can't give the test anything to report.  Names are what tests compare
+# qualnames and the like with, patterns what they look for inside of them.
+_NAMES = {
+    "B101": ["assert"],
+    "B102": ["exec"],
+    "B110": ["except"],
+    "B112": ["except"],
+    "B504": ["ssl"],
+    "B505": ["cryptography", "Crypto", "Cryptodome"],
+    "B604": ["shell"],
+    "B610": ["extra"],
+}
+_PATTERNS = {
+    "B103": ["chmod"],
+    "B106": [re.compile(RE_WORDS, re.IGNORECASE)],
+    "B107": [re.compile(RE_WORDS, re.IGNORECASE)],
+    "B201": ["flask"],
+    "B324": ["hashlib"],
+    "B501": ["requests"],
+    "B506": ["yaml"],
+    "B507": ["set_missing_host_key_policy"],
+    "B601": ["exec_command"],
+    "B611": ["RawSQL"],
+    "B701": ["jinja2"],
+    "B702": ["mako"],
+    "B703": ["safestring"],
+}
+
+# Tests whose names come from their config, the first part of each of the
+# qualnames they match
+_CONFIG_NAMES = {
+    "B001": lambda config: [
+        qualname
+        for checks in config.values()
+        for check in checks
+        for qualname in check["qualnames"]
+    ],
+    "B502": lambda config: config["bad_protocol_versions"],
+    "B503": lambda config: config["bad_protocol_versions"],
+    **{
+        test_id: lambda config: [name for names in config.values() for name in names]
+        for test_id in ("B602", "B603", "B605", "B606", "B607", "B609")
+    },
+}
+
+# Before Python 3.8 string literals are Str nodes, and bandit's Str tests
+# match string values the prefilter can't see without the visitor
+_STR_NODES = type(ast.parse("''").body[0].value).__name__ == "Str"
+
+
+def _new_prefilter(test_set):
+    # None when prefiltering is off or a loaded test has no known markers
+    if not prefilter_enabled() or (_STR_NODES and test_set.get_tests("Str")):
+        return None
+    # A coding cookie can make the source something else than its bytes
+    patterns = [r"coding[:=]"]
+    names = []
+    try:
+        for check, tests in test_set.tests.items():
+            if check == "Str":
+                continue  # Never called, literals are Constant nodes
+            for test in tests:
+                test_id = test._test_id
+                if test_id in _CONFIG_NAMES:
+                    for name in _CONFIG_NAMES[test_id](test._config):
+                        names.append(name.split(".")[0])
+                elif test_id in _NAMES or test_id in _PATTERNS:
+                    names.extend(_NAMES.get(test_id, []))
+                    patterns.extend(_PATTERNS.get(test_id, []))
+                else:
+                    return None
+        if not all(name.isidentifier() for name in names):
+            return None
+        return Prefilter(list(dict.fromkeys(patterns)), names)
+    except (ValueError, KeyError, AttributeError, TypeError):
+        return None
+
+
+def _clean_score():
+    return {
+        "SEVERITY": [0] * len(b_constants.RANKING),
+        "CONFIDENCE": [0] * len(b_constants.RANKING),
+    }
+
+
+class _Prefiltered_Manager(b_manager.BanditManager):
+    # Files without a marker of any loaded test are still parsed, so syntax
+    # errors are skipped as before, but not walked by the test visitor.
+    # String literals are checked too, escapes and implicit concatenation
+    # can hide a name from the raw source.  Files with nosec comments are
+    # always visited, the visitor counts the nodes it skips for the metrics.
+    prefilter = None
+    prefiltered = 0
+
+    def _execute_ast_visitor(self, fname, data, nosec_lines):
+        if self.prefilter is None or nosec_lines or self.prefilter.search(data):
+            return super()._execute_ast_visitor(fname, data, nosec_lines)
+        for node in ast.walk(ast.parse(data)):
+            value = node.value if isinstance(node, ast.Constant) else None
+            if isinstance(value, str):
+                value = value.encode("utf-8", "surrogatepass")
+            if isinstance(value, bytes) and self.prefilter.search(value):
+                return super()._execute_ast_visitor(fname, data, nosec_lines)
+        self.prefiltered += 1
+        return _clean_score()
+
+
+def _new_manager():
+    # Building the config and test set is what makes `bandit` slow to start,
+    # so each thread/process builds a manager once and keeps reusing it.
+    manager = _Prefiltered_Manager(b_config.BanditConfig(), "file", quiet=True)
+    manager.prefilter = _new_prefilter(manager.b_ts)
+    return manager
+
+
+def _reset_manager(manager):
+    manager.files_list = []
+    manager.excluded_files = []
+    manager.skipped = []
+    manager.results = []
+    manager.baseline = []
+    manager.scores = []
+    manager.metrics = b_metrics.Metrics()
+    manager.b_ma = b_meta_ast.BanditMetaAst()
+    manager.prefiltered = 0
+    return manager
+
+
+def _finding(issue, output_dir):
+    # Results store row for a bandit issue, see results_store.Results_Store.
+    # Paths are kept relative to the package, not the scratch directory.
+    details = issue.as_dict(with_code=False)
+    details["filename"] = os.path.relpath(issue.fname, output_dir)
+    return {
+        "severity": issue.severity,
+        "confidence": issue.confidence,
+        "file": details["filename"],
+        "line": issue.lineno,
+        "rule": issue.test_id,
+        "message": issue.text,
+        "details": details,
+    }
+
+
+def _init_pool_worker():
+    global _pool_manager
+    _pool_manager = _new_manager()
+
+
+def _scan_files(files):
+    # Runs in a pool worker, hands back everything output_results needs
+    manager = _reset_manager(_pool_manager)
+    manager.files_list = list(files)
+    manager.run_tests()
+    return (
+        manager.files_list,
+        manager.skipped,
+        manager.results,
+        manager.scores,
+        {
+            name: data
+            for name, data in manager.metrics.data.items()
+            if name != "_totals"
+        },
+    )
 
 
 class Bsndit_Scanner(IPlugin):
+    # Issues are per file, so a release can be scanned for its changed files
+    incremental = True
+
+    def activate(self):
+        super().activate()
+        self._local = threading.local()
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self.processes = int(
+            os.environ.get("PIP_AUDIT_BANDIT_PROCESSES") or os.cpu_count() or 1
+        )
+
+    def deactivate(self):
+        if self._pool:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+        super().deactivate()
+
+    def _manager(self):
+        # BanditManager keeps per-run state, so one per scan worker thread
+        manager = getattr(self._local, "manager", None)
+        if manager is None:
+            manager = self._local.manager = _new_manager()
+        return _reset_manager(manager)
+
+    def _process_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = plugin_pool(self.processes, _init_pool_worker)
+            return self._pool
+
+    def _run_tests(self, manager):
+        files = manager.files_list
+        if self.processes <= 1 or not files:
+            manager.run_tests()
+            return
+
+        if len(files) < POOL_MIN_FILES:
+            chunk_size = len(files)
+        else:
+            chunk_size = -(-len(files) // (self.processes * 4))
+        chunks = [files[i : i + chunk_size] for i in range(0, len(files), chunk_size)]
+        files_list = []
+        for scanned, skipped, results, scores, metrics in self._process_pool().map(
+            _scan_files, chunks
+        ):
+            files_list.extend(scanned)
+            manager.skipped.extend(skipped)
+            manager.results.extend(results)
+            manager.scores.extend(scores)
+            manager.metrics.data.update(metrics)
+        manager.files_list = files_list
+        manager.metrics.aggregate()
+
     def scan(
         self,
         scan_list=[],
@@ -15,37 +259,51 @@ class Bsndit_Scanner(IPlugin):
         output_json=False,
         **kwargs
     ):
+        if not self.is_activated:
+            self.activate()
+
         scan_errors = 0
+        report_dir = kwargs.get("report_dir") or output_dir
+        record_findings = kwargs.get("record_findings")
+        only_files = kwargs.get("only_files")
         if scan_list:
             if verbose and not output_json:
                 print(
-                    f"-> Running bandit against files {', '.join(scan_list)}. Output saved to {output_dir}."
+                    f"-> Running bandit against files {', '.join(scan_list)}. Output saved to {report_dir}."
                 )
             for target in scan_list:
-                if output_json:
-                    bandit_scan = [
-                        "bandit",
-                        "-r",
-                        "-q",
-                        "-f",
-                        "json",
-                        "-o",
-                        f"{output_dir}/bandit_scan_{target}.json",
-                        f"{output_dir}/{target}",
-                    ]
-                else:
-                    bandit_scan = [
-                        "bandit",
-                        "-r",
-                        "-q",
-                        "-f",
-                        "txt",
-                        "-o",
-                        f"{output_dir}/bandit_scan_{target}.txt",
-                        f"{output_dir}/{target}",
-                    ]
+                output_format = "json" if output_json else "txt"
                 try:
-                    subprocess.run(bandit_scan)
+                    manager = self._manager()
+                    manager.discover_files([f"{output_dir}/{target}"], recursive=True)
+                    if only_files is not None:
+                        manager.files_list = [
+                            name
+                            for name in manager.files_list
+                            if os.path.relpath(name, output_dir) in only_files
+                        ]
+                    self._run_tests(manager)
+                    if record_findings:
+                        record_findings(
+                            target,
+                            [
+                                _finding(issue, output_dir)
+                                for issue in manager.get_issue_list(
+                                    b_constants.LOW, b_constants.LOW
+                                )
+                            ],
+                        )
+                        continue
+                    with open(
+                        f"{report_dir}/bandit_scan_{target}.{output_format}", "w"
+                    ) as report:
+                        manager.output_results(
+                            CONTEXT_LINES,
+                            b_constants.LOW,
+                            b_constants.LOW,
+                            report,
+                            output_format,
+                        )
                 except Exception as e:
                     logging.error(traceback.format_exc())
                     scan_errors += 1
@@ -1,53 +1,316 @@
-import subprocess
+import os
+import re
+import json
 import logging
+import threading
 import traceback
+from time import gmtime, strftime
 from pprint import pprint
-from yapsy.IPlugin import IPlugin
-
-
-class Detect_Secrets_Scanner(IPlugin):
-    def scan(
-        self,
-        scan_list=[],
-        package_meta={},
-        output_dir="",
-        verbose=False,
-        debug=False,
-        output_json=False,
-        **kwargs
-    ):
-        scan_errors = 0
-        if scan_list:
-            if verbose and not output_json:
+import plugin_api  # Not `from`, yapsy would take Scan_Plugin for the plugin
+from prefilter import Prefilter, enabled as prefilter_enabled
+from plugin_pool import plugin_pool
+from detect_secrets.core.secrets_collection import SecretsCollection
+from detect_secrets.core.usage import ParserBuilder
+from detect_secrets.plugins.common import initialize
+from detect_secrets.plugins.high_entropy_strings import (
+    HighEntropyStringsPlugin,
+    YAML_EXTENSIONS,
+)
+from detect_secrets.plugins.keyword import KeywordDetector, DENYLIST as KEYWORDS
+
+# Batches with at least this many files are split over the process pool
+# (when PIP_AUDIT_DETECT_SECRETS_PROCESSES is above 1).
+POOL_MIN_FILES = 64
+
+# Packages scanned together at most, so small ones can share the pool
+BATCH_SIZE = 16
+
+_pool_plugins = None
+
+
+def _default_plugins():
+    # Same plugin set and settings `detect-secrets scan` uses by default
+    args = ParserBuilder().add_console_use_arguments().parse_args(["scan"])
+    return initialize.from_parser_builder(args.plugins)
+
+
+def _new_prefilter(plugins):
+    # None when prefiltering is off or a plugin isn't one the prefilter knows
+    # the findings of.  YAML files are always scanned, the YAML parser can
+    # make strings out of anything.
+    if not prefilter_enabled():
+        return None
+    # configparser's interpolation can put values together out of pieces
+    patterns = [re.escape("%(")]
+    try:
+        for plugin in plugins:
+            if isinstance(plugin, HighEntropyStringsPlugin):
+                # Entropy is at most log2 of a string's length, so it takes
+                # more than 2**limit characters to get over the limit
+                run = int(2**plugin.entropy_limit) + 1
+                patterns.append(f"[{plugin.charset}]{{{run},}}")
+            elif isinstance(plugin, KeywordDetector):
+                patterns.extend(
+                    re.compile(re.escape(keyword), re.IGNORECASE)
+                    for keyword in KEYWORDS
+                )
+            elif getattr(plugin, "denylist", None) is not None:
+                patterns.extend(plugin.denylist)
+            else:
+                return None
+        return Prefilter(patterns)
+    except ValueError:
+        return None
+
+
+def _scan_files(files, plugins=None):
+    # Yields (filename, sorted secrets) for files with findings, one file at a
+    # time so a package with huge data files never sits in memory at once.
+    for filename in files:
+        collection = SecretsCollection(plugins or _pool_plugins)
+        collection.scan_file(filename)
+        for secrets in collection.json().values():
+            yield filename, sorted(
+                secrets, key=lambda x: (x["line_number"], x["hashed_secret"])
+            )
+
+
+def _scan_files_in_worker(files):
+    return list(_scan_files(files))
+
+
+def _finding(filename, secret, output_dir):
+    # Results store row for a potential secret, detect-secrets has no severity
+    return {
+        "file": os.path.relpath(filename, output_dir),
+        "line": secret["line_number"],
+        "rule": secret["type"],
+        "message": f"Potential secret: {secret['type']}",
+        "details": secret,
+    }
+
+
+def _init_pool_worker():
+    global _pool_plugins
+    _pool_plugins = _default_plugins()
+
+
+class _Batch_Failed(Exception):
+    pass
+
+
+class _Batch_Findings:
+    # Hands a batch's findings, which come out in the order the files went
+    # in, to the packages they are from, one package after another as the
+    # scanner gets to them.
+    def __init__(self, targets, findings):
+        self._files = (
+            (position, name)
+            for position, (_, _, names) in enumerate(targets)
+            for name in names
+        )
+        self._findings = iter(findings)
+        self._ahead = None
+        self._done = False
+        self.failed = False
+
+    def _next(self):
+        try:
+            filename, secrets = next(self._findings)
+        except StopIteration:
+            return None
+        except Exception:
+            logging.error(traceback.format_exc())
+            self.failed = True
+            raise _Batch_Failed()
+        for position, name in self._files:
+            if name == filename:
+                return position, filename, secrets
+        return None
+
+    def package(self, position):
+        # Findings of the package at position, skipping what an earlier
+        # package's report left unread.  Raises _Batch_Failed once the pass
+        # has failed, whether in this package or reading ahead into the next.
+        while True:
+            if self.failed:
+                raise _Batch_Failed()
+            if self._ahead is None:
+                if self._done:
+                    return
+                self._ahead = self._next()
+                if self._ahead is None:
+                    self._done = True
+                    return
+            owner, filename, secrets = self._ahead
+            if owner > position:
+                return
+            self._ahead = None
+            if owner == position:
+                yield filename, secrets
+
+
+def _indent(text, spaces):
+    return text.replace("\n", "\n" + " " * spaces)
+
+
+class Detect_Secrets_Scanner(plugin_api.Scan_Plugin):
+    resource_class = plugin_api.CPU_BOUND
+    batch_size = BATCH_SIZE
+    # Secrets are found per file, so a release can be scanned for its changed
+    # files
+    incremental = True
+
+    def setup(self):
+        self.plugins = _default_plugins()
+        self.prefilter = _new_prefilter(self.plugins)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self.processes = int(os.environ.get("PIP_AUDIT_DETECT_SECRETS_PROCESSES", "1"))
+
+    def teardown(self):
+        if self._pool:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def _process_pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = plugin_pool(self.processes, _init_pool_worker)
+            return self._pool
+
+    def _candidate(self, filename):
+        # Links are left to the scanner, which skips them
+        return (
+            self.prefilter is None
+            or os.path.islink(filename)
+            or os.path.splitext(filename)[1] in YAML_EXTENSIONS
+            or self.prefilter.candidate(filename)
+        )
+
+    def _findings(self, files):
+        # Reports only list files with findings, so leaving out files that
+        # can't have any doesn't change them
+        files = [filename for filename in files if self._candidate(filename)]
+        if self.processes <= 1 or len(files) < POOL_MIN_FILES:
+            for finding in _scan_files(files, self.plugins):
+                yield finding
+            return
+
+        # imap keeps file order, so the report comes out sorted as it streams
+        chunk_size = -(-len(files) // (self.processes * 4))
+        chunks = [files[i : i + chunk_size] for i in range(0, len(files), chunk_size)]
+        for findings in self._process_pool().imap(_scan_files_in_worker, chunks):
+            for finding in findings:
+                yield finding
+
+    def _write_report(self, report, findings):
+        # Writes the same document `detect-secrets scan` prints, one file's
+        # results at a time instead of building the whole thing in memory.
+        separators = (",", ": ")
+        header = json.dumps(
+            {
+                "exclude": {"files": None, "lines": None},
+                "generated_at": strftime("%Y-%m-%dT%H:%M:%SZ", gmtime()),
+                "plugins_used": sorted(
+                    (plugin.__dict__ for plugin in self.plugins),
+                    key=lambda x: x["name"],
+                ),
+            },
+            indent=2,
+            sort_keys=True,
+            separators=separators,
+        )
+        report.write(header[: -len("\n}")] + ',\n  "results": {')
+        written = 0
+        for filename, secrets in findings:
+            report.write("," if written else "")
+            report.write(f"\n    {json.dumps(filename)}: ")
+            report.write(
+                _indent(
+                    json.dumps(
+                        secrets, indent=2, sort_keys=True, separators=separators
+                    ),
+                    4,
+                )
+            )
+            written += 1
+        report.write("\n  }" if written else "}")
+        report.write(f',\n  "version": {json.dumps(SecretsCollection().version)}\n}}\n')
+
+    def _files(self, request, target):
+        # Same walk as `detect-secrets scan --all-files`
+        files = sorted(
+            os.path.join(root, filename)
+            for root, dirs, filenames in os.walk(f"{request['output_dir']}/{target}")
+            for filename in filenames
+        )
+        if request["only_files"] is not None:
+            files = [
+                name
+                for name in files
+                if os.path.relpath(name, request["output_dir"]) in request["only_files"]
+            ]
+        return files
+
+    def _report(self, request, target, found):
+        report_dir = request["report_dir"] or request["output_dir"]
+        if request["debug"]:
+            print("Trying to write to:")
+            pprint(f"{report_dir}/detect_secrets_{target}.json")
+        if request["record_findings"]:
+            # Recorded once all of them are in, so a package scanned again
+            # after a failed pass isn't recorded twice
+            request["record_findings"](
+                target,
+                [
+                    _finding(filename, secret, request["output_dir"])
+                    for filename, secrets in found
+                    for secret in secrets
+                ],
+            )
+            return
+        with open(f"{report_dir}/detect_secrets_{target}.json", "w") as file:
+            self._write_report(file, found)
+
+    def scan_batch(self, requests):
+        # A batch of small packages is scanned as one, big enough for the
+        # process pool
+        scan_errors = [0] * len(requests)
+        targets = []
+        for index, request in enumerate(requests):
+            if not request["scan_list"]:
+                scan_errors[index] += 1
+                continue
+            if request["verbose"] and not request["output_json"]:
                 print(
-                    f"-> Running detect-secrets against package dirs {', '.join(scan_list)}.  Output saved to {output_dir}."
+                    f"-> Running detect-secrets against package dirs {', '.join(request['scan_list'])}.  Output saved to {request['report_dir'] or request['output_dir']}."
                 )
-            for target in scan_list:
-                detect_secrets_scan = [
-                    "detect-secrets",
-                    "scan",
-                    "--all-files",
-                    f"{output_dir}/{target}",
-                ]
+            for target in request["scan_list"]:
                 try:
-                    detect_secrets_output = subprocess.run(
-                        detect_secrets_scan, capture_output=True
-                    )
+                    targets.append((index, target, self._files(request, target)))
                 except Exception as e:
                     logging.error(traceback.format_exc())
-                    scan_errors += 1
+                    scan_errors[index] += 1
 
-                if debug:
-                    print("Trying to write to:")
-                    pprint(f"{output_dir}/detect_secrets_{target}.json")
+        # Every package's files go through the scanner in one pass, and each
+        # package's report is written as its findings come out of it, so the
+        # batch's findings are never all in memory at once.  Once the pass
+        # fails the packages it hadn't finished are scanned again on their
+        # own, so one bad file does not fail the whole batch.
+        batch = _Batch_Findings(
+            targets,
+            self._findings([name for _, _, files in targets for name in files]),
+        )
+        for position, (index, target, files) in enumerate(targets):
+            try:
                 try:
-                    file = open(f"{output_dir}/detect_secrets_{target}.json", "w")
-                    file.write(detect_secrets_output.stdout.decode("utf-8"))
-                    file.close()
-                except Exception as e:
-                    logging.error(traceback.format_exc())
-                    scan_errors += 1
-        else:
-            scan_errors += 1
+                    self._report(requests[index], target, batch.package(position))
+                except _Batch_Failed:
+                    self._report(requests[index], target, self._findings(files))
+            except Exception as e:
+                logging.error(traceback.format_exc())
+                scan_errors[index] += 1
 
         return scan_errors
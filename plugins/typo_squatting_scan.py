@@ -1,20 +1,123 @@
-import jellyfish  # Used to compute distance between two strings in terms of deletion, insertion, substitution and transposition.
 import traceback
-import requests
 import logging
-import json
-import sys
+import threading
+import email.utils
+import time
 import os
-import re
+import io
+import contextlib
 
 from yapsy.IPlugin import IPlugin
+from typo_index import Reference_List
+import package_names
 
-plugin_location = os.path.dirname(
-    os.path.abspath(sys.argv[0])
-)  # The location of the directory where the plugin is located.
+REFERENCE_URL = (
+    "https://hugovk.github.io/top-pypi-packages/top-pypi-packages-365-days.json"
+)
+
+# The reference list lives in the repository root (where `invoke top5000`
+# puts it) unless PIP_AUDIT_TOP_LIST points somewhere else.
+DEFAULT_REFERENCE_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "top5000_list.json"
+)
+
+# Re-download once the list is older than this, in seconds (default a week)
+DEFAULT_REFERENCE_MAX_AGE = 7 * 24 * 60 * 60
+
+# How often a running process stats the list to pick up a refreshed copy
+REFERENCE_RECHECK_SECONDS = 60
 
 
 class Typo_Squatting_Protection(IPlugin):
+    # Only reads a handful of small files, works from archive members directly
+    needs_filesystem = False
+
+    def activate(self):
+        # Load the reference list once per process instead of once per package
+        super().activate()
+        self.reference_path = os.environ.get(
+            "PIP_AUDIT_TOP_LIST", DEFAULT_REFERENCE_PATH
+        )
+        self.reference_max_age = float(
+            os.environ.get("PIP_AUDIT_TOP_LIST_MAX_AGE", DEFAULT_REFERENCE_MAX_AGE)
+        )
+        self.reference = None
+        self._reference_mtime = None
+        self._reference_checked = 0
+        self._reference_lock = threading.Lock()
+        try:
+            self._current_reference()
+        except Exception as e:
+            logging.error(traceback.format_exc())
+
+    def _download_reference(self):
+        # Conditional GET so an unchanged list costs a 304 and nothing else.
+        # requests is only imported when the list is actually refreshed.
+        import requests
+
+        headers = {}
+        etag_path = f"{self.reference_path}.etag"
+        if os.path.isfile(self.reference_path):
+            mtime = os.stat(self.reference_path).st_mtime
+            headers["If-Modified-Since"] = email.utils.formatdate(mtime, usegmt=True)
+            if os.path.isfile(etag_path):
+                with open(etag_path, "r", encoding="utf-8") as file:
+                    headers["If-None-Match"] = file.read().strip()
+
+        inventory_raw = requests.get(REFERENCE_URL, headers=headers, timeout=60)
+        if inventory_raw.status_code == 304:
+            os.utime(self.reference_path)
+            return
+        inventory_raw.raise_for_status()
+
+        partial = f"{self.reference_path}.{os.getpid()}.part"
+        with open(partial, "w", encoding="utf-8") as file:
+            file.write(inventory_raw.text)
+        os.replace(partial, self.reference_path)
+        if inventory_raw.headers.get("ETag"):
+            with open(etag_path, "w", encoding="utf-8") as file:
+                file.write(inventory_raw.headers["ETag"])
+
+    def _current_reference(self):
+        with self._reference_lock:
+            now = time.time()
+            if (
+                self.reference is not None
+                and now - self._reference_checked < REFERENCE_RECHECK_SECONDS
+            ):
+                return self.reference
+            self._reference_checked = now
+
+            try:
+                stat = os.stat(self.reference_path)
+            except FileNotFoundError:
+                stat = None
+            if stat is None or now - stat.st_mtime > self.reference_max_age:
+                try:
+                    self._download_reference()
+                    stat = os.stat(self.reference_path)
+                except Exception as e:
+                    if stat is None:
+                        raise
+                    # A stale list is still better than no list at all
+                    logging.error(traceback.format_exc())
+
+            if self.reference is None or stat.st_mtime_ns != self._reference_mtime:
+                self.reference = Reference_List.load(self.reference_path)
+                self._reference_mtime = stat.st_mtime_ns
+            return self.reference
+
+    def cache_tag(self):
+        # Results depend on the reference list as much as on this code, so
+        # cached ones are only reused while the list is the same
+        if not self.is_activated:
+            self.activate()
+        try:
+            return self._current_reference().sha256[:16]
+        except Exception as e:
+            logging.error(traceback.format_exc())
+            return None
+
     def scan(
         self,
         scan_list=[],
@@ -25,281 +128,104 @@ class Typo_Squatting_Protection(IPlugin):
         output_json=False,
         **kwargs
     ):
-        # Defining some smaller functions to help with the execution.
-
-        def _downloading_top_5000():
-            inventory_raw = requests.get(
-                "https://hugovk.github.io/top-pypi-packages/top-pypi-packages-365-days.json"
-            )
-            with open(
-                f"{plugin_location}/top5000_list.json", "w", encoding="utf-8"
-            ) as file:
-                file.write(inventory_raw.text)
-
-        def _loading_top_5000():
-            if os.path.exists(f"{plugin_location}/top5000_list.json"):
-                with open(
-                    f"{plugin_location}/top5000_list.json", "r", encoding="utf-8"
-                ) as file:
-                    inventory_list = json.loads(
-                        file.read()
-                    )  # Reads all the file at once, can create problems
-                    inventory = list(
-                        project["project"] for project in inventory_list["rows"]
-                    )
-                    return inventory
-            else:
-                _downloading_top_5000()
-                return _loading_top_5000()  # Recursive call because I am lazy.
-
-        def _name_distance_indicator(pkg_name_1, pkg_name_2):
-            if pkg_name_1 == pkg_name_2:
-                return float(
-                    "inf"
-                )  # We don't want the scan to report that, for instance, numpy is a name very close to that of the popular package numpy...
-            return (
-                2
-                * jellyfish.damerau_levenshtein_distance(pkg_name_1, pkg_name_2)
-                / (len(pkg_name_1) + len(pkg_name_2))
-            )
+        if not self.is_activated:
+            self.activate()
 
-        print("-> Beginning the typo-squatting plugin")
+        if verbose and not output_json:
+            print("-> Beginning the typo-squatting plugin")
 
         scan_errors = 0
+        report_dir = kwargs.get("report_dir") or output_dir
+        record_findings = kwargs.get("record_findings")
+
+        # The pipeline reads the package's names out of the archive while
+        # listing it, see package_names.  Without that (e.g. when the plugin
+        # is run on its own) they are looked up here.
+        members = kwargs.get("members")
+        resolved = package_meta.get("package_names")
+        if resolved is None:
+            try:
+                files = members() if members else package_names.read_tree(output_dir)
+                resolved = package_names.resolve(files, sorted(scan_list))
+            except Exception as e:
+                logging.error(traceback.format_exc())
+                resolved = {
+                    "names": list(scan_list),
+                    "warnings": [],
+                    "suspicious": 1,
+                }
+        scan_errors += resolved["suspicious"]
+        pkg_names_list = resolved["names"]
 
         threshold = 0.3
         try:
-            top5000_list = _loading_top_5000()
+            # Names plus a BK-tree over them, see typo_index.Reference_List
+            top5000_list = self._current_reference()
         except Exception as e:
             logging.error(traceback.format_exc())
             scan_errors += 1
-
-        pkg_names_list = []
-
-        with open(
-            f"{output_dir}/typo_squatting_warnings.txt", "w", encoding="utf-8"
+            top5000_list = None
+
+        # With a results store the warnings are collected and recorded as one
+        # finding instead of going to typo_squatting_warnings.txt
+        warnings = io.StringIO() if record_findings else None
+        with (
+            contextlib.nullcontext(warnings)
+            if record_findings
+            else open(
+                f"{report_dir}/typo_squatting_warnings.txt", "w", encoding="utf-8"
+            )
         ) as warning_file:
-            for pkg_dir in scan_list:
-
-                ### First step is to find the registered name of the package on PyPi in the setup.py file.
-                ### That step is really long and obscure, sorry about that, but we have to take every possible case into account.
-
-                setup_location = None
-                for root, dirs, files in os.walk(f"{output_dir}/{pkg_dir}"):
-                    if "setup.py" in files:
-                        setup_location = os.path.join(root, "setup.py")
-
-                if (
-                    not setup_location
-                ):  # It is entirely possible to have no setup.py file in a package, in case that package has a METADATA file. Just to be sure we add the package root dir in the pkg_names_list in order to be sure that no package will go unnoticed.
-                    warning_file.write(
-                        f"The setup.py file could not be found in {pkg_dir}, that may not be an issue if a METADATA file is found later on."
-                    )
-                    pkg_name = pkg_dir  # a default name for the script to work with.
+            for warning in resolved["warnings"]:
+                warning_file.write(f"{warning}\n")
 
-                if (
-                    setup_location
-                ):  # in case where there are both a setup.py and a metadata file, the setup.py will be considered more reliable.
-
-                    ### In the absolutely unreadable bit of code that follows, we do twice the same thing:
-                    ### Step 1 : find all occurences of a call to the setup method.
-                    ### Step 2 : Count the number of occurences found. If there are more or less than one, raises the error counter.
-                    ### Step 3 : Do the same thing with all occurences with every occurence of "name=" in the arguments of the setup call.
-
-                    with open(setup_location, "r") as setup_file:
-                        setup_file_content = (
-                            setup_file.read()
-                        )  # Reads all at once, poor RAM management but makes re easier to work with.
-
-                        # all_setup_call_location = [(m.start(),m.end()) for m in re.finditer("setup\([^)]+\)",setup_file_content)]
-                        all_setup_call_location = [
-                            (m.start(), m.end())
-                            for m in re.finditer("setup\([^)]+\)", setup_file_content)
-                        ]
-                        # Have I ever mentionned that I find regular expressions unreadable ?
-
-                        if (
-                            len(all_setup_call_location) > 1
-                        ):  # there should only be one call, anything else seems suspicious
-                            warning_file.write(
-                                f"The setup.py file in {pkg_dir} contains more than one call of setup, which is suspicious and may lead to parsing mistakes from this script."
-                            )
-                            scan_errors += 1
-
-                            first_setup_call_location = all_setup_call_location[0]
-                            setup_call_arguments = setup_file_content[
-                                first_setup_call_location[0]
-                                + 6 : first_setup_call_location[1]
-                                - 1
-                            ]  # the part of the line containing the arguments for the setup call.
-                            all_namings = [
-                                (m.start(), m.end())
-                                for m in re.finditer(
-                                    "name=[^,)]+[,)]", setup_call_arguments
-                                )
-                            ]  # finds all occurences of what could be the naming of the package in the setup call file.
-
-                            if (
-                                len(all_namings) > 1
-                            ):  # Same fight here, there should only be one occurence of name=
-                                warning_file.write(
-                                    f"The setup call in the setup.py file in {pkg_dir} seems to give several names to its package, which is suspicious and may lead to parsing mistakes from this script."
-                                )
-                                scan_errors += 1
-
-                                first_naming_call = all_namings[0]
-                                pkg_name = (
-                                    setup_call_arguments[
-                                        first_naming_call[0]
-                                        + 5 : first_naming_call[1]
-                                        - 1
-                                    ]
-                                    .strip("'")
-                                    .strip('"')
-                                )  # remove the quotes in the original python code.
-
-                            elif len(all_namings) == 0:
-                                warning_file.write(
-                                    f"The setup call in the setup.py file in {pkg_dir} doesn't seem to contain the name of the package, which is suspicious and may lead to parsing mistakes from this script."
-                                )
-                                scan_errors += 1
-                                pkg_name = pkg_dir
-
-                            else:
-                                first_naming_call = all_namings[0]
-                                pkg_name = (
-                                    setup_call_arguments[
-                                        first_naming_call[0]
-                                        + 5 : first_naming_call[1]
-                                        - 1
-                                    ]
-                                    .strip("'")
-                                    .strip('"')
-                                )  # remove the quotes in the original python code.
-
-                        elif len(all_setup_call_location) == 0:
-                            warning_file.write(
-                                f"The setup.py file in {pkg_dir} doesn't contain any call of setup, which is suspicious and may lead to parsing mistakes from this script."
-                            )
-                            scan_errors += 1
-                            pkg_name = (
-                                pkg_dir
-                            )  # defaults to the name of the root directory of the package.
-
-                        else:
-                            first_setup_call_location = all_setup_call_location[0]
-                            setup_call_arguments = setup_file_content[
-                                first_setup_call_location[0]
-                                + 6 : first_setup_call_location[1]
-                                - 1
-                            ]  # the part of the line containing the arguments for the setup call.
-                            all_namings = [
-                                (m.start(), m.end())
-                                for m in re.finditer(
-                                    "name=[^,)]+[,)]", setup_call_arguments
-                                )
-                            ]  # finds all occurences of what could be the naming of the package in the setup call file.
-
-                            if (
-                                len(all_namings) > 1
-                            ):  # Same fight here, there should only be one occurence of name=
-                                warning_file.write(
-                                    f"The setup call in the setup.py file in {pkg_dir} seems to give several names to its package, which is suspicious and may lead to parsing mistakes from this script."
-                                )
-                                scan_errors += 1
-                                first_naming_call = all_namings[0]
-                                pkg_name = (
-                                    setup_call_arguments[
-                                        first_naming_call[0]
-                                        + 5 : first_naming_call[1]
-                                        - 1
-                                    ]
-                                    .strip("'")
-                                    .strip('"')
-                                )  # remove the quotes in the original python code.
-
-                            elif len(all_namings) == 0:
-                                warning_file.write(
-                                    f"The setup call in the setup.py file in {pkg_dir} doesn't seem to contain the name of the package, which is suspicious and may lead to parsing mistakes from this script."
-                                )
-                                scan_errors += 1
-                                pkg_name = pkg_dir
-                            else:
-                                first_naming_call = all_namings[0]
-                                pkg_name = (
-                                    setup_call_arguments[
-                                        first_naming_call[0]
-                                        + 5 : first_naming_call[1]
-                                        - 1
-                                    ]
-                                    .strip("'")
-                                    .strip('"')
-                                )  # remove the quotes in the original python code.
-
-                # There should be a pkg_name defined here whether we found a setup.py file or not.
-                if (
-                    not pkg_name in pkg_names_list
-                ):  # i.e. if we haven't already registered the name (which should never happend, but is added with the scan in metadata)
-                    pkg_names_list.append(
-                        pkg_name
-                    )  # all packages appear at least once in the scan_list, so we are certain that each package will at least appear once in this list.
-
-            ### Here we do basically the same work once more with the informations obtained from METADATA files.
-
-            if "archive_file_list" in package_meta:
-                all_metadata_paths = []
-
-                archive_file_list = package_meta["archive_file_list"]
-                for filepath in archive_file_list:
-                    if filepath.endswith("METADATA") or filepath.endswith(
-                        "PKG-INFO"
-                    ):  # Both files contain the package name
-                        all_metadata_paths.append(filepath)
-
-                for metadata_path in all_metadata_paths:
-                    with open(f"{output_dir}/{metadata_path}", "r") as metadata_file:
-                        metadata_line = metadata_file.readline().rstrip()
-                        metadata_name_found = (
-                            False
-                        )  # indicates whether the name of the package was found in metadata. If not, it seems suspicious.
-                        while metadata_line:
-                            if metadata_line.startswith("Name: "):
-
-                                pkg_name = metadata_line[
-                                    6:
-                                ]  # the rest of the line is considered to be the package name.
-                                if not pkg_name in pkg_names_list:
-                                    pkg_names_list.append(pkg_name)
-
-                                metadata_name_found = True
-                                break  # just for efficiency
-                            metadata_line = metadata_file.readline().rstrip()
-
-                        if not metadata_name_found:
-                            warning_file.write(
-                                f"The METADATA file at {metadata_path} doesn't seem to contain the name of the package, which is suspicious and may lead to parsing mistakes from this script."
-                            )
-                            scan_errors += 1
+        if record_findings and warnings.getvalue():
+            record_findings(
+                None,
+                [{"rule": "package-name-warning", "message": warnings.getvalue()}],
+            )
 
         ############# Once that point has been reached the script should have found a pkg_name to work with.
 
+        # Nothing to compare the names with, the error is already counted
+        if top5000_list is None:
+            return scan_errors
+
         for pkg_name in pkg_names_list:
 
             if verbose and not output_json:
                 print(
-                    f"-> Running typo-squatting detection against package {pkg_name}. Output saved to {output_dir}."
+                    f"-> Running typo-squatting detection against package {pkg_name}. Output saved to {report_dir}."
                 )
 
+            if record_findings:
+                try:
+                    suscpicion_list = top5000_list.near(pkg_name, threshold)
+                    if suscpicion_list:
+                        record_findings(
+                            pkg_name,
+                            [
+                                {
+                                    "rule": "typo-squatting",
+                                    "message": f"{pkg_name} is close to {len(suscpicion_list)} popular package(s)",
+                                    "details": {
+                                        "package": pkg_name,
+                                        "similar_to": suscpicion_list,
+                                    },
+                                }
+                            ],
+                        )
+                except Exception as e:
+                    logging.error(traceback.format_exc())
+                    scan_errors += 1
+                continue
+
             with open(
-                f"{output_dir}/typo_squatting_{pkg_name}.txt", "w", encoding="utf-8"
+                f"{report_dir}/typo_squatting_{pkg_name}.txt", "w", encoding="utf-8"
             ) as scan_results:
                 try:
-                    suscpicion_list = []
-                    suscpicion_count = 0
-                    for top_pkg in top5000_list:
-                        if _name_distance_indicator(pkg_name, top_pkg) < threshold:
-                            suscpicion_list.append(top_pkg)
-                            suscpicion_count += 1
+                    suscpicion_list = top5000_list.near(pkg_name, threshold)
+                    suscpicion_count = len(suscpicion_list)
                     scan_results.write(
                         f"{pkg_name}- Potential typo squattings detected -{suscpicion_count}- List of potentially typo squatted packages -{suscpicion_list}\n"
                     )  # The - are here to make the output easier to parse later on.
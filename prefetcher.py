@@ -0,0 +1,192 @@
+"""Asyncio prefetching of package archives ahead of the scanners.
+
+While one package is being scanned the next few are already downloading:
+Prefetcher.run() takes the stream of jobs, keeps up to `prefetch` of them
+downloading or downloaded ahead of the consumer (and stops reading ahead
+once `max_bytes` of finished archives are waiting on disk), and hands them
+on in their original order to the ordinary synchronous stages.
+
+Every index and file request goes through an event loop running in its own
+thread, which limits how many requests hit the same host at once and
+retries connection errors, timeouts, 429s and 5xx responses with
+exponential backoff (honouring Retry-After).  The HTTP calls themselves are
+still made by Package_Fetcher in executor threads, so the keep-alive
+sessions and hash checks are the same as without prefetching.
+
+@author u/gatewaynode
+@website https://reddit.com/r/pipsecurity
+"""
+
+import random
+import logging
+import threading
+import functools
+import traceback
+import collections
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+DEFAULT_PREFETCH = 4
+DEFAULT_PREFETCH_BYTES = 1024**3
+DEFAULT_PER_HOST = 4
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+
+
+def _retryable(error):
+    import requests  # Only needed once something went wrong
+
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return True
+    if isinstance(error, requests.HTTPError) and error.response is not None:
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    return False
+
+
+def _retry_after(error):
+    # Seconds the server asked us to wait, if it said so in a usable form
+    response = getattr(error, "response", None)
+    if response is None:
+        return 0
+    try:
+        return float(response.headers.get("Retry-After", 0))
+    except ValueError:
+        return 0
+
+
+class _Loop_Fetcher:
+    # Stands in for a Package_Fetcher inside the download stage, every call is
+    # scheduled on the prefetcher's event loop and waited for.
+    def __init__(self, prefetcher):
+        self._prefetcher = prefetcher
+
+    def resolve(self, project):
+        return self._prefetcher._call(
+            self._prefetcher.fetcher.index_url,
+            self._prefetcher.fetcher.resolve,
+            project,
+        )
+
+    def download(self, entry, output_dir, saved_dir=None):
+        return self._prefetcher._call(
+            entry["url"],
+            self._prefetcher.fetcher.download,
+            entry,
+            output_dir,
+            saved_dir,
+        )
+
+    def fetch(self, project, output_dir, saved_dir=None):
+        return self.download(self.resolve(project), output_dir, saved_dir)
+
+
+class Prefetcher:
+    def __init__(
+        self,
+        fetcher,
+        prefetch=DEFAULT_PREFETCH,
+        max_bytes=DEFAULT_PREFETCH_BYTES,
+        per_host=DEFAULT_PER_HOST,
+        retries=DEFAULT_RETRIES,
+        backoff=DEFAULT_BACKOFF,
+    ):
+        self.fetcher = fetcher
+        self.prefetch = prefetch
+        self.max_bytes = max_bytes
+        self.per_host = per_host
+        self.retries = retries
+        self.backoff = backoff
+        self._loop = None
+        self._io = None
+        self._hosts = {}
+        self._buffered = 0
+        self._buffered_lock = threading.Lock()
+
+    def _call(self, url, function, *args):
+        # Blocking entry point for the job threads
+        import asyncio
+
+        return asyncio.run_coroutine_threadsafe(
+            self._limited(url, function, *args), self._loop
+        ).result()
+
+    async def _limited(self, url, function, *args):
+        import asyncio
+
+        host = urlsplit(url).netloc
+        if host not in self._hosts:
+            self._hosts[host] = asyncio.Semaphore(self.per_host)
+        attempt = 0
+        while True:
+            async with self._hosts[host]:
+                try:
+                    return await self._loop.run_in_executor(
+                        self._io, functools.partial(function, *args)
+                    )
+                except Exception as e:
+                    if attempt >= self.retries or not _retryable(e):
+                        raise
+                    error = e
+            # Back off outside the semaphore so other requests to the host go on
+            attempt += 1
+            delay = self.backoff * 2 ** (attempt - 1) * (1 + random.random())
+            delay = max(delay, _retry_after(error))
+            logging.warning(f"Retrying {url} in {delay:.1f}s after: {error}")
+            await asyncio.sleep(delay)
+
+    def _fetch_job(self, fetch_job, job):
+        try:
+            fetch_job(job, _Loop_Fetcher(self))
+        except Exception as e:
+            logging.error(traceback.format_exc())
+            job["scan_errors"] += 1
+            job["skip"] = True
+        job["prefetched_bytes"] = (job.get("output") or {}).get("size") or 0
+        with self._buffered_lock:
+            self._buffered += job["prefetched_bytes"]
+
+    def run(self, jobs, fetch_job):
+        # Yields the jobs in order once fetch_job(job, fetcher) has run for
+        # them, with up to `prefetch` of the following ones fetched meanwhile.
+        # asyncio is imported here, most runs never get to it.
+        import asyncio
+
+        self._loop = asyncio.new_event_loop()
+        loop_thread = threading.Thread(target=self._loop.run_forever, daemon=True)
+        loop_thread.start()
+        self._io = ThreadPoolExecutor(max_workers=self.prefetch)
+        job_threads = ThreadPoolExecutor(max_workers=self.prefetch)
+        pending = collections.deque()
+        jobs = iter(jobs)
+        exhausted = False
+        try:
+            while True:
+                while (
+                    not exhausted
+                    and len(pending) < self.prefetch
+                    and self._buffered < self.max_bytes
+                ):
+                    job = next(jobs, None)
+                    if job is None:
+                        exhausted = True
+                        break
+                    pending.append(
+                        (job, job_threads.submit(self._fetch_job, fetch_job, job))
+                    )
+                if not pending:
+                    return
+                job, future = pending.popleft()
+                future.result()
+                with self._buffered_lock:
+                    self._buffered -= job["prefetched_bytes"]
+                yield job
+        finally:
+            # Let downloads still in flight finish before the loop goes away
+            for job, future in pending:
+                future.result()
+            job_threads.shutdown()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            loop_thread.join()
+            self._loop.close()
+            self._io.shutdown()
+            self._hosts = {}
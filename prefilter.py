@@ -0,0 +1,132 @@
+"""One pass triage of files before the expensive scanners see them.
+
+A Prefilter is a single compiled alternation over everything a scanner could
+possibly report on: the regexes of detect-secrets' plugins, the names
+bandit's tests look for, runs of characters long enough to be high entropy
+and so on.  Each scanner plugin builds its own from the scanner's loaded
+configuration, so the markers follow the scanner's rules instead of a copy
+of them.  A file the alternation doesn't match can't produce a finding and
+is not handed to the scanner at all.
+
+The markers are plain ASCII, so files with anything else in them (non-ASCII
+or control bytes, a lone carriage return) are always candidates; that keeps
+Unicode case folding, identifier normalization and odd line endings from
+ever hiding a match.  Files are read once, memory mapped where possible.
+
+Set PIP_AUDIT_PREFILTER=0 to hand every file to the scanners again.
+
+@author u/gatewaynode
+@website https://reddit.com/r/pipsecurity
+"""
+
+import os
+import re
+import mmap
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
+
+# Anything but printable ASCII, tab and newlines, or a CR not ending a line
+ODD_BYTES = rb"[^\x09\x0a\x0d\x20-\x7e]|\r(?!\n)"
+
+# Backreferences would point at the wrong group once patterns are combined
+_BACKREFERENCE = re.compile(r"\\[1-9]|\(\?P=")
+
+# Literals shorter than this are not worth trading a pattern for
+MIN_LITERAL = 3
+
+
+def enabled():
+    return os.environ.get("PIP_AUDIT_PREFILTER", "1") != "0"
+
+
+def _required_literal(parsed, flags):
+    # The longest run of plain characters every match of the parsed pattern
+    # contains, if it is MIN_LITERAL or longer.  Matching that instead of the
+    # pattern can only let more files through, and literals are a lot
+    # cheaper to look for than groups, anchors or case insensitive
+    # alternatives.
+    best = run = ""
+    for op, value in parsed:
+        if op is sre_parse.LITERAL and value < 128:
+            run += chr(value)
+        else:
+            run = ""
+        best = max(best, run, key=len)
+    if len(best) < MIN_LITERAL:
+        return None
+    if not flags & re.IGNORECASE:
+        return re.escape(best)
+    return "".join(
+        f"[{char.lower()}{char.upper()}]" if char.isalpha() else re.escape(char)
+        for char in best
+    )
+
+
+def _branch(pattern, flags=0):
+    # pattern as an ASCII branch of the combined alternation
+    if isinstance(pattern, re.Pattern):
+        pattern, flags = pattern.pattern, pattern.flags
+    if isinstance(pattern, bytes):
+        pattern = pattern.decode("ascii")
+    try:
+        parsed = sre_parse.parse(pattern, flags)
+    except re.error as e:
+        raise ValueError(f"Can't parse {pattern!r}: {e}")
+    # Flags set inside the pattern, (?i) and the like, count too
+    flags = (getattr(parsed, "state", None) or parsed.pattern).flags
+    literal = _required_literal(parsed, flags)
+    if literal is not None:
+        return literal.encode("ascii")
+    if _BACKREFERENCE.search(pattern):
+        raise ValueError(f"Backreference in {pattern!r}")
+    scoped = "".join(
+        letter
+        for flag, letter in ((re.IGNORECASE, "i"), (re.DOTALL, "s"), (re.VERBOSE, "x"))
+        if flags & flag
+    )
+    # Global flags are only allowed at the start of a whole pattern
+    pattern = re.sub(r"^\(\?[aiLmsux]+\)", "", pattern)
+    if scoped:
+        pattern = (
+            f"(?{scoped}:{pattern}\n)" if "x" in scoped else f"(?{scoped}:{pattern})"
+        )
+    return b"(?:" + pattern.encode("ascii") + b")"
+
+
+class Prefilter:
+    def __init__(self, patterns=(), words=()):
+        # patterns are regex strings or compiled regexes (whose flags are
+        # kept), all ASCII and matched with MULTILINE.  words are
+        # matched as whole words, all in one branch, which is several times
+        # faster than a branch each.  Raises ValueError for anything that
+        # can't be combined safely, callers then go without a prefilter.
+        branches = [ODD_BYTES]
+        if words:
+            words = sorted(set(words), key=lambda name: (-len(name), name))
+            escaped = "|".join(re.escape(name) for name in words)
+            branches.append(rb"\b(?:" + escaped.encode("ascii") + rb")\b")
+        branches.extend(_branch(pattern) for pattern in patterns)
+        try:
+            self.regex = re.compile(b"|".join(branches), re.MULTILINE)
+        except re.error as e:
+            raise ValueError(f"Can't combine the patterns: {e}")
+
+    def search(self, data):
+        return self.regex.search(data) is not None
+
+    def candidate(self, path):
+        # True when the file at path could hold a finding
+        try:
+            with open(path, "rb") as file:
+                if os.fstat(file.fileno()).st_size == 0:
+                    return False
+                try:
+                    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                        return self.search(data)
+                except (ValueError, OSError):
+                    return self.search(file.read())
+        except OSError:
+            return True  # Let the scanner report it
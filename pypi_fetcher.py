@@ -0,0 +1,305 @@
+"""Fetch package archives straight from a PEP 503/691 simple index.
+
+Replaces shelling out to `pip3 download` for every package.  One fetcher is
+shared by all download workers, each worker thread keeps its own keep-alive
+requests session, and downloads are checked against the hash the index
+publishes.  With an Archive_Store the fetcher looks for the archive there
+(or left over in the output directory by an earlier --save_files run)
+before downloading it.
+
+@author u/gatewaynode
+@website https://reddit.com/r/pipsecurity
+"""
+
+import os
+import re
+import json
+import shutil
+import hashlib
+import logging
+import traceback
+import threading
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlsplit, urldefrag
+from urllib.request import url2pathname, pathname2url
+from packaging.version import parse as parse_version, InvalidVersion
+
+DEFAULT_INDEX_URL = "https://pypi.org/simple/"
+
+SIMPLE_JSON = "application/vnd.pypi.simple.v1+json"
+ACCEPT = f"{SIMPLE_JSON}, application/vnd.pypi.simple.v1+html;q=0.2, text/html;q=0.1"
+
+# Only the archive types _extract_archives knows how to open, sdists first
+# since that is what the old `pip3 download --no-binary` asked for.
+ARCHIVE_PREFERENCE = (".tar.gz", ".whl")
+
+CHUNK_SIZE = 1024 * 64
+
+
+class Fetch_Error(Exception):
+    pass
+
+
+def normalize_name(name):
+    # ref: https://peps.python.org/pep-0503/#normalized-names
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+class _Anchor_Parser(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.links = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "a":
+            self.links.append(dict(attrs))
+
+
+def _version_from_filename(file_name, project):
+    if file_name.endswith(".whl"):
+        parts = file_name.split("-")
+        return parts[1] if len(parts) > 2 else None
+    for extension in ARCHIVE_PREFERENCE:
+        if file_name.endswith(extension):
+            stem = file_name[: -len(extension)]
+            break
+    else:
+        return None
+    # sdist names are "{name}-{version}", the name keeps whatever spelling
+    # the author used so compare it normalized instead of splitting on "-".
+    if normalize_name(stem[: len(project)]) == project and len(stem) > len(project):
+        return stem[len(project) + 1 :]
+    return stem.rsplit("-", 1)[-1] if "-" in stem else None
+
+
+def _iter_chunks(source):
+    # source is either a local file path or a streaming requests response
+    if isinstance(source, str):
+        with open(source, "rb") as file:
+            for chunk in iter(lambda: file.read(CHUNK_SIZE), b""):
+                yield chunk
+    else:
+        try:
+            for chunk in source.iter_content(CHUNK_SIZE):
+                yield chunk
+        finally:
+            source.close()
+
+
+def _local_size(url):
+    # HTML indexes don't list sizes, archives in a local mirror can tell
+    if not url.startswith("file://"):
+        return None
+    try:
+        return os.path.getsize(url2pathname(urlsplit(url).path))
+    except OSError:
+        return None
+
+
+class Package_Fetcher:
+    def __init__(self, index_url=DEFAULT_INDEX_URL, timeout=60, store=None):
+        if "://" not in index_url:
+            # Plain directory laid out like a simple index, handy as an offline
+            # stand-in for PyPI.
+            index_url = "file://" + pathname2url(os.path.abspath(index_url))
+        self.index_url = index_url.rstrip("/") + "/"
+        self.timeout = timeout
+        self.store = store
+        self._local = threading.local()
+        self._ahead = {}
+        self._ahead_lock = threading.Lock()
+
+    @property
+    def session(self):
+        # requests sessions pool keep-alive connections per host but are not
+        # meant to be shared between threads, so each worker gets its own.
+        session = getattr(self._local, "session", None)
+        if session is None:
+            # Imported on first use, a local mirror never needs it
+            import requests
+
+            session = requests.Session()
+            session.headers["User-Agent"] = "audit_automation_tools"
+            self._local.session = session
+        return session
+
+    def _open(self, url, headers=None, stream=False):
+        if url.startswith("file://"):
+            path = url2pathname(urlsplit(url).path)
+            if os.path.isdir(path):
+                path = os.path.join(path, "index.html")
+            if not os.path.isfile(path):
+                raise Fetch_Error(f"{url} not found")
+            return path
+        response = self.session.get(
+            url, headers=headers, stream=stream, timeout=self.timeout
+        )
+        if response.status_code == 404:
+            response.close()
+            raise Fetch_Error(f"{url} not found")
+        response.raise_for_status()
+        return response
+
+    def project_files(self, project):
+        project = normalize_name(project)
+        page_url = urljoin(self.index_url, f"{project}/")
+        page = self._open(page_url, headers={"Accept": ACCEPT})
+
+        if isinstance(page, str):
+            with open(page, "r", encoding="utf-8") as file:
+                content_type, body = "text/html", file.read()
+        else:
+            content_type = page.headers.get("Content-Type", "text/html")
+            body = page.text
+            page_url = page.url
+
+        files = []
+        if content_type.startswith(SIMPLE_JSON):
+            for entry in json.loads(body).get("files", []):
+                files.append(
+                    {
+                        "file_name": entry["filename"],
+                        "url": urljoin(page_url, entry["url"]),
+                        "sha256": entry.get("hashes", {}).get("sha256"),
+                        "size": entry.get("size"),
+                        "yanked": bool(entry.get("yanked")),
+                    }
+                )
+        else:
+            parser = _Anchor_Parser()
+            parser.feed(body)
+            for link in parser.links:
+                if not link.get("href"):
+                    continue
+                url, fragment = urldefrag(urljoin(page_url, link["href"]))
+                sha256 = None
+                if fragment.startswith("sha256="):
+                    sha256 = fragment[len("sha256=") :]
+                files.append(
+                    {
+                        "file_name": url.rsplit("/", 1)[-1],
+                        "url": url,
+                        "sha256": sha256,
+                        "size": _local_size(url),
+                        "yanked": "data-yanked" in link,
+                    }
+                )
+
+        for entry in files:
+            entry["project"] = project
+            entry["version"] = _version_from_filename(entry["file_name"], project)
+        return files
+
+    def lookahead(self, project):
+        # resolve() ahead of time, e.g. to learn the archive's size for
+        # scheduling.  The next resolve() of the project gets this entry
+        # instead of asking the index again.
+        entry = self.resolve(project)
+        with self._ahead_lock:
+            self._ahead[normalize_name(project)] = entry
+        return entry
+
+    def resolve(self, project):
+        # Newest non-yanked, non pre-release version, preferring an sdist over
+        # a wheel for that version (same choice pip made for us before).
+        with self._ahead_lock:
+            entry = self._ahead.pop(normalize_name(project), None)
+        if entry is not None:
+            return entry
+        candidates = []
+        for entry in self.project_files(project):
+            if entry["yanked"] or not entry["version"]:
+                continue
+            if not entry["file_name"].endswith(ARCHIVE_PREFERENCE):
+                continue
+            try:
+                version = parse_version(entry["version"])
+            except InvalidVersion:
+                continue
+            kind = [entry["file_name"].endswith(ext) for ext in ARCHIVE_PREFERENCE]
+            candidates.append((version, kind, entry))
+
+        if not candidates:
+            raise Fetch_Error(f"No sdist or wheel found for {project}")
+        final = [c for c in candidates if not c[0].is_prerelease]
+        candidates = final or candidates
+        return max(candidates, key=lambda candidate: candidate[:2])[2]
+
+    def _reuse(self, entry, path, saved):
+        # sha256 of an archive we already have for this entry, linked to path
+        if entry["sha256"] and os.path.isfile(saved):
+            digest = hashlib.sha256()
+            for chunk in _iter_chunks(saved):
+                digest.update(chunk)
+            if digest.hexdigest() == entry["sha256"]:
+                if saved != path:
+                    try:
+                        os.link(saved, path)
+                    except OSError:
+                        shutil.copyfile(saved, path)
+                return entry["sha256"], "output_dir"
+        if self.store:
+            sha256 = self.store.find(entry["sha256"], entry["url"])
+            if sha256 and self.store.link(sha256, path):
+                return sha256, "store"
+        return None, None
+
+    def download(self, entry, output_dir, saved_dir=None):
+        # saved_dir is where an earlier --save_files run would have left the
+        # archive, when that is not output_dir itself
+        os.makedirs(output_dir, exist_ok=True)
+        path = os.path.join(output_dir, entry["file_name"])
+        saved = os.path.join(saved_dir or output_dir, entry["file_name"])
+        sha256, reused_from = self._reuse(entry, path, saved)
+        if sha256:
+            if reused_from == "output_dir":
+                self._keep(entry, path, sha256)
+            return self._result(entry, path, sha256, reused_from)
+
+        partial = f"{path}.part"
+        digest = hashlib.sha256()
+
+        source = self._open(entry["url"], stream=True)
+        try:
+            with open(partial, "wb") as file:
+                for chunk in _iter_chunks(source):
+                    digest.update(chunk)
+                    file.write(chunk)
+        except Exception:
+            if os.path.isfile(partial):
+                os.remove(partial)
+            raise
+
+        sha256 = digest.hexdigest()
+        if entry["sha256"] and entry["sha256"] != sha256:
+            os.remove(partial)
+            raise Fetch_Error(
+                f"Hash mismatch for {entry['file_name']}: index says {entry['sha256']}, got {sha256}"
+            )
+        os.replace(partial, path)
+        self._keep(entry, path, sha256)
+        return self._result(entry, path, sha256, "index")
+
+    def _keep(self, entry, path, sha256):
+        # A full or broken store must not fail the download itself
+        if self.store:
+            try:
+                self.store.add(path, sha256, entry["url"])
+            except Exception as e:
+                logging.error(traceback.format_exc())
+
+    def _result(self, entry, path, sha256, source):
+        return {
+            "project": entry["project"],
+            "version": entry["version"],
+            "file_name": entry["file_name"],
+            "path": path,
+            "url": entry["url"],
+            "size": os.path.getsize(path),
+            "sha256": sha256,
+            "hash_verified": bool(entry["sha256"]),
+            "source": source,
+        }
+
+    def fetch(self, project, output_dir, saved_dir=None):
+        return self.download(self.resolve(project), output_dir, saved_dir)
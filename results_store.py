@@ -0,0 +1,213 @@
+"""One SQLite database for the findings of every plugin.
+
+Instead of a report file per plugin and package directory, plugins hand
+their findings to the scan stage which queues them here, and the queue is
+written out in batched transactions.  Every finding carries the package,
+version, archive hash, plugin, severity, confidence, file, line and rule,
+with the plugin's own record kept as JSON in `details`, e.g.
+
+    SELECT package, file, line, message FROM findings
+     WHERE plugin = 'Bandit Scan' AND severity = 'HIGH'
+       AND scanned_at > strftime('%s', 'now', '-1 day');
+
+The `scans` table has one row per package and plugin run, so packages that
+came back clean can be told apart from ones never scanned.  With
+incremental scanning `manifests` keeps the sha256 of every file of every
+audited archive, so the next release of a project can be diffed against it
+and only the files that changed scanned again.
+
+@author u/gatewaynode
+@website https://reddit.com/r/pipsecurity
+"""
+
+import os
+import json
+import time
+import sqlite3
+import threading
+
+DEFAULT_BATCH_SIZE = 1000
+DEFAULT_FLUSH_SECONDS = 5.0
+
+# Name findings are kept under in a cached plugin result
+FINDINGS_REPORT = "findings.json"
+
+FINDING_FIELDS = ("severity", "confidence", "file", "line", "rule", "message")
+
+
+class Results_Store:
+    def __init__(
+        self,
+        path,
+        batch_size=DEFAULT_BATCH_SIZE,
+        flush_seconds=DEFAULT_FLUSH_SECONDS,
+    ):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+        self._lock = threading.Lock()
+        self._findings = []
+        self._scans = []
+        self._manifests = []
+        self._last_flush = time.time()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock, self._db:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("""CREATE TABLE IF NOT EXISTS scans (
+                    package TEXT NOT NULL,
+                    version TEXT,
+                    archive_sha256 TEXT,
+                    plugin TEXT NOT NULL,
+                    plugin_version TEXT NOT NULL,
+                    scan_errors INTEGER NOT NULL,
+                    findings INTEGER NOT NULL,
+                    scanned_at REAL NOT NULL
+                )""")
+            self._db.execute("""CREATE TABLE IF NOT EXISTS findings (
+                    package TEXT NOT NULL,
+                    version TEXT,
+                    archive_sha256 TEXT,
+                    plugin TEXT NOT NULL,
+                    plugin_version TEXT NOT NULL,
+                    target TEXT,
+                    severity TEXT,
+                    confidence TEXT,
+                    file TEXT,
+                    line INTEGER,
+                    rule TEXT,
+                    message TEXT,
+                    details TEXT,
+                    scanned_at REAL NOT NULL
+                )""")
+            self._db.execute("""CREATE TABLE IF NOT EXISTS manifests (
+                    package TEXT NOT NULL,
+                    version TEXT,
+                    archive_sha256 TEXT,
+                    file TEXT NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    scanned_at REAL NOT NULL
+                )""")
+            for table, column in (
+                ("scans", "package"),
+                ("scans", "archive_sha256"),
+                ("findings", "package"),
+                ("findings", "archive_sha256"),
+                ("manifests", "package"),
+                ("manifests", "archive_sha256"),
+                ("findings", "plugin, severity"),
+                ("findings", "scanned_at"),
+            ):
+                name = f"{table}_{column.replace(', ', '_')}"
+                self._db.execute(
+                    f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({column})"
+                )
+
+    def add(self, package, plugin, scan_errors, findings):
+        # package is (name, version, archive_sha256), plugin is (name, version)
+        # and findings a list of (target, finding dict).  Only queued here,
+        # flush() writes them.
+        now = time.time()
+        rows = [
+            package
+            + plugin
+            + (target,)
+            + tuple(finding.get(field) for field in FINDING_FIELDS)
+            + (json.dumps(finding.get("details"), sort_keys=True), now)
+            for target, finding in findings
+        ]
+        with self._lock:
+            self._scans.append(package + plugin + (scan_errors, len(rows), now))
+            self._findings.extend(rows)
+
+    def add_manifest(self, package, files):
+        # files is {path inside the release: sha256 of its content}, kept
+        # once per archive
+        now = time.time()
+        with self._lock:
+            if self._db.execute(
+                "SELECT 1 FROM manifests WHERE archive_sha256 = ? LIMIT 1",
+                (package[2],),
+            ).fetchone():
+                return
+            self._manifests.extend(
+                package + (path, sha256, now) for path, sha256 in files.items()
+            )
+
+    def previous_release(self, name, archive_sha256):
+        # (version, archive_sha256, {path: sha256}) of the last other archive
+        # of the project with a manifest, or None.  Reads what is flushed.
+        with self._lock:
+            row = self._db.execute(
+                "SELECT version, archive_sha256 FROM manifests"
+                " WHERE package = ? AND archive_sha256 IS NOT ?"
+                " ORDER BY scanned_at DESC LIMIT 1",
+                (name, archive_sha256),
+            ).fetchone()
+            if not row:
+                return None
+            files = dict(
+                self._db.execute(
+                    "SELECT file, sha256 FROM manifests"
+                    " WHERE package = ? AND archive_sha256 = ?",
+                    (name, row[1]),
+                )
+            )
+        return row[0], row[1], files
+
+    def findings_of(self, archive_sha256, plugin):
+        # (target, finding dict) pairs from the last run of plugin, a (name,
+        # version) pair, on the archive.  None unless that run was clean.
+        with self._lock:
+            scan = self._db.execute(
+                "SELECT scan_errors, scanned_at FROM scans"
+                " WHERE archive_sha256 = ? AND plugin = ? AND plugin_version = ?"
+                " ORDER BY scanned_at DESC LIMIT 1",
+                (archive_sha256,) + plugin,
+            ).fetchone()
+            if not scan or scan[0]:
+                return None
+            rows = self._db.execute(
+                f"SELECT target, {', '.join(FINDING_FIELDS)}, details FROM findings"
+                " WHERE archive_sha256 = ? AND plugin = ? AND plugin_version = ?"
+                " AND scanned_at = ?",
+                (archive_sha256,) + plugin + (scan[1],),
+            ).fetchall()
+        findings = []
+        for row in rows:
+            finding = dict(zip(FINDING_FIELDS, row[1:-1]))
+            finding["details"] = json.loads(row[-1])
+            findings.append((row[0], finding))
+        return findings
+
+    def due(self):
+        with self._lock:
+            pending = len(self._findings) + len(self._scans) + len(self._manifests)
+        return pending >= self.batch_size or (
+            pending and time.time() - self._last_flush >= self.flush_seconds
+        )
+
+    def flush(self):
+        with self._lock:
+            findings, self._findings = self._findings, []
+            scans, self._scans = self._scans, []
+            manifests, self._manifests = self._manifests, []
+            self._last_flush = time.time()
+            with self._db:
+                self._db.executemany(
+                    "INSERT INTO scans VALUES (?, ?, ?, ?, ?, ?, ?, ?)", scans
+                )
+                self._db.executemany(
+                    "INSERT INTO findings VALUES"
+                    " (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    findings,
+                )
+                self._db.executemany(
+                    "INSERT INTO manifests VALUES (?, ?, ?, ?, ?, ?)", manifests
+                )
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._db.close()
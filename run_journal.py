@@ -0,0 +1,125 @@
+"""Durable record of which packages a batch run has audited.
+
+Every package gets a row when it enters the pipeline and is updated when it
+leaves, with its status, attempt count, error count and how long it took.
+When a long run dies the same input list can be started again with
+--resume: packages that finished cleanly are skipped, failed ones (and ones
+that were still in flight when the run died) are retried until they have
+used up their attempts.
+
+@author u/gatewaynode
+@website https://reddit.com/r/pipsecurity
+"""
+
+import os
+import time
+import sqlite3
+import threading
+
+DEFAULT_MAX_ATTEMPTS = 3
+
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class Run_Journal:
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock, self._db:
+            # WAL with NORMAL sync: a finished package survives the process
+            # being killed without paying for an fsync on every row.
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute("""CREATE TABLE IF NOT EXISTS packages (
+                    raw_input TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL,
+                    scan_errors INTEGER NOT NULL,
+                    started REAL NOT NULL,
+                    finished REAL,
+                    seconds REAL,
+                    work_seconds REAL
+                )""")
+            # Journals from before work_seconds was recorded
+            columns = [
+                row[1] for row in self._db.execute("PRAGMA table_info(packages)")
+            ]
+            if "work_seconds" not in columns:
+                self._db.execute("ALTER TABLE packages ADD COLUMN work_seconds REAL")
+
+    def status(self, raw_input):
+        # (status, attempts) or None for a package this journal has not seen
+        with self._lock:
+            return self._db.execute(
+                "SELECT status, attempts FROM packages WHERE raw_input = ?",
+                (raw_input,),
+            ).fetchone()
+
+    def should_run(self, raw_input, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        row = self.status(raw_input)
+        if row is None:
+            return True
+        status, attempts = row
+        return status != DONE and attempts < max_attempts
+
+    def start(self, raw_input):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR IGNORE INTO packages (raw_input, status, attempts,"
+                " scan_errors, started) VALUES (?, ?, 0, 0, 0)",
+                (raw_input, RUNNING),
+            )
+            self._db.execute(
+                "UPDATE packages SET status = ?, attempts = attempts + 1,"
+                " scan_errors = 0, started = ?, finished = NULL, seconds = NULL"
+                " WHERE raw_input = ?",
+                (RUNNING, time.time(), raw_input),
+            )
+
+    def finish(self, raw_input, scan_errors, work_seconds=None):
+        # work_seconds is the time the package spent in the pipeline's stages,
+        # seconds also counts the time it waited between them
+        now = time.time()
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE packages SET status = ?, scan_errors = ?, finished = ?,"
+                " seconds = ? - started, work_seconds = COALESCE(?, work_seconds)"
+                " WHERE raw_input = ?",
+                (
+                    DONE if not scan_errors else FAILED,
+                    scan_errors,
+                    now,
+                    now,
+                    work_seconds,
+                    raw_input,
+                ),
+            )
+
+    def work_seconds(self, raw_input):
+        # How long the package took the last time it went through, None if it
+        # never finished.  Kept when the package is started again, so a run
+        # resumed from this journal can plan with it.
+        with self._lock:
+            row = self._db.execute(
+                "SELECT work_seconds FROM packages WHERE raw_input = ?",
+                (raw_input,),
+            ).fetchone()
+        return row[0] if row else None
+
+    def summary(self):
+        # {status: package count}
+        with self._lock:
+            return dict(
+                self._db.execute(
+                    "SELECT status, COUNT(*) FROM packages GROUP BY status"
+                ).fetchall()
+            )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
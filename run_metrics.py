@@ -0,0 +1,232 @@
+"""Timing and size metrics for audit runs.
+
+The pipeline stages record how long each package spent in download,
+extract, scan (and in each plugin's scan) and cleanup into the job, and
+finished jobs are folded in here.  Everything is kept as fixed bucket
+histograms, so memory stays the same for ten packages or the whole index,
+and percentiles are interpolated from the buckets the same way Prometheus'
+histogram_quantile() does it.
+
+The totals can be written as a JSON summary and as a Prometheus textfile
+(for node_exporter's textfile collector), both replaced atomically so a
+reader never sees half a file.
+
+@author u/gatewaynode
+@website https://reddit.com/r/pipsecurity
+"""
+
+import os
+import json
+import time
+
+SECONDS_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    25,
+    60,
+    120,
+    300,
+    600,
+    1800,
+    3600,
+)
+BYTES_BUCKETS = tuple(1024 * 4**power for power in range(11))  # 1KiB to 1GiB
+FILES_BUCKETS = tuple(2**power for power in range(17))  # 1 to 65536
+
+STAGES = ("download", "extract", "scan", "cleanup")
+
+
+def _round(value):
+    return None if value is None else round(value, 6)
+
+
+def _label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # Last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = 0.0
+
+    def observe(self, value):
+        index = 0
+        while index < len(self.buckets) and value > self.buckets[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        self.min = value if self.min is None else min(self.min, value)
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                if index == len(self.buckets):
+                    return self.max
+                # Interpolate within the bucket, narrowed to what was seen
+                lower = max(self.buckets[index - 1] if index else 0, self.min)
+                upper = min(self.buckets[index], self.max)
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "sum": round(self.sum, 6),
+            "max": round(self.max, 6),
+            "p50": _round(self.quantile(0.5)),
+            "p95": _round(self.quantile(0.95)),
+            "p99": _round(self.quantile(0.99)),
+        }
+
+    def prometheus(self, name, labels=""):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += count
+            le = f'le="{bound}"'
+            lines.append(
+                f"{name}_bucket{{{labels + ',' if labels else ''}{le}}} {cumulative}"
+            )
+        braces = f"{{{labels}}}" if labels else ""
+        lines.append(f"{name}_sum{braces} {self.sum}")
+        lines.append(f"{name}_count{braces} {self.count}")
+        return lines
+
+
+def _write_atomically(path, text):
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = f"{path}.{os.getpid()}.part"
+    with open(partial, "w", encoding="utf-8") as file:
+        file.write(text)
+    os.replace(partial, path)
+
+
+class Run_Metrics:
+    def __init__(self):
+        self.started = time.time()
+        self.packages = 0
+        self.scan_errors = 0
+        self.stages = {stage: Histogram(SECONDS_BUCKETS) for stage in STAGES}
+        self.plugins = {}
+        self.archive_bytes = Histogram(BYTES_BUCKETS)
+        self.package_files = Histogram(FILES_BUCKETS)
+        # Seconds the packages still to come should take, when scheduled by
+        # size (see scheduler)
+        self.predicted_seconds = None
+
+    def add_job(self, job):
+        # Only called from the thread reading finished jobs, so no locking
+        self.packages += 1
+        self.scan_errors += job["scan_errors"]
+        for stage, seconds in job.get("timings", {}).items():
+            if stage not in self.stages:
+                self.stages[stage] = Histogram(SECONDS_BUCKETS)
+            self.stages[stage].observe(seconds)
+        for plugin, seconds in job.get("plugin_timings", {}).items():
+            if plugin not in self.plugins:
+                self.plugins[plugin] = Histogram(SECONDS_BUCKETS)
+            self.plugins[plugin].observe(seconds)
+        package_meta = job["package_meta"]
+        if "archive_size" in package_meta:
+            self.archive_bytes.observe(package_meta["archive_size"])
+        if "total_package_files" in package_meta:
+            self.package_files.observe(package_meta["total_package_files"])
+
+    def summary(self):
+        summary = {
+            "packages": self.packages,
+            "scan_errors": self.scan_errors,
+            "wall_seconds": round(time.time() - self.started, 3),
+            "stages": {
+                stage: histogram.summary() for stage, histogram in self.stages.items()
+            },
+            "plugins": {
+                plugin: histogram.summary()
+                for plugin, histogram in sorted(self.plugins.items())
+            },
+            "archive_bytes": self.archive_bytes.summary(),
+            "package_files": self.package_files.summary(),
+        }
+        if self.predicted_seconds is not None:
+            summary["predicted_seconds"] = round(self.predicted_seconds, 3)
+        return summary
+
+    def prometheus(self):
+        lines = [
+            "# HELP pip_audit_packages_total Packages that went through the pipeline.",
+            "# TYPE pip_audit_packages_total counter",
+            f"pip_audit_packages_total {self.packages}",
+            "# HELP pip_audit_scan_errors_total Errors counted over all packages.",
+            "# TYPE pip_audit_scan_errors_total counter",
+            f"pip_audit_scan_errors_total {self.scan_errors}",
+            "# HELP pip_audit_stage_seconds Time a package spent in each pipeline stage.",
+            "# TYPE pip_audit_stage_seconds histogram",
+        ]
+        for stage, histogram in self.stages.items():
+            lines.extend(
+                histogram.prometheus(
+                    "pip_audit_stage_seconds", f'stage="{_label(stage)}"'
+                )
+            )
+        lines.extend(
+            [
+                "# HELP pip_audit_plugin_seconds Time each scan plugin took per package.",
+                "# TYPE pip_audit_plugin_seconds histogram",
+            ]
+        )
+        for plugin, histogram in sorted(self.plugins.items()):
+            lines.extend(
+                histogram.prometheus(
+                    "pip_audit_plugin_seconds", f'plugin="{_label(plugin)}"'
+                )
+            )
+        lines.extend(
+            [
+                "# HELP pip_audit_archive_bytes Size of the downloaded archives.",
+                "# TYPE pip_audit_archive_bytes histogram",
+            ]
+        )
+        lines.extend(self.archive_bytes.prometheus("pip_audit_archive_bytes"))
+        lines.extend(
+            [
+                "# HELP pip_audit_package_files Number of files in each archive.",
+                "# TYPE pip_audit_package_files histogram",
+            ]
+        )
+        lines.extend(self.package_files.prometheus("pip_audit_package_files"))
+        if self.predicted_seconds is not None:
+            lines.extend(
+                [
+                    "# HELP pip_audit_predicted_remaining_seconds Predicted time until the packages scheduled so far are done.",
+                    "# TYPE pip_audit_predicted_remaining_seconds gauge",
+                    f"pip_audit_predicted_remaining_seconds {self.predicted_seconds}",
+                ]
+            )
+        return "\n".join(lines) + "\n"
+
+    def write(self, json_path=None, textfile_path=None):
+        if json_path:
+            _write_atomically(json_path, json.dumps(self.summary(), indent=4) + "\n")
+        if textfile_path:
+            _write_atomically(textfile_path, self.prometheus())
@@ -0,0 +1,177 @@
+"""Persistent cache of plugin results keyed by archive content.
+
+An entry is keyed by the archive's sha256 plus the plugin's name and the
+version from its .yapsy-plugin file, and holds the plugin's error count and
+the report files it wrote.  A package whose archive has not changed since it
+was last audited can be answered from here without downloading it again,
+while bumping a plugin's version only reruns that plugin.
+
+@author u/gatewaynode
+@website https://reddit.com/r/pipsecurity
+"""
+
+import os
+import json
+import time
+import zlib
+import base64
+import sqlite3
+import threading
+
+DEFAULT_MAX_BYTES = 1024**3
+
+
+def plugin_key(plugin):
+    # plugin is a yapsy PluginInfo, name and version come from .yapsy-plugin.
+    # A plugin whose results also depend on data it loads (a reference list,
+    # rules) tags the version with that data through cache_tag().
+    version = str(plugin.version)
+    cache_tag = getattr(plugin.plugin_object, "cache_tag", None)
+    tag = cache_tag() if cache_tag else None
+    if tag:
+        version = f"{version}+{tag}"
+    return (plugin.name, version)
+
+
+def snapshot_reports(report_dir):
+    # Modification times of the report files currently in report_dir, used to
+    # work out which files a plugin wrote.
+    reports = {}
+    if os.path.isdir(report_dir):
+        for entry in os.scandir(report_dir):
+            if entry.is_file():
+                reports[entry.name] = entry.stat().st_mtime_ns
+    return reports
+
+
+def read_new_reports(report_dir, before):
+    reports = {}
+    for name, mtime in snapshot_reports(report_dir).items():
+        if before.get(name) != mtime:
+            with open(os.path.join(report_dir, name), "rb") as file:
+                reports[name] = file.read()
+    return reports
+
+
+def write_reports(report_dir, reports):
+    os.makedirs(report_dir, exist_ok=True)
+    for name, data in reports.items():
+        with open(os.path.join(report_dir, os.path.basename(name)), "wb") as file:
+            file.write(data)
+
+
+def _pack(reports):
+    encoded = {
+        name: base64.b64encode(data).decode("ascii") for name, data in reports.items()
+    }
+    return zlib.compress(json.dumps(encoded).encode("utf-8"))
+
+
+def _unpack(blob):
+    encoded = json.loads(zlib.decompress(blob).decode("utf-8"))
+    return {name: base64.b64decode(data) for name, data in encoded.items()}
+
+
+class Scan_Cache:
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        with self._lock, self._db:
+            # WAL lets several audit processes share one cache file
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("""CREATE TABLE IF NOT EXISTS scan_results (
+                    archive_sha256 TEXT NOT NULL,
+                    plugin_name TEXT NOT NULL,
+                    plugin_version TEXT NOT NULL,
+                    scan_errors INTEGER NOT NULL,
+                    reports BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    last_used REAL NOT NULL,
+                    PRIMARY KEY (archive_sha256, plugin_name, plugin_version)
+                )""")
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS scan_results_last_used ON scan_results (last_used)"
+            )
+            self._total = self._db.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM scan_results"
+            ).fetchone()[0]
+
+    def lookup(self, archive_sha256, plugin_keys):
+        # Returns {plugin_key: (scan_errors, reports)} for the plugins that hit
+        hits = {}
+        if not archive_sha256:
+            return hits
+        now = time.time()
+        with self._lock, self._db:
+            for name, version in plugin_keys:
+                row = self._db.execute(
+                    "SELECT scan_errors, reports FROM scan_results"
+                    " WHERE archive_sha256 = ? AND plugin_name = ? AND plugin_version = ?",
+                    (archive_sha256, name, version),
+                ).fetchone()
+                if row:
+                    hits[(name, version)] = (row[0], _unpack(row[1]))
+                    self._db.execute(
+                        "UPDATE scan_results SET last_used = ?"
+                        " WHERE archive_sha256 = ? AND plugin_name = ? AND plugin_version = ?",
+                        (now, archive_sha256, name, version),
+                    )
+        return hits
+
+    def store(self, archive_sha256, key, scan_errors, reports):
+        if not archive_sha256:
+            return
+        blob = _pack(reports)
+        now = time.time()
+        with self._lock, self._db:
+            replaced = self._db.execute(
+                "SELECT size FROM scan_results"
+                " WHERE archive_sha256 = ? AND plugin_name = ? AND plugin_version = ?",
+                (archive_sha256, key[0], key[1]),
+            ).fetchone()
+            self._total += len(blob) - (replaced[0] if replaced else 0)
+            self._db.execute(
+                "INSERT OR REPLACE INTO scan_results VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    archive_sha256,
+                    key[0],
+                    key[1],
+                    scan_errors,
+                    blob,
+                    len(blob),
+                    now,
+                    now,
+                ),
+            )
+            self._evict()
+
+    def _evict(self):
+        # Least recently used entries go first once the cache is over budget,
+        # trimming down to 90% so we are not evicting on every insert.
+        if self._total <= self.max_bytes:
+            return
+        target = int(self.max_bytes * 0.9)
+        rows = self._db.execute(
+            "SELECT archive_sha256, plugin_name, plugin_version, size"
+            " FROM scan_results ORDER BY last_used"
+        ).fetchall()
+        expired = []
+        for archive_sha256, name, version, size in rows:
+            if self._total <= target:
+                break
+            expired.append((archive_sha256, name, version))
+            self._total -= size
+        self._db.executemany(
+            "DELETE FROM scan_results"
+            " WHERE archive_sha256 = ? AND plugin_name = ? AND plugin_version = ?",
+            expired,
+        )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,150 @@
+"""Largest first ordering of the targets, so big packages don't end a run.
+
+Packages are handed to the pipeline in list order by default, and a few big
+sdists near the end of a list leave one worker busy long after the others
+ran out of work.  Size_Scheduler reads the targets a window at a time and
+hands each window on biggest first.  The pipeline's workers take the next
+package as soon as they are free, so the small ones fill in around the big
+ones (longest processing time first scheduling).
+
+How big a package is comes from, in order:
+
+  * the journal of an earlier run (--journal), which has how long the
+    package spent in the pipeline the last time;
+  * the size of its archive in the index (PEP 691 JSON indexes have it),
+    turned into seconds at the rate finished packages have been going;
+  * the median of the other estimates in the window.
+
+The index lookup is the one the download stage would make anyway, the
+fetcher keeps the entry for it.  predicted_seconds() is how long the
+packages read so far should still take, which the metrics files report.
+
+@author u/gatewaynode
+@website https://reddit.com/r/pipsecurity
+"""
+
+import heapq
+import threading
+from statistics import median
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_WINDOW = 256
+
+# Index lookups made at the same time while estimating a window
+DEFAULT_LOOKUPS = 8
+
+# Rate archive bytes are turned into seconds at until packages have finished
+DEFAULT_BYTES_PER_SECOND = 1024**2
+
+# Estimate when nothing else is known
+DEFAULT_SECONDS = 1.0
+
+
+def makespan(costs, workers):
+    # How long `workers` take for all costs, each handing out the biggest
+    # remaining one to whichever worker is free first
+    loads = [0.0] * max(1, workers)
+    for cost in sorted(costs, reverse=True):
+        heapq.heapreplace(loads, loads[0] + cost)
+    return max(loads)
+
+
+class Size_Scheduler:
+    def __init__(
+        self,
+        workers=1,
+        window=DEFAULT_WINDOW,
+        journal=None,
+        lookup=None,
+        lookups=DEFAULT_LOOKUPS,
+    ):
+        # lookup(raw_input) returns the index entry of the archive the
+        # package would be audited from, or raises
+        self.workers = workers
+        self.window = window
+        self.journal = journal
+        self.lookup = lookup
+        self.lookups = lookups
+        self.estimates = {}
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._seconds = 0.0
+
+    def bytes_per_second(self):
+        with self._lock:
+            if self._bytes and self._seconds:
+                return self._bytes / self._seconds
+        return DEFAULT_BYTES_PER_SECOND
+
+    def _estimate(self, raw_input):
+        if self.journal:
+            seconds = self.journal.work_seconds(raw_input)
+            if seconds is not None:
+                return seconds
+        if self.lookup:
+            try:
+                size = self.lookup(raw_input).get("size")
+            except Exception:
+                return None  # The download stage reports it
+            if size:
+                return size / self.bytes_per_second()
+        return None
+
+    def _plan(self, window):
+        if self.lookup and len(window) > 1:
+            with ThreadPoolExecutor(max_workers=self.lookups) as executor:
+                estimates = list(executor.map(self._estimate, window))
+        else:
+            estimates = [self._estimate(raw_input) for raw_input in window]
+        known = [estimate for estimate in estimates if estimate is not None]
+        fallback = median(known) if known else DEFAULT_SECONDS
+        planned = [
+            (fallback if estimate is None else estimate, raw_input)
+            for estimate, raw_input in zip(estimates, window)
+        ]
+        # Stable on ties, so equal packages keep their list order
+        planned.sort(key=lambda item: item[0], reverse=True)
+        with self._lock:
+            for estimate, raw_input in planned:
+                self.estimates[raw_input] = estimate
+        return planned
+
+    def order(
+        self, targets, verbose=False, debug=False, output_json=False, action="Audit"
+    ):
+        # Yields targets biggest first, window by window (the whole list with
+        # a window of 0)
+        targets = iter(targets)
+        while True:
+            window = []
+            for raw_input in targets:
+                window.append(raw_input)
+                if self.window and len(window) >= self.window:
+                    break
+            if not window:
+                return
+            planned = self._plan(window)
+            if verbose and not output_json:
+                print(
+                    f"-> {action} {len(planned)} packages largest first, predicted to finish in {self.predicted_seconds():.0f}s"
+                )
+            for estimate, raw_input in planned:
+                if debug:
+                    print(f"Scheduling {raw_input}, estimated {estimate:.3f}s")
+                yield raw_input
+
+    def finished(self, job):
+        # Takes a finished job out of the prediction and learns from how long
+        # its archive took
+        seconds = sum(job["timings"].values())
+        size = job["package_meta"].get("archive_size")
+        with self._lock:
+            self.estimates.pop(job["raw_input"], None)
+            if size and seconds > 0:
+                self._bytes += size
+                self._seconds += seconds
+
+    def predicted_seconds(self):
+        with self._lock:
+            costs = list(self.estimates.values())
+        return makespan(costs, self.workers)
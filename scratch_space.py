@@ -0,0 +1,142 @@
+"""Per-package scratch directories with cleanup off the critical path.
+
+Every package is downloaded and extracted into its own directory under one
+scratch root (put it on tmpfs, e.g. /dev/shm, to keep the disk out of it
+entirely).  When the package is done the whole directory is renamed into
+the root's trash directory, a single syscall, and a background thread
+deletes it from there, so removing thousands of files never holds up the
+pipeline.
+
+Runs (and --queue workers) can share a root: each one works in a run
+directory of its own under it, holding a lock on the directory's lock file
+for as long as it runs.  Run directories nobody holds the lock of are what
+a run that died left behind, they are moved to the trash and deleted along
+with what is already in there when the next run starts.
+
+With a size budget, extracting a package waits until the packages still
+on scratch (including the ones waiting to be deleted) leave room for it.
+
+@author u/gatewaynode
+@website https://reddit.com/r/pipsecurity
+"""
+
+import os
+import uuid
+import fcntl
+import queue
+import shutil
+import tempfile
+import threading
+
+TRASH_DIR = ".trash"
+
+RUN_PREFIX = "run-"
+LOCK_FILE = ".lock"
+
+
+def _lock_run(run_dir):
+    # The lock file is locked before it gets its name, so a run directory
+    # with a lock file nobody holds is never one that is just starting
+    partial = os.path.join(run_dir, f"{LOCK_FILE}.{uuid.uuid4().hex}")
+    lock = open(partial, "w")
+    fcntl.flock(lock, fcntl.LOCK_EX)
+    os.rename(partial, os.path.join(run_dir, LOCK_FILE))
+    return lock
+
+
+def _abandoned(run_dir):
+    try:
+        lock = open(os.path.join(run_dir, LOCK_FILE))
+    except OSError:
+        return False  # Starting up, or not a run directory
+    with lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return False
+        return True
+
+
+class Scratch_Space:
+    def __init__(self, root, max_bytes=None):
+        self.root = root
+        self.trash = os.path.join(root, TRASH_DIR)
+        self.max_bytes = max_bytes
+        self._used = 0
+        self._sizes = {}
+        self._condition = threading.Condition()
+        self._doomed = queue.Queue()
+        os.makedirs(self.trash, exist_ok=True)
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name.startswith(RUN_PREFIX) and _abandoned(path):
+                try:
+                    os.rename(path, self._trash_path(name))
+                except FileNotFoundError:
+                    pass  # Another run starting up got to it first
+        self.run_dir = tempfile.mkdtemp(prefix=RUN_PREFIX, dir=self.root)
+        self._run_lock = _lock_run(self.run_dir)
+        for name in os.listdir(self.trash):
+            self._doomed.put((os.path.join(self.trash, name), 0))
+        self._deleter = threading.Thread(target=self._delete_loop, daemon=True)
+        self._deleter.start()
+
+    def create(self, name):
+        return tempfile.mkdtemp(prefix=f"{name}-", dir=self.run_dir)
+
+    def reserve(self, path, size):
+        # Blocks until size more bytes fit in the budget.  A package bigger
+        # than the whole budget still gets to run, once it has scratch alone.
+        with self._condition:
+            while self.max_bytes and self._used and self._used + size > self.max_bytes:
+                self._condition.wait()
+            self._used += size
+            self._sizes[path] = self._sizes.get(path, 0) + size
+
+    def _trash_path(self, name):
+        return os.path.join(self.trash, f"{name}.{uuid.uuid4().hex}")
+
+    def drop(self, path):
+        with self._condition:
+            size = self._sizes.pop(path, 0)
+        doomed = self._trash_path(os.path.basename(path))
+        try:
+            os.rename(path, doomed)
+        except FileNotFoundError:
+            doomed = None
+        except OSError:
+            # Not on the scratch filesystem, delete it where it is
+            doomed = path
+        self._doomed.put((doomed, size))
+
+    def _delete_loop(self):
+        while True:
+            item = self._doomed.get()
+            if item is None:
+                break
+            path, size = item
+            if path and os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path, ignore_errors=True)
+            elif path:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            with self._condition:
+                self._used -= size
+                self._condition.notify_all()
+
+    def close(self):
+        # Waits for everything dropped so far to be deleted
+        self._doomed.put(None)
+        self._deleter.join()
+        # Left with just its lock file, unless something was never dropped.
+        # Should that not go either the lock is released all the same, so
+        # the next run takes care of it.
+        self._run_lock.close()
+        shutil.rmtree(self.run_dir, ignore_errors=True)
+        for directory in (self.trash, self.root):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                pass  # Still in use, e.g. by another run
@@ -52,3 +52,13 @@ def top5000():
     inventory = list(project["project"] for project in inventory_list["rows"])
     with open("top5000_list.json", "w", encoding="utf-8") as file:
         json.dump(inventory, file, ensure_ascii=False, indent=4)
+
+
+@task
+def typosweep():
+    run("python typo_sweep.py -v -m mega_list.json -t top5000_list.json")
+
+
+@task
+def benchmark():
+    run("python benchmark.py -v")
@@ -0,0 +1,42 @@
+import pytest
+import sys
+
+# Support importing archive_store as an absolute import
+from pathlib import Path
+
+file = Path(__file__).resolve()
+parent, root = file.parent, file.parents[1]
+sys.path.append(str(root))
+
+# Additionally remove the current file's directory from sys.path
+try:
+    sys.path.remove(str(parent))
+except ValueError:  # Already removed
+    pass
+
+from archive_store import Archive_Store as app
+
+
+def _archive(tmp_path, name, data):
+    path = tmp_path / name
+    path.write_bytes(data)
+    return str(path)
+
+
+def test_store_finds_by_hash_or_url(tmp_path):
+    store = app(str(tmp_path / "store"))
+    store.add(_archive(tmp_path, "a.tar.gz", b"a" * 10), "aa" * 32, "https://x/a")
+    assert store.find("aa" * 32) == "aa" * 32
+    assert store.find(None, "https://x/a") == "aa" * 32
+    assert store.find("bb" * 32) is None
+    assert store.link("aa" * 32, str(tmp_path / "scratch" / "a.tar.gz"))
+    assert (tmp_path / "scratch" / "a.tar.gz").read_bytes() == b"a" * 10
+
+
+def test_store_evicts_least_recently_used(tmp_path):
+    store = app(str(tmp_path / "store"), max_bytes=150)
+    store.add(_archive(tmp_path, "old", b"o" * 100), "00" * 32)
+    store.add(_archive(tmp_path, "new", b"n" * 100), "11" * 32)
+    assert store.find("00" * 32) is None
+    assert not Path(store.path("00" * 32)).exists()
+    assert store.find("11" * 32) == "11" * 32
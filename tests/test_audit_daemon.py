@@ -0,0 +1,78 @@
+import pytest
+import sys
+import socket
+import threading
+
+# Support importing audit_daemon as an absolute import
+from pathlib import Path
+
+file = Path(__file__).resolve()
+parent, root = file.parent, file.parents[1]
+sys.path.append(str(root))
+
+# Additionally remove the current file's directory from sys.path
+try:
+    sys.path.remove(str(parent))
+except ValueError:  # Already removed
+    pass
+
+from audit_daemon import Audit_Daemon as app
+from audit_daemon import audit, request, Daemon_Error
+
+
+def _pipeline(daemon, report_root):
+    # Stands in for the real pipeline: every package gets one report file
+    for raw_input in daemon.targets():
+        scratch_dir = report_root / raw_input
+        scratch_dir.mkdir(exist_ok=True)
+        (scratch_dir / f"detect_secrets_{raw_input}.json").write_text('{"results": {}}')
+        (scratch_dir / "setup.py").write_text("")
+        daemon.finished(
+            {
+                "raw_input": raw_input,
+                "scratch_dir": str(scratch_dir),
+                "package_meta": {"version": "1.0", "archive_file_list": ["setup.py"]},
+                "scan_errors": int(raw_input == "bad"),
+                "timings": {"scan": 0.1},
+                "plugin_timings": {},
+            }
+        )
+
+
+def test_packages_are_audited_for_the_client_that_asked(tmp_path):
+    address = str(tmp_path / "daemon.sock")
+    daemon = app(address)
+    daemon.start(["Detect Secrets Scan"])
+    pipeline = threading.Thread(target=_pipeline, args=(daemon, tmp_path))
+    pipeline.start()
+
+    results = audit(address, ["six", "bad", "six"])
+    assert [result["package"] for result in results] == ["six", "bad", "six"]
+    assert [result["scan_errors"] for result in results] == [0, 1, 0]
+    assert results[0]["reports"] == {"detect_secrets_six.json": {"results": {}}}
+    assert request(address, "GET", "/health")[1]["audited"] == 3
+    with pytest.raises(Daemon_Error):
+        audit(address, [""])
+
+    # As from a signal handler interrupting the main thread in finished()
+    with daemon._lock:
+        daemon.stop()
+    pipeline.join()
+    daemon.close()
+    assert not Path(address).exists()
+
+
+def test_a_live_socket_is_not_taken_over(tmp_path):
+    address = str(tmp_path / "daemon.sock")
+    first = app(address)
+    first.start()
+    with pytest.raises(Daemon_Error):
+        app(address).start()
+    first.close()
+    # Left behind by a daemon that died, so it is replaced
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(address)
+    stale.close()
+    second = app(address)
+    second.start()
+    second.close()
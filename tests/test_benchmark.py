@@ -0,0 +1,52 @@
+import pytest
+import sys
+
+# Support importing benchmark as an absolute import
+from pathlib import Path
+
+file = Path(__file__).resolve()
+parent, root = file.parent, file.parents[1]
+sys.path.append(str(root))
+
+# Additionally remove the current file's directory from sys.path
+try:
+    sys.path.remove(str(parent))
+except ValueError:  # Already removed
+    pass
+
+from benchmark import generate_corpus as app
+from benchmark import compare
+from pip_audit import _iter_archive_members
+from pypi_fetcher import Package_Fetcher
+
+
+def test_corpus_served_from_local_index(tmp_path):
+    corpus = (
+        ("bench-many", "sdist", 50, 100, 5000, 0),
+        ("bench-wheel", "wheel", 3, 100, 0, 2000),
+    )
+    names = app(str(tmp_path), corpus=corpus)
+    assert names == ["bench-many", "bench-wheel"]
+
+    fetcher = Package_Fetcher(str(tmp_path / "simple"))
+    sdist = fetcher.fetch("bench-many", str(tmp_path / "out"))
+    assert sdist["hash_verified"]
+    members = dict(_iter_archive_members(sdist["path"]))
+    assert len(members) == 52  # modules, setup.py and PKG-INFO
+    assert len(members["bench-many-1.0.0/setup.py"]) >= 5000
+
+    wheel = fetcher.fetch("bench-wheel", str(tmp_path / "out"))
+    assert wheel["path"].endswith(".whl")
+    assert any(
+        name.endswith("vendored.json")
+        for name in dict(_iter_archive_members(wheel["path"]))
+    )
+
+
+def test_compare_flags_regressions():
+    baseline = {"process_seconds": 10.0, "stages": {"scan": 8.0}, "plugins": {}}
+    current = {"process_seconds": 10.5, "stages": {"scan": 9.5}, "plugins": {}}
+    assert compare(baseline, current, tolerance=0.1) == [
+        ("process", 10.0, 10.5, False),
+        ("scan", 8.0, 9.5, True),
+    ]
@@ -0,0 +1,58 @@
+import pytest
+import sys
+
+# Support importing package_names as an absolute import
+from pathlib import Path
+
+file = Path(__file__).resolve()
+parent, root = file.parent, file.parents[1]
+sys.path.append(str(root))
+
+# Additionally remove the current file's directory from sys.path
+try:
+    sys.path.remove(str(parent))
+except ValueError:  # Already removed
+    pass
+
+from package_names import resolve as app
+from package_names import read_tree
+
+SETUP_PY = b"""
+from setuptools import setup
+NAME = "reqeusts"
+setup(
+    # A comment with a ) in it
+    name=NAME,
+    version=".".join(str(part) for part in (1, 0)),
+    install_requires=["six (>=1.0)"],
+)
+"""
+
+
+def test_metadata_wins_over_setup_py():
+    resolved = app(
+        [
+            ("pkg-1.0/PKG-INFO", b"Metadata-Version: 2.1\nName: pkg\nVersion: 1.0\n"),
+            ("pkg-1.0/setup.py", SETUP_PY),
+            # Vendored packages' metadata is not the package's name
+            ("pkg-1.0/pkg/_vendor/six.egg-info/PKG-INFO", b"Name: six\n"),
+        ],
+        ["pkg-1.0"],
+    )
+    assert resolved["names"] == ["pkg"]
+    assert resolved["source"] == "metadata"
+    assert not resolved["warnings"]
+
+
+def test_setup_py_is_parsed_not_pattern_matched():
+    resolved = app([("pkg-1.0/setup.py", SETUP_PY)], ["pkg-1.0"])
+    assert resolved["names"] == ["reqeusts"]
+    assert (resolved["source"], resolved["suspicious"]) == ("setup.py", 0)
+
+
+def test_unreadable_setup_py_falls_back_to_the_directory(tmp_path):
+    (tmp_path / "pkg-1.0").mkdir()
+    (tmp_path / "pkg-1.0" / "setup.py").write_text("print 'python 2'\n")
+    resolved = app(read_tree(str(tmp_path)), ["pkg-1.0"])
+    assert resolved["names"] == ["pkg-1.0"]
+    assert resolved["suspicious"] == 1
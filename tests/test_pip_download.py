@@ -1,5 +1,8 @@
 import pytest
 import sys
+import io
+import hashlib
+import tarfile
 
 # Support importing pip_audit as an absolute import
 from pathlib import Path
@@ -15,25 +18,80 @@ except ValueError:  # Already removed
     pass
 
 from pip_audit import _pip_download as app
+from pypi_fetcher import Package_Fetcher
+from archive_store import Archive_Store
 
 
-def test_pip_download_error():
+def _local_index(tmp_path, sha256=None, store=None):
+    # A one package simple index laid out the way PEP 503 describes it
+    archive = tmp_path / "packages" / "six-1.16.0.tar.gz"
+    archive.parent.mkdir()
+    with tarfile.open(archive, "w:gz") as tar:
+        data = b"print('six')\n"
+        info = tarfile.TarInfo("six-1.16.0/six.py")
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+    sha256 = sha256 or hashlib.sha256(archive.read_bytes()).hexdigest()
+    project = tmp_path / "simple" / "six"
+    project.mkdir(parents=True)
+    (project / "index.html").write_text(
+        f'<a href="../../packages/six-1.15.0.tar.gz">six-1.15.0.tar.gz</a>\n'
+        f'<a href="../../packages/six-1.16.0.tar.gz#sha256={sha256}">six-1.16.0.tar.gz</a>\n'
+    )
+    return Package_Fetcher(str(tmp_path / "simple"), store=store)
+
+
+def test_pip_download_error(tmp_path):
     output = app(
         raw_input="no_such_package",
-        output_dir="local_files",
+        output_dir=str(tmp_path / "out"),
         verbose=False,
         debug=False,
         output_json=False,
+        fetcher=_local_index(tmp_path),
     )
-    assert output.stderr
+    assert output is False
 
 
-def test_pip_download_success():
+def test_pip_download_success(tmp_path):
     output = app(
         raw_input="six",
-        output_dir="local_files",
+        output_dir=str(tmp_path / "out"),
         verbose=False,
         debug=False,
         output_json=False,
+        fetcher=_local_index(tmp_path),
+    )
+    assert output["file_name"] == "six-1.16.0.tar.gz"
+    assert output["hash_verified"]
+    assert Path(output["path"]).stat().st_size == output["size"]
+
+
+def test_pip_download_hash_mismatch(tmp_path):
+    output = app(
+        raw_input="six",
+        output_dir=str(tmp_path / "out"),
+        fetcher=_local_index(tmp_path, sha256="0" * 64),
     )
-    assert "Saved" in output.stdout.decode("utf-8")
+    assert output is False
+    assert not list((tmp_path / "out").iterdir())
+
+
+def test_pip_download_reuses_archive_store(tmp_path):
+    store = Archive_Store(str(tmp_path / "store"))
+    fetcher = _local_index(tmp_path, store=store)
+    first = app(raw_input="six", output_dir=str(tmp_path / "one"), fetcher=fetcher)
+    assert first["source"] == "index"
+    # Gone from the index, a second run must not need it
+    (tmp_path / "packages" / "six-1.16.0.tar.gz").unlink()
+    second = app(raw_input="six", output_dir=str(tmp_path / "two"), fetcher=fetcher)
+    assert second["source"] == "store"
+    assert second["sha256"] == first["sha256"]
+    assert Path(second["path"]).read_bytes() == Path(first["path"]).read_bytes()
+
+
+def test_pip_download_reuses_saved_file(tmp_path):
+    fetcher = _local_index(tmp_path)
+    first = app(raw_input="six", output_dir=str(tmp_path / "out"), fetcher=fetcher)
+    second = app(raw_input="six", output_dir=str(tmp_path / "out"), fetcher=fetcher)
+    assert (first["source"], second["source"]) == ("index", "output_dir")
@@ -0,0 +1,82 @@
+import pytest
+import sys
+import threading
+
+# Support importing pip_audit as an absolute import
+from pathlib import Path
+
+file = Path(__file__).resolve()
+parent, root = file.parent, file.parents[1]
+sys.path.append(str(root))
+
+# Additionally remove the current file's directory from sys.path
+try:
+    sys.path.remove(str(parent))
+except ValueError:  # Already removed
+    pass
+
+from pip_audit import _run_pipeline as app
+from pip_audit import _scan_stage
+from plugin_api import Scan_Plugin
+from scan_cache import Scan_Cache
+
+
+def _fail_odd(job):
+    if int(job["raw_input"]) % 2:
+        job["scan_errors"] += 1
+        job["skip"] = True
+
+
+def _count(job):
+    job["scan_errors"] += 10
+
+
+def test_pipeline_error_tally():
+    stages = [(_fail_odd, 3, False), (_count, 2, False), (lambda job: None, 1, True)]
+    jobs = list(app([str(n) for n in range(20)], stages, "local_files", 2))
+    assert len(jobs) == 20
+    assert sum(job["scan_errors"] for job in jobs) == 10 * 1 + 10 * 10
+
+
+def test_pipeline_scratch_dirs_are_unique():
+    # Hold all three jobs inside the stage at once so they are in flight together
+    barrier = threading.Barrier(3, timeout=5)
+    stages = [(lambda job: barrier.wait(), 3, False)]
+    jobs = list(app(["six", "six", "six"], stages, "local_files", 3))
+    assert len(set(job["scratch_dir"] for job in jobs)) == 3
+
+
+class Flaky_Plugin(Scan_Plugin):
+    def __init__(self):
+        super().__init__()
+        self.responses = [1, 0]
+
+    def scan_request(self, request):
+        return self.responses.pop(0)
+
+
+class Plugin_Info:
+    name = "Flaky Scan"
+    version = "0.1"
+
+    def __init__(self):
+        self.plugin_object = Flaky_Plugin()
+
+
+def test_failed_scans_are_not_cached(tmp_path):
+    plugin = Plugin_Info()
+    cache = Scan_Cache(str(tmp_path / "cache.db"))
+    for expected in (1, 0, 0):
+        job = {
+            "raw_input": "six",
+            "scan_list": ["six"],
+            "package_meta": {"archive_sha256": "abc"},
+            "scratch_dir": str(tmp_path / "six"),
+            "work_dir": str(tmp_path / "six"),
+            "scan_errors": 0,
+            "plugin_timings": {},
+        }
+        _scan_stage(job, [plugin], cache=cache)
+        assert job["scan_errors"] == expected
+    # Rerun after the failure, then served from the cache
+    assert plugin.plugin_object.responses == []
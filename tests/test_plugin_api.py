@@ -0,0 +1,81 @@
+import pytest
+import sys
+import threading
+
+# Support importing plugin_api as an absolute import
+from pathlib import Path
+
+file = Path(__file__).resolve()
+parent, root = file.parent, file.parents[1]
+sys.path.append(str(root))
+
+# Additionally remove the current file's directory from sys.path
+try:
+    sys.path.remove(str(parent))
+except ValueError:  # Already removed
+    pass
+
+from plugin_api import Plugin_Runner as app
+from plugin_api import Scan_Plugin, IO_BOUND, adapt, scan_request
+
+
+class Counting_Plugin(Scan_Plugin):
+    batch_size = 3
+
+    def __init__(self):
+        super().__init__()
+        self.batches = []
+
+    def scan_batch(self, requests):
+        self.batches.append(len(requests))
+        return [len(request["scan_list"]) for request in requests]
+
+
+class Old_Plugin:
+    resource_class = IO_BOUND
+
+    def scan(
+        self, scan_list, package_meta, output_dir, verbose, debug, output_json, **kwargs
+    ):
+        return len(scan_list) + (kwargs["only_files"] is not None)
+
+
+def test_runner_batches_concurrent_packages():
+    plugin = Counting_Plugin()
+    runner = app({"count": plugin}, max_batch=3, batch_wait=5)
+    futures = [
+        runner.submit("count", scan_request(["a"] * number, {}, "out"))
+        for number in range(3)
+    ]
+    assert [future.result() for future in futures] == [0, 1, 2]
+    assert plugin.batches == [3]
+    # A lone package does not wait for company forever
+    runner = app({"count": plugin}, max_batch=3, batch_wait=0.01)
+    assert runner.submit("count", scan_request(["a"], {}, "out")).result() == 1
+    runner.close()
+
+
+def test_runner_refuses_plugins_that_do_not_scan():
+    class Empty_Plugin(Scan_Plugin):
+        pass
+
+    class One_At_A_Time_Plugin(Scan_Plugin):
+        def scan_request(self, request):
+            return len(request["scan_list"])
+
+    with pytest.raises(TypeError):
+        app({"empty": Empty_Plugin()})
+    with pytest.raises(TypeError):
+        Empty_Plugin().scan(["a"], {}, "out")
+    runner = app({"one": One_At_A_Time_Plugin()})
+    assert runner.submit("one", scan_request(["a", "b"], {}, "out")).result() == 2
+    runner.close()
+
+
+def test_old_plugins_run_through_the_adapter():
+    plugin = adapt(Old_Plugin())
+    assert plugin.resource_class == IO_BOUND and plugin.needs_filesystem
+    runner = app({"old": plugin})
+    request = scan_request(["a", "b"], {}, "out", only_files={"a/x.py"})
+    assert runner.submit("old", request).result() == 3
+    runner.close()
@@ -0,0 +1,73 @@
+import pytest
+import sys
+import time
+import threading
+import requests
+
+# Support importing prefetcher as an absolute import
+from pathlib import Path
+
+file = Path(__file__).resolve()
+parent, root = file.parent, file.parents[1]
+sys.path.append(str(root))
+
+# Additionally remove the current file's directory from sys.path
+try:
+    sys.path.remove(str(parent))
+except ValueError:  # Already removed
+    pass
+
+from prefetcher import Prefetcher as app
+
+
+class Flaky_Fetcher:
+    # Every download fails once with a connection error, then takes a moment
+    index_url = "https://index.example/simple/"
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.attempts = {}
+        self.running = 0
+        self.most_running = 0
+
+    def resolve(self, project):
+        return {"url": f"https://files.example/{project}.tar.gz", "project": project}
+
+    def download(self, entry, output_dir, saved_dir=None):
+        with self.lock:
+            self.attempts[entry["project"]] = self.attempts.get(entry["project"], 0) + 1
+            if self.attempts[entry["project"]] == 1:
+                raise requests.ConnectionError("reset by peer")
+            self.running += 1
+            self.most_running = max(self.most_running, self.running)
+        time.sleep(0.02)
+        with self.lock:
+            self.running -= 1
+        return {"size": 10, "project": entry["project"]}
+
+
+def _fetch_job(job, fetcher):
+    job["output"] = fetcher.fetch(job["raw_input"], "unused")
+
+
+def test_prefetch_keeps_order_retries_and_limits_hosts():
+    fetcher = Flaky_Fetcher()
+    prefetcher = app(fetcher, prefetch=6, per_host=2, retries=2, backoff=0)
+    jobs = [
+        {"raw_input": f"package{number}", "scan_errors": 0, "skip": False}
+        for number in range(12)
+    ]
+    done = list(prefetcher.run(jobs, _fetch_job))
+
+    assert [job["raw_input"] for job in done] == [job["raw_input"] for job in jobs]
+    assert all(job["output"]["size"] == 10 and not job["skip"] for job in done)
+    assert set(fetcher.attempts.values()) == {2}
+    assert fetcher.most_running <= 2
+
+
+def test_prefetch_gives_up_after_retries():
+    fetcher = Flaky_Fetcher()
+    prefetcher = app(fetcher, prefetch=2, retries=0, backoff=0)
+    job = {"raw_input": "package", "scan_errors": 0, "skip": False}
+    assert list(prefetcher.run([job], _fetch_job)) == [job]
+    assert job["skip"] and job["scan_errors"] == 1
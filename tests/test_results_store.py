@@ -0,0 +1,73 @@
+import pytest
+import sys
+
+# Support importing results_store as an absolute import
+from pathlib import Path
+
+file = Path(__file__).resolve()
+parent, root = file.parent, file.parents[1]
+sys.path.append(str(root))
+
+# Additionally remove the current file's directory from sys.path
+try:
+    sys.path.remove(str(parent))
+except ValueError:  # Already removed
+    pass
+
+from results_store import Results_Store as app
+
+
+def test_findings_written_in_batches(tmp_path):
+    store = app(str(tmp_path / "results.db"), batch_size=3, flush_seconds=3600)
+    package = ("leaky", "1.0", "abc")
+    store.add(package, ("Bandit Scan", "0.2"), 0, [])
+    assert not store.due()
+    store.add(
+        package,
+        ("Bandit Scan", "0.2"),
+        1,
+        [
+            ("leaky-1.0", {"severity": "HIGH", "file": "a.py", "line": 3}),
+            ("leaky-1.0", {"severity": "LOW", "details": {"test_id": "B404"}}),
+        ],
+    )
+    assert store.due()
+    store.flush()
+    store.add(package, ("Detect Secrets Scan", "0.2"), 0, [("leaky-1.0", {})])
+    store.close()
+
+    reopened = app(str(tmp_path / "results.db"))
+    assert reopened._db.execute(
+        "SELECT package, file, line FROM findings"
+        " WHERE plugin = 'Bandit Scan' AND severity = 'HIGH'"
+    ).fetchall() == [("leaky", "a.py", 3)]
+    assert reopened._db.execute(
+        "SELECT plugin, scan_errors, findings FROM scans ORDER BY rowid"
+    ).fetchall() == [
+        ("Bandit Scan", 0, 0),
+        ("Bandit Scan", 1, 2),
+        ("Detect Secrets Scan", 0, 1),
+    ]
+
+
+def test_previous_release_and_its_findings(tmp_path):
+    store = app(str(tmp_path / "results.db"))
+    old = ("leaky", "1.0", "abc")
+    store.add_manifest(old, {"leaky/a.py": "1", "setup.py": "2"})
+    store.add(old, ("Bandit Scan", "0.2"), 0, [("leaky-1.0", {"file": "a.py"})])
+    store.add(old, ("Detect Secrets Scan", "0.2"), 1, [])
+    store.flush()
+
+    assert store.previous_release("leaky", "def") == (
+        "1.0",
+        "abc",
+        {"leaky/a.py": "1", "setup.py": "2"},
+    )
+    assert store.previous_release("leaky", "abc") is None
+    findings = store.findings_of("abc", ("Bandit Scan", "0.2"))
+    assert [(target, finding["file"]) for target, finding in findings] == [
+        ("leaky-1.0", "a.py")
+    ]
+    # Only clean runs of the same plugin version can be built on
+    assert store.findings_of("abc", ("Bandit Scan", "0.3")) is None
+    assert store.findings_of("abc", ("Detect Secrets Scan", "0.2")) is None
@@ -0,0 +1,39 @@
+import pytest
+import sys
+
+# Support importing run_journal as an absolute import
+from pathlib import Path
+
+file = Path(__file__).resolve()
+parent, root = file.parent, file.parents[1]
+sys.path.append(str(root))
+
+# Additionally remove the current file's directory from sys.path
+try:
+    sys.path.remove(str(parent))
+except ValueError:  # Already removed
+    pass
+
+from run_journal import Run_Journal as app
+
+
+def test_resume_skips_done_and_caps_retries(tmp_path):
+    journal = app(str(tmp_path / "journal.db"))
+    journal.start("six")
+    journal.finish("six", 0)
+    journal.start("broken")
+    journal.finish("broken", 1)
+    journal.start("killed")  # Run died before it finished
+    journal.close()
+
+    journal = app(str(tmp_path / "journal.db"))
+    assert not journal.should_run("six", max_attempts=2)
+    assert journal.should_run("broken", max_attempts=2)
+    assert journal.should_run("killed", max_attempts=2)
+    assert journal.should_run("never_seen", max_attempts=2)
+
+    journal.start("broken")
+    journal.finish("broken", 1)
+    assert journal.status("broken") == ("failed", 2)
+    assert not journal.should_run("broken", max_attempts=2)
+    assert journal.summary() == {"done": 1, "failed": 1, "running": 1}
@@ -0,0 +1,56 @@
+import pytest
+import sys
+
+# Support importing run_metrics as an absolute import
+from pathlib import Path
+
+file = Path(__file__).resolve()
+parent, root = file.parent, file.parents[1]
+sys.path.append(str(root))
+
+# Additionally remove the current file's directory from sys.path
+try:
+    sys.path.remove(str(parent))
+except ValueError:  # Already removed
+    pass
+
+from run_metrics import Run_Metrics as app
+from run_metrics import Histogram, SECONDS_BUCKETS
+
+
+def test_histogram_percentiles_close_to_exact():
+    histogram = Histogram(SECONDS_BUCKETS)
+    values = [number / 100 for number in range(1, 1001)]  # 0.01s to 10s
+    for value in values:
+        histogram.observe(value)
+    assert histogram.quantile(0.5) == pytest.approx(5.0, rel=0.1)
+    assert histogram.quantile(0.95) == pytest.approx(9.5, rel=0.1)
+    assert histogram.quantile(1.0) == 10.0
+
+    single = Histogram(SECONDS_BUCKETS)
+    single.observe(0.3)
+    assert single.quantile(0.5) == pytest.approx(0.3)
+
+
+def test_metrics_export(tmp_path):
+    metrics = app()
+    for seconds in (0.2, 3.0):
+        metrics.add_job(
+            {
+                "scan_errors": 1,
+                "package_meta": {"archive_size": 2048, "total_package_files": 12},
+                "timings": {"download": seconds, "scan": seconds * 2},
+                "plugin_timings": {"Bandit Scan": seconds},
+            }
+        )
+    metrics.write(str(tmp_path / "m.json"), str(tmp_path / "m.prom"))
+
+    summary = metrics.summary()
+    assert summary["packages"] == 2 and summary["scan_errors"] == 2
+    assert summary["plugins"]["Bandit Scan"]["max"] == 3.0
+    text = (tmp_path / "m.prom").read_text()
+    assert 'pip_audit_stage_seconds_bucket{stage="download",le="0.25"} 1' in text
+    assert 'pip_audit_stage_seconds_bucket{stage="download",le="+Inf"} 2' in text
+    assert 'pip_audit_plugin_seconds_count{plugin="Bandit Scan"} 2' in text
+    assert "pip_audit_archive_bytes_count 2" in text
+    assert (tmp_path / "m.json").exists()
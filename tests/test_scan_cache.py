@@ -0,0 +1,55 @@
+import pytest
+import sys
+
+# Support importing scan_cache as an absolute import
+from pathlib import Path
+
+file = Path(__file__).resolve()
+parent, root = file.parent, file.parents[1]
+sys.path.append(str(root))
+
+# Additionally remove the current file's directory from sys.path
+try:
+    sys.path.remove(str(parent))
+except ValueError:  # Already removed
+    pass
+
+from scan_cache import Scan_Cache as app
+from scan_cache import plugin_key
+
+
+def test_cache_hit_per_plugin_version(tmp_path):
+    cache = app(str(tmp_path / "cache.db"))
+    cache.store("abc", ("Bandit Scan", "0.1"), 2, {"bandit_scan_six.txt": b"ok"})
+    hits = cache.lookup("abc", [("Bandit Scan", "0.1"), ("Bandit Scan", "0.2")])
+    assert hits == {("Bandit Scan", "0.1"): (2, {"bandit_scan_six.txt": b"ok"})}
+    assert cache.lookup(None, [("Bandit Scan", "0.1")]) == {}
+
+
+def test_cache_evicts_least_recently_used(tmp_path):
+    cache = app(str(tmp_path / "cache.db"), max_bytes=1)
+    cache.store("old", ("Bandit Scan", "0.1"), 0, {"a": b"a" * 100})
+    cache.store("new", ("Bandit Scan", "0.1"), 0, {"b": b"b" * 100})
+    assert not cache.lookup("old", [("Bandit Scan", "0.1")])
+
+
+class Tagged_Plugin:
+    tag = "aaaa"
+
+    def cache_tag(self):
+        return self.tag
+
+
+class Plugin_Info:
+    name = "Typo-squatting Scan"
+    version = "0.2"
+    plugin_object = Tagged_Plugin()
+
+
+def test_plugin_key_follows_the_plugins_data():
+    plugin = Plugin_Info()
+    assert plugin_key(plugin) == ("Typo-squatting Scan", "0.2+aaaa")
+    plugin.plugin_object.tag = "bbbb"
+    assert plugin_key(plugin) == ("Typo-squatting Scan", "0.2+bbbb")
+    plugin.plugin_object.tag = None
+    assert plugin_key(plugin) == ("Typo-squatting Scan", "0.2")
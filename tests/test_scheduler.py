@@ -0,0 +1,60 @@
+import pytest
+import sys
+
+# Support importing scheduler as an absolute import
+from pathlib import Path
+
+file = Path(__file__).resolve()
+parent, root = file.parent, file.parents[1]
+sys.path.append(str(root))
+
+# Additionally remove the current file's directory from sys.path
+try:
+    sys.path.remove(str(parent))
+except ValueError:  # Already removed
+    pass
+
+from scheduler import Size_Scheduler as app
+from scheduler import makespan, DEFAULT_BYTES_PER_SECOND
+from run_journal import Run_Journal
+
+
+def test_windows_are_ordered_largest_first():
+    sizes = {"a": 10, "b": 3000, "c": 200, "d": 5000, "e": 1}
+
+    def lookup(raw_input):
+        if raw_input == "missing":
+            raise LookupError(raw_input)
+        return {"size": sizes[raw_input]}
+
+    scheduler = app(window=3, lookup=lookup)
+    targets = ["a", "b", "c", "d", "missing", "e"]
+    assert list(scheduler.order(targets)) == ["b", "c", "a", "d", "missing", "e"]
+    # The unknown package got the median of its window
+    assert scheduler.estimates["missing"] == 2500.5 / DEFAULT_BYTES_PER_SECOND
+
+
+def test_journal_times_come_before_sizes(tmp_path):
+    journal = Run_Journal(str(tmp_path / "journal.db"))
+    journal.start("small")
+    journal.finish("small", 0, work_seconds=30.0)
+    scheduler = app(journal=journal, lookup=lambda raw_input: {"size": 1000})
+    assert list(scheduler.order(["big", "small"])) == ["small", "big"]
+    assert scheduler.estimates["small"] == 30.0
+
+
+def test_prediction_follows_finished_packages():
+    assert makespan([7, 5, 4, 3, 3], 2) == 12
+    assert makespan([], 4) == 0
+    scheduler = app(workers=2, window=0, lookup=lambda raw_input: {"size": 100})
+    list(scheduler.order(["a", "b", "c"]))
+    assert scheduler.predicted_seconds() == 200 / DEFAULT_BYTES_PER_SECOND
+    scheduler.finished(
+        {
+            "raw_input": "a",
+            "timings": {"download": 1.0, "scan": 1.0},
+            "package_meta": {"archive_size": 100},
+        }
+    )
+    assert scheduler.bytes_per_second() == 50
+    assert scheduler.predicted_seconds() == 100 / DEFAULT_BYTES_PER_SECOND
@@ -0,0 +1,73 @@
+import pytest
+import sys
+import threading
+
+# Support importing scratch_space as an absolute import
+from pathlib import Path
+
+file = Path(__file__).resolve()
+parent, root = file.parent, file.parents[1]
+sys.path.append(str(root))
+
+# Additionally remove the current file's directory from sys.path
+try:
+    sys.path.remove(str(parent))
+except ValueError:  # Already removed
+    pass
+
+from scratch_space import Scratch_Space as app
+
+
+def test_scratch_drop_is_deleted_in_background(tmp_path):
+    scratch = app(str(tmp_path / "scratch"))
+    work_dir = Path(scratch.create("six"))
+    (work_dir / "six-1.16.0").mkdir()
+    (work_dir / "six-1.16.0" / "six.py").write_text("print('six')\n")
+    scratch.drop(str(work_dir))
+    assert not work_dir.exists()
+    scratch.close()
+    assert not (tmp_path / "scratch").exists()
+
+
+def test_scratch_budget_waits_for_room(tmp_path):
+    scratch = app(str(tmp_path / "scratch"), max_bytes=100)
+    first = scratch.create("first")
+    scratch.reserve(first, 80)
+    second = scratch.create("second")
+    reserved = threading.Event()
+    waiter = threading.Thread(
+        target=lambda: (scratch.reserve(second, 80), reserved.set())
+    )
+    waiter.start()
+    assert not reserved.wait(0.2)
+    scratch.drop(first)
+    assert reserved.wait(5)
+    waiter.join()
+    scratch.close()
+
+
+def test_scratch_left_by_a_dead_run_is_deleted(tmp_path):
+    root = tmp_path / "scratch"
+    dead = root / "run-dead"
+    (dead / "six-abc" / "six-1.16.0").mkdir(parents=True)
+    (dead / "six-abc" / "six-1.16.0" / "six.py").write_text("print('six')\n")
+    (dead / "six-1.16.0.tar.gz").write_text("partial")
+    (dead / ".lock").write_text("")
+    (root / ".trash" / "idna-def.0123").mkdir(parents=True)
+    scratch = app(str(root))
+    assert not dead.exists()
+    scratch.close()
+    assert not root.exists()
+
+
+def test_scratch_of_a_live_run_is_left_alone(tmp_path):
+    first = app(str(tmp_path / "scratch"))
+    work_dir = Path(first.create("six"))
+    second = app(str(tmp_path / "scratch"))
+    assert work_dir.exists()
+    assert Path(second.create("six")).parent != work_dir.parent
+    second.close()
+    assert work_dir.exists()
+    first.drop(str(work_dir))
+    first.close()
+    assert not (tmp_path / "scratch").exists()
@@ -0,0 +1,45 @@
+import pytest
+import io
+import json
+import sys
+
+# Support importing pip_audit as an absolute import
+from pathlib import Path
+
+file = Path(__file__).resolve()
+parent, root = file.parent, file.parents[1]
+sys.path.append(str(root))
+
+# Additionally remove the current file's directory from sys.path
+try:
+    sys.path.remove(str(parent))
+except ValueError:  # Already removed
+    pass
+
+from pip_audit import _iter_targets as app
+from pip_audit import _iter_json_array, _in_shard
+
+
+def test_json_list_and_jsonl_give_the_same_targets(tmp_path):
+    names = json.load(open(Path(parent, "simple_list.json")))
+    jsonl = tmp_path / "list.jsonl"
+    jsonl.write_text(
+        "\n".join(json.dumps(name) if i % 2 else name for i, name in enumerate(names))
+    )
+    assert list(app(str(Path(parent, "simple_list.json")))) == names
+    assert list(app(str(jsonl))) == names
+
+
+def test_json_list_read_in_small_chunks():
+    items = ["six", 12345, {"project": "requests"}, "urllib3", 6.5, None]
+    text = json.dumps(items, indent=4)
+    parsed = list(_iter_json_array(io.StringIO(text[1:]), "[", chunk_size=3))
+    assert parsed == items
+
+
+def test_shards_are_disjoint_and_cover_the_list():
+    names = [f"package-{number}" for number in range(1000)]
+    shards = [[name for name in names if _in_shard(name, (i, 4))] for i in range(4)]
+    assert sorted(sum(shards, [])) == sorted(names)
+    assert all(150 < len(shard) < 350 for shard in shards)
+    assert _in_shard("Django", (0, 4)) == _in_shard("django", (0, 4))
@@ -0,0 +1,58 @@
+import pytest
+import sys
+import json
+
+# Support importing typo_index as an absolute import
+from pathlib import Path
+
+file = Path(__file__).resolve()
+parent, root = file.parent, file.parents[1]
+sys.path.append(str(root))
+
+# Additionally remove the current file's directory from sys.path
+try:
+    sys.path.remove(str(parent))
+except ValueError:  # Already removed
+    pass
+
+from typo_index import Typo_Index as app
+from typo_index import load_index, name_distance_indicator, Reference_List
+
+
+def test_index_matches_linear_scan():
+    with open(parent / "narrow_suspicious_packages.json") as list_file:
+        names = json.load(list_file)
+    index = app(names[:1000])
+    for pkg_name in names[::50] + ["requestss", "a", "numpy"]:
+        expected = [
+            top_pkg
+            for top_pkg in names[:1000]
+            if name_distance_indicator(pkg_name, top_pkg) < 0.3
+        ]
+        assert index.near(pkg_name, 0.3) == expected
+
+
+def test_index_is_persisted_next_to_reference(tmp_path):
+    reference = tmp_path / "top5000_list.json"
+    reference.write_text(json.dumps(["requests", "urllib3"]))
+    load_index(str(reference), ["requests", "urllib3"])
+    assert (tmp_path / "top5000_list_index.json").is_file()
+
+
+def test_index_that_cannot_be_saved_is_kept_in_memory(tmp_path):
+    reference = tmp_path / "top5000_list.json"
+    reference.write_text(json.dumps(["requests", "urllib3"]))
+    unwritable = str(tmp_path / "missing" / "top5000_list_index.json")
+    index = load_index(str(reference), ["requests", "urllib3"], unwritable)
+    assert index.near("request", 0.3) == ["requests"]
+    assert list(tmp_path.iterdir()) == [reference]
+
+
+def test_reference_list_skips_same_project(tmp_path):
+    reference = tmp_path / "top5000_list.json"
+    reference.write_text(
+        json.dumps({"rows": [{"project": "Django"}, {"project": "djangoo"}]})
+    )
+    top5000_list = Reference_List.load(str(reference))
+    assert "django" in top5000_list
+    assert top5000_list.near("django") == ["djangoo"]
@@ -0,0 +1,36 @@
+import pytest
+import sys
+import json
+
+# Support importing typo_sweep as an absolute import
+from pathlib import Path
+
+file = Path(__file__).resolve()
+parent, root = file.parent, file.parents[1]
+sys.path.append(str(root))
+
+# Additionally remove the current file's directory from sys.path
+try:
+    sys.path.remove(str(parent))
+except ValueError:  # Already removed
+    pass
+
+from typo_sweep import sweep as app
+from typo_index import name_distance_indicator
+from pypi_fetcher import normalize_name
+
+
+def test_sweep_matches_pairwise_check():
+    with open(parent / "narrow_suspicious_packages.json") as list_file:
+        names = json.load(list_file)
+    top_names, candidates = names[:300], names[300:900] + ["Requestz", "six"]
+    expected = set(
+        (name, top_name)
+        for name in candidates
+        for top_name in top_names
+        if name_distance_indicator(name, top_name) < 0.3
+        and normalize_name(name) != normalize_name(top_name)
+    )
+    report = app(candidates, top_names, 0.3, chunk_size=50, workers=1)
+    assert set((row["package"], row["popular_package"]) for row in report) == expected
+    assert [row["score"] for row in report] == sorted(row["score"] for row in report)
@@ -1,5 +1,8 @@
 import pytest
 import sys
+import io
+import hashlib
+import tarfile
 
 # Support importing pip_audit as an absolute import
 from pathlib import Path
@@ -15,6 +18,8 @@ except ValueError:  # Already removed
     pass
 
 from pip_audit import _extract_archives as app
+from pip_audit import _iter_archive_members
+from archive_members import Archive_Rejected, Member_Budget
 
 
 def test_pip_download_error():
@@ -27,3 +32,76 @@ def test_pip_download_error():
         output_json=False,
     )
     assert test_output
+
+
+def _tarball(tmp_path, members):
+    archive = tmp_path / "demo-0.1.tar.gz"
+    with tarfile.open(archive, "w:gz") as tar:
+        for name, data in members:
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    return archive, {
+        "path": str(archive),
+        "sha256": "",
+        "size": archive.stat().st_size,
+        "project": "demo",
+        "version": "0.1",
+    }
+
+
+def test_stream_members_without_extracting(tmp_path):
+    archive, output = _tarball(
+        tmp_path, (("demo-0.1/setup.py", b"setup()"), ("demo-0.1/a.py", b""))
+    )
+    scan_dirs, package_meta = app(output, str(tmp_path), {}, extract=False)
+    assert sorted(scan_dirs) == ["demo-0.1/a.py", "demo-0.1/setup.py"]
+    assert not (tmp_path / "demo-0.1").exists()
+    assert dict(_iter_archive_members(str(archive)))["demo-0.1/setup.py"] == b"setup()"
+
+
+def test_binary_and_oversized_members_are_skipped(tmp_path):
+    archive, output = _tarball(
+        tmp_path,
+        (
+            ("demo-0.1/a.py", b"import os\n"),
+            ("demo-0.1/big.py", b"#" * 2048),
+            ("demo-0.1/blob.dat", b"\x00\x01"),
+            ("demo-0.1/lib.so", b"ELF"),
+        ),
+    )
+    limits = {"max_member_bytes": 1024}
+    scan_dirs, package_meta = app(output, str(tmp_path), {}, limits=limits)
+    assert scan_dirs == ["demo-0.1/a.py"]
+    assert package_meta["skipped_member_count"] == 3
+    assert len(package_meta["archive_file_list"]) == 4
+    assert sorted(path.name for path in (tmp_path / "demo-0.1").iterdir()) == ["a.py"]
+    assert dict(_iter_archive_members(str(archive), limits)) == {
+        "demo-0.1/a.py": b"import os\n"
+    }
+
+
+def test_decompression_bomb_is_rejected(tmp_path):
+    # A few KB of gzip that expands to 4MB of zeros
+    archive, output = _tarball(tmp_path, (("demo-0.1/a.py", bytes(4 * 1024**2)),))
+    limits = {"max_package_bytes": 1024**2}
+    scan_dirs, package_meta = app(output, str(tmp_path), {}, limits=limits)
+    assert scan_dirs is False
+    assert "expands to more than" in package_meta["archive_rejected"]
+    assert not (tmp_path / "demo-0.1").exists()
+    # Far past what its archive's size allows, whatever the package cap
+    with pytest.raises(Archive_Rejected):
+        Member_Budget(2 * 1024**2).admit("demo-0.1/a.py", 300 * 1024**2)
+
+
+def test_one_pass_writes_and_hashes_members(tmp_path):
+    archive, output = _tarball(
+        tmp_path, (("demo-0.1/setup.py", b"setup()"), ("demo-0.1/a.py", b"x = 1\n"))
+    )
+    manifest = {}
+    scan_dirs, package_meta = app(output, str(tmp_path), {}, manifest=manifest)
+    assert (tmp_path / "demo-0.1" / "a.py").read_bytes() == b"x = 1\n"
+    assert manifest["a.py"] == ("demo-0.1/a.py", hashlib.sha256(b"x = 1\n").hexdigest())
+    listed = {}
+    app(output, str(tmp_path / "none"), {}, extract=False, manifest=listed)
+    assert listed == manifest and not (tmp_path / "none").exists()
@@ -0,0 +1,69 @@
+import pytest
+import sys
+import time
+
+# Support importing work_queue as an absolute import
+from pathlib import Path
+
+file = Path(__file__).resolve()
+parent, root = file.parent, file.parents[1]
+sys.path.append(str(root))
+
+# Additionally remove the current file's directory from sys.path
+try:
+    sys.path.remove(str(parent))
+except ValueError:  # Already removed
+    pass
+
+from work_queue import Work_Queue as app
+from work_queue import Queue_Worker
+
+
+def test_leases_are_exclusive_and_failures_are_redelivered(tmp_path):
+    path = str(tmp_path / "queue.db")
+    coordinator = app(path, max_attempts=2)
+    assert coordinator.put(["a", "b", "a"]) == 2
+    assert coordinator.put(["b"]) == 0
+
+    first, second = app(path, max_attempts=2), app(path, max_attempts=2)
+    assert first.lease("w1") == "a"
+    assert second.lease("w2") == "b"
+    assert second.lease("w2") is None
+    assert first.ack("a", "w1", scan_errors=0)
+    assert second.ack("b", "w2", scan_errors=1)
+    # Failed once, so it comes back for its second and last attempt
+    assert first.lease("w1") == "b"
+    assert first.ack("b", "w1", scan_errors=1)
+    assert first.lease("w1") is None
+    assert coordinator.summary() == {"done": 1, "failed": 1}
+    assert not coordinator.busy("w1")
+
+
+def test_expired_leases_go_to_the_next_worker(tmp_path):
+    work_queue = app(str(tmp_path / "queue.db"), lease_seconds=0.2)
+    work_queue.put(["a", "b"])
+    assert work_queue.lease("dead") == "a"
+    assert work_queue.lease("alive") == "b"
+    time.sleep(0.1)
+    assert work_queue.heartbeat("alive") == 1
+    time.sleep(0.15)
+    # Only the lease nobody kept alive has run out
+    assert work_queue.lease("alive") == "a"
+    assert not work_queue.ack("a", "dead")
+    assert work_queue.ack("a", "alive")
+    assert work_queue.ack("b", "alive")
+    assert work_queue.summary() == {"done": 2}
+
+
+def test_worker_drains_the_queue_and_returns_unfinished_leases(tmp_path):
+    work_queue = app(str(tmp_path / "queue.db"), lease_seconds=1)
+    work_queue.put(["a", "b", "c"])
+    worker = Queue_Worker(work_queue, "w1")
+    targets = worker.targets()
+    assert next(targets) == "a"
+    worker.done("a", 0)
+    assert next(targets) == "b"
+    worker.close()
+    assert list(targets) == []
+    assert work_queue.summary() == {"done": 1, "queued": 2}
+    assert list(Queue_Worker(work_queue, "w2").targets()) == ["b", "c"]
@@ -0,0 +1,211 @@
+"""BK-tree over a list of popular package names for typo-squatting lookups.
+
+Damerau-Levenshtein distance is a metric, so a BK-tree can answer "which
+names are within d edits of X" while only computing the distance to a small
+fraction of the reference list.  The typo-squatting plugin asks with a
+normalized threshold (2 * distance / combined length), which is turned into
+the largest edit distance that can still pass before searching and then
+checked exactly on the few names that come back.
+
+The tree is built once per process and written to disk next to the
+reference list, tagged with the list's sha256 so a refreshed list is
+rebuilt instead of silently reusing a stale tree.  Reference_List bundles
+the parsed names, their PEP 503 normalized forms and the tree so callers
+load all of it once.
+
+@author u/gatewaynode
+@website https://reddit.com/r/pipsecurity
+"""
+
+import os
+import json
+import logging
+import hashlib
+import threading
+import jellyfish
+from pypi_fetcher import normalize_name
+
+INDEX_FORMAT = 1
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def name_distance_indicator(pkg_name_1, pkg_name_2, distance=None):
+    if pkg_name_1 == pkg_name_2:
+        # Never report numpy as being very close to the popular package numpy
+        return float("inf")
+    if distance is None:
+        distance = jellyfish.damerau_levenshtein_distance(pkg_name_1, pkg_name_2)
+    return 2 * distance / (len(pkg_name_1) + len(pkg_name_2))
+
+
+def max_edit_distance(length, threshold):
+    # 2d / (L + M) < t and M <= L + d give d < t * L / (1 - t / 2), this is
+    # the largest whole number of edits that can still be under threshold.
+    bound = threshold * length / (1 - threshold / 2)
+    return max(int(-(-bound // 1)) - 1, 0)
+
+
+class BK_Tree:
+    def __init__(self):
+        # Each node is [word, [ranks], {edit distance: child node index}], a
+        # word listed more than once keeps every rank it appeared at.
+        self.nodes = []
+
+    def add(self, word, rank):
+        if not self.nodes:
+            self.nodes.append([word, [rank], {}])
+            return
+        node = self.nodes[0]
+        while True:
+            distance = jellyfish.damerau_levenshtein_distance(word, node[0])
+            if distance == 0:
+                node[1].append(rank)
+                return
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = len(self.nodes)
+                self.nodes.append([word, [rank], {}])
+                return
+            node = self.nodes[child]
+
+    def search(self, word, radius):
+        # Yields (word, ranks, distance) for every entry within radius edits
+        if not self.nodes:
+            return
+        pending = [0]
+        while pending:
+            node = self.nodes[pending.pop()]
+            distance = jellyfish.damerau_levenshtein_distance(word, node[0])
+            if distance <= radius:
+                yield node[0], node[1], distance
+            for edge, child in node[2].items():
+                if distance - radius <= edge <= distance + radius:
+                    pending.append(child)
+
+    def to_json(self):
+        return [
+            [word, ranks, list(children.items())]
+            for word, ranks, children in self.nodes
+        ]
+
+    @classmethod
+    def from_json(cls, data):
+        tree = cls()
+        tree.nodes = [[word, ranks, dict(children)] for word, ranks, children in data]
+        return tree
+
+
+class Typo_Index:
+    def __init__(self, names=(), tree=None):
+        self.tree = tree or BK_Tree()
+        if tree is None:
+            for rank, name in enumerate(names):
+                self.tree.add(name, rank)
+
+    def near(self, pkg_name, threshold=0.3):
+        # Popular names within threshold of pkg_name, most popular first
+        matches = []
+        radius = max_edit_distance(len(pkg_name), threshold)
+        for top_pkg, ranks, distance in self.tree.search(pkg_name, radius):
+            if name_distance_indicator(pkg_name, top_pkg, distance) < threshold:
+                matches.extend((rank, top_pkg) for rank in ranks)
+        return [top_pkg for rank, top_pkg in sorted(matches)]
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 64), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_index(reference_path, names, index_path=None):
+    # names must be the list parsed from reference_path.  The tree is reused
+    # from memory, then from index_path, and only built when neither matches
+    # the current contents of the reference list.
+    if index_path is None:
+        index_path = os.path.splitext(reference_path)[0] + "_index.json"
+    source_sha256 = _file_sha256(reference_path)
+
+    with _indexes_lock:
+        key = (os.path.abspath(index_path), source_sha256)
+        if key in _indexes:
+            return _indexes[key]
+
+        index = None
+        if os.path.isfile(index_path):
+            try:
+                with open(index_path, "r", encoding="utf-8") as file:
+                    saved = json.load(file)
+                if (
+                    saved.get("format") == INDEX_FORMAT
+                    and saved.get("source_sha256") == source_sha256
+                ):
+                    index = Typo_Index(tree=BK_Tree.from_json(saved["nodes"]))
+            except ValueError:
+                index = None  # Corrupt or half written, just rebuild it
+
+        if index is None:
+            index = Typo_Index(names)
+            # Saving the tree only saves the next process building it, a
+            # read-only or full directory just means it is kept in memory
+            partial = f"{index_path}.{os.getpid()}.part"
+            try:
+                with open(partial, "w", encoding="utf-8") as file:
+                    json.dump(
+                        {
+                            "format": INDEX_FORMAT,
+                            "source_sha256": source_sha256,
+                            "nodes": index.tree.to_json(),
+                        },
+                        file,
+                    )
+                os.replace(partial, index_path)
+            except OSError as e:
+                logging.error(f"Could not save the typo-squatting index: {e}")
+                try:
+                    os.remove(partial)
+                except OSError:
+                    pass
+
+        _indexes[key] = index
+        return index
+
+
+def load_names(path, limit=None):
+    # Plain JSON list of names, or the top-pypi-packages format with "rows"
+    with open(path, "r", encoding="utf-8") as file:
+        names = json.load(file)
+    if isinstance(names, dict):
+        names = list(project["project"] for project in names["rows"])
+    return names[:limit] if limit else names
+
+
+class Reference_List:
+    def __init__(self, names, index, sha256=None):
+        self.names = tuple(names)
+        self.normalized = frozenset(normalize_name(name) for name in self.names)
+        self.index = index
+        self.sha256 = sha256
+
+    @classmethod
+    def load(cls, path):
+        names = load_names(path)
+        return cls(names, load_index(path, names), _file_sha256(path))
+
+    def __contains__(self, pkg_name):
+        return normalize_name(pkg_name) in self.normalized
+
+    def near(self, pkg_name, threshold=0.3):
+        matches = self.index.near(pkg_name, threshold)
+        if pkg_name in self:
+            # "Django" is not a typo-squat of "django", same project once
+            # normalized, so only spell-alike *other* projects are reported.
+            normalized = normalize_name(pkg_name)
+            matches = [
+                top_pkg for top_pkg in matches if normalize_name(top_pkg) != normalized
+            ]
+        return matches
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3.7
+"""Sweep the whole PyPI name list for typo-squats of popular packages.
+
+Checks every name in mega_list.json (see `invoke megaupdate`) against the top
+N popular names in one go, no archives are downloaded.  Comparing ~400k x
+5000 pairs with Damerau-Levenshtein one at a time is far too slow, so pairs
+are filtered in NumPy batches first:
+
+* every name becomes a padded row of character counts, so for a chunk of
+  candidates against all popular names the length difference and the bag
+  distance (characters one name has that the other lacks) come out of a few
+  array operations.  Both are lower bounds of the edit distance, a pair
+  whose lower bound already misses the threshold cannot be a typo-squat.
+* the few pairs that survive get the exact distance, with the same scoring
+  as the typo-squatting plugin.
+
+Chunks are spread over a process pool and the matches are written as a
+single report ranked by score.
+
+@author u/gatewaynode
+@website https://reddit.com/r/pipsecurity
+"""
+
+import os
+import json
+import click
+import traceback
+import logging
+import multiprocessing
+import numpy
+from typo_index import name_distance_indicator, load_names
+from pypi_fetcher import normalize_name
+
+ALPHABET = "abcdefghijklmnopqrstuvwxyz0123456789-_."
+
+# Character to column, everything outside ALPHABET shares the last column.
+# Merging characters (including upper and lower case) can only make the bag
+# distance smaller, so it stays a valid lower bound.
+_COLUMNS = {character: column for column, character in enumerate(ALPHABET)}
+_OTHER = len(ALPHABET)
+
+_top_names = None
+_top_counts = None
+_top_lengths = None
+
+
+def character_counts(names):
+    counts = numpy.zeros((len(names), len(ALPHABET) + 1), dtype=numpy.int16)
+    for row, name in enumerate(names):
+        for character in name.lower():
+            counts[row, _COLUMNS.get(character, _OTHER)] += 1
+    lengths = numpy.fromiter((len(name) for name in names), numpy.int32, len(names))
+    return counts, lengths
+
+
+def candidate_pairs(counts, lengths, top_counts, top_lengths, threshold):
+    # (row, top index) pairs whose edit distance lower bound is under threshold
+    combined = lengths[:, None] + top_lengths[None, :]
+    length_gap = numpy.abs(lengths[:, None] - top_lengths[None, :])
+    possible = 2 * length_gap < threshold * combined
+    rows = numpy.nonzero(possible.any(axis=1))[0]
+    if not len(rows):
+        return []
+
+    # Bag distance only for rows where the length filter left something
+    difference = counts[rows, None, :] - top_counts[None, :, :]
+    surplus = numpy.clip(difference, 0, None).sum(axis=2, dtype=numpy.int32)
+    deficit = surplus - (lengths[rows, None] - top_lengths[None, :])
+    bag_distance = numpy.maximum(surplus, deficit)
+    possible = possible[rows] & (2 * bag_distance < threshold * combined[rows])
+    hits, top_indexes = numpy.nonzero(possible)
+    return list(zip(rows[hits].tolist(), top_indexes.tolist()))
+
+
+def _init_worker(top_names):
+    global _top_names, _top_counts, _top_lengths
+    _top_names = top_names
+    _top_counts, _top_lengths = character_counts(top_names)
+
+
+def _sweep_chunk(arguments):
+    names, threshold = arguments
+    counts, lengths = character_counts(names)
+    matches = []
+    for row, top_index in candidate_pairs(
+        counts, lengths, _top_counts, _top_lengths, threshold
+    ):
+        if normalize_name(names[row]) == normalize_name(_top_names[top_index]):
+            continue  # Same project spelled differently
+        score = name_distance_indicator(names[row], _top_names[top_index])
+        if score < threshold:
+            matches.append((score, top_index, names[row], _top_names[top_index]))
+    return matches
+
+
+def sweep(names, top_names, threshold=0.3, chunk_size=64, workers=None):
+    chunks = (
+        (names[start : start + chunk_size], threshold)
+        for start in range(0, len(names), chunk_size)
+    )
+    matches = []
+    if workers == 1:
+        _init_worker(top_names)
+        for chunk in chunks:
+            matches.extend(_sweep_chunk(chunk))
+    else:
+        with multiprocessing.Pool(
+            workers, initializer=_init_worker, initargs=(top_names,)
+        ) as pool:
+            for chunk_matches in pool.imap_unordered(_sweep_chunk, chunks):
+                matches.extend(chunk_matches)
+
+    # Closest first, ties go to the more popular package
+    matches.sort(key=lambda match: (match[0], match[1], match[2]))
+    return [
+        {
+            "package": name,
+            "popular_package": top_name,
+            "popular_rank": top_index + 1,
+            "score": round(score, 4),
+        }
+        for score, top_index, name, top_name in matches
+    ]
+
+
+@click.command()
+@click.option(
+    "-m",
+    "--mega-list",
+    "mega_list",
+    help="JSON list of every package name to check.",
+    default="mega_list.json",
+)
+@click.option(
+    "-t",
+    "--top-list",
+    "top_list",
+    help="JSON list of popular packages, plain or in top-pypi-packages format.",
+    default="top5000_list.json",
+)
+@click.option(
+    "-n", "--top-n", "top_n", help="Only use the N most popular.", default=5000
+)
+@click.option(
+    "--threshold",
+    "threshold",
+    help="Report pairs whose normalized distance is below this.",
+    default=0.3,
+)
+@click.option(
+    "--chunk-size",
+    "chunk_size",
+    help="Names compared per batch, bounds memory per worker.",
+    default=64,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "-w",
+    "--workers",
+    "workers",
+    help="Worker processes, defaults to one per CPU.",
+    default=None,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "-o",
+    "--output",
+    "output_file",
+    help="Where to write the ranked report.",
+    default="local_files/typo_sweep_report.json",
+)
+@click.option("-v", "--verbose", "verbose", help="Show more information.", is_flag=True)
+def main(
+    mega_list, top_list, top_n, threshold, chunk_size, workers, output_file, verbose
+):
+    try:
+        names = load_names(mega_list)
+        top_names = load_names(top_list, top_n)
+    except Exception as e:
+        logging.error(traceback.format_exc())
+        raise SystemExit(1)
+
+    if verbose:
+        print(f"-> Sweeping {len(names)} names against {len(top_names)} popular ones")
+    report = sweep(names, top_names, threshold, chunk_size, workers)
+
+    if os.path.dirname(output_file):
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+    with open(output_file, "w", encoding="utf-8") as file:
+        json.dump(report, file, ensure_ascii=False, indent=4)
+    if verbose:
+        print(f"Sweep complete! {len(report)} potential typo-squats in {output_file}")
+
+
+if __name__ == "__main__":
+    main()
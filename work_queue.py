@@ -0,0 +1,254 @@
+"""Durable work queue for spreading an audit over many workers and hosts.
+
+A coordinator puts package names into a SQLite file (`--queue FILE
+--enqueue` with the usual -p/-i targeting), then any number of workers
+(`--queue FILE` alone) lease packages out of it and run them through their
+own pipeline.  A lease is only good for lease_seconds: a worker's heartbeat
+keeps extending the leases of the packages it still has in flight, and a
+package whose worker died or hung without acknowledging it goes back to the
+queue once its lease runs out.  Packages that finish with scan errors are
+redelivered too, until they have used up max_attempts.
+
+Workers on other hosts need the file on storage with working locks (a local
+disk shared by containers, not NFS).
+
+@author u/gatewaynode
+@website https://reddit.com/r/pipsecurity
+"""
+
+import os
+import time
+import socket
+import sqlite3
+import threading
+from contextlib import contextmanager
+from run_journal import DEFAULT_MAX_ATTEMPTS
+
+DEFAULT_LEASE_SECONDS = 600
+
+QUEUED = "queued"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+class Work_Queue:
+    def __init__(
+        self,
+        path,
+        lease_seconds=DEFAULT_LEASE_SECONDS,
+        max_attempts=DEFAULT_MAX_ATTEMPTS,
+    ):
+        self.path = path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        # Transactions are started by hand, leasing has to take the write
+        # lock before it looks for a package or two workers could get it
+        self._db = sqlite3.connect(
+            path, check_same_thread=False, timeout=30, isolation_level=None
+        )
+        with self._lock:
+            # WAL with NORMAL sync, same as the run journal
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._transaction():
+            self._db.execute("""CREATE TABLE IF NOT EXISTS items (
+                    id INTEGER PRIMARY KEY,
+                    raw_input TEXT NOT NULL UNIQUE,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL,
+                    worker TEXT,
+                    lease_expires REAL,
+                    scan_errors INTEGER,
+                    enqueued REAL NOT NULL,
+                    finished REAL,
+                    cost REAL
+                )""")
+            # Queues from before packages had a cost
+            columns = [row[1] for row in self._db.execute("PRAGMA table_info(items)")]
+            if "cost" not in columns:
+                self._db.execute("ALTER TABLE items ADD COLUMN cost REAL")
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS items_status ON items (status, id)"
+            )
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def put(self, raw_inputs, cost=None):
+        # Adds packages not in the queue yet, returns how many were added.
+        # Packages already there are left as they are, so enqueueing the same
+        # list twice doesn't audit anything twice.  cost(raw_input) is how
+        # long a package should take, the costliest ones are leased first.
+        added = 0
+        now = time.time()
+        with self._transaction():
+            for raw_input in raw_inputs:
+                added += self._db.execute(
+                    "INSERT OR IGNORE INTO items (raw_input, status, attempts,"
+                    " enqueued, cost) VALUES (?, ?, 0, ?, ?)",
+                    (raw_input, QUEUED, now, cost(raw_input) if cost else None),
+                ).rowcount
+        return added
+
+    def lease(self, worker):
+        # raw_input of the next package, now leased to worker, or None when
+        # there is nothing to hand out right now
+        now = time.time()
+        with self._transaction():
+            # Expired leases without attempts left are given up on.  Packages
+            # without a cost sort last, in the order they were added.
+            self._db.execute(
+                "UPDATE items SET status = ?, finished = ? WHERE status = ?"
+                " AND lease_expires < ? AND attempts >= ?",
+                (FAILED, now, LEASED, now, self.max_attempts),
+            )
+            row = self._db.execute(
+                "SELECT id, raw_input FROM items WHERE status = ?"
+                " OR (status = ? AND lease_expires < ?) ORDER BY cost DESC, id LIMIT 1",
+                (QUEUED, LEASED, now),
+            ).fetchone()
+            if row is None:
+                return None
+            self._db.execute(
+                "UPDATE items SET status = ?, attempts = attempts + 1, worker = ?,"
+                " lease_expires = ? WHERE id = ?",
+                (LEASED, worker, now + self.lease_seconds, row[0]),
+            )
+        return row[1]
+
+    def heartbeat(self, worker):
+        # Extends every lease worker holds, returns how many it holds
+        with self._transaction():
+            return self._db.execute(
+                "UPDATE items SET lease_expires = ? WHERE status = ? AND worker = ?",
+                (time.time() + self.lease_seconds, LEASED, worker),
+            ).rowcount
+
+    def ack(self, raw_input, worker, scan_errors=0):
+        # Records a package worker is done with.  One with scan errors goes
+        # back to the queue while it has attempts left.  Returns False if the
+        # lease was lost to another worker in the meantime, whose result
+        # counts instead.
+        with self._transaction():
+            row = self._db.execute(
+                "SELECT attempts FROM items WHERE raw_input = ? AND status = ?"
+                " AND worker = ?",
+                (raw_input, LEASED, worker),
+            ).fetchone()
+            if row is None:
+                return False
+            if not scan_errors:
+                status = DONE
+            elif row[0] < self.max_attempts:
+                status = QUEUED
+            else:
+                status = FAILED
+            self._db.execute(
+                "UPDATE items SET status = ?, scan_errors = ?, lease_expires = NULL,"
+                " finished = ? WHERE raw_input = ?",
+                (status, scan_errors, time.time(), raw_input),
+            )
+        return True
+
+    def release(self, raw_input, worker):
+        # Hands a package back unprocessed, without using up an attempt
+        with self._transaction():
+            self._db.execute(
+                "UPDATE items SET status = ?, attempts = attempts - 1,"
+                " lease_expires = NULL WHERE raw_input = ? AND status = ?"
+                " AND worker = ?",
+                (QUEUED, raw_input, LEASED, worker),
+            )
+
+    def busy(self, worker):
+        # True while packages wait in the queue or are leased to other
+        # workers, whose leases may still run out and come back
+        with self._lock:
+            return bool(
+                self._db.execute(
+                    "SELECT COUNT(*) FROM items WHERE status = ?"
+                    " OR (status = ? AND worker != ?)",
+                    (QUEUED, LEASED, worker),
+                ).fetchone()[0]
+            )
+
+    def summary(self):
+        # {status: package count}
+        with self._lock:
+            return dict(
+                self._db.execute(
+                    "SELECT status, COUNT(*) FROM items GROUP BY status"
+                ).fetchall()
+            )
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class Queue_Worker:
+    # One worker's side of the queue: leases packages as the pipeline asks
+    # for them, keeps their leases alive and acknowledges them once done.
+    def __init__(self, work_queue, worker=None, poll_seconds=None):
+        self.queue = work_queue
+        self.worker = worker or default_worker_id()
+        self.poll_seconds = poll_seconds or min(5.0, work_queue.lease_seconds / 4)
+        self._leased = set()
+        self._leased_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat = threading.Thread(target=self._beat, daemon=True)
+        self._heartbeat.start()
+
+    def _beat(self):
+        while not self._stop.wait(self.queue.lease_seconds / 3):
+            with self._leased_lock:
+                if not self._leased:
+                    continue
+            self.queue.heartbeat(self.worker)
+
+    def targets(self, verbose=False, debug=False, output_json=False):
+        # Yields leased packages until the queue is drained.  Leases other
+        # workers hold are waited out, they come back if those workers die.
+        while not self._stop.is_set():
+            raw_input = self.queue.lease(self.worker)
+            if raw_input is None:
+                if not self.queue.busy(self.worker):
+                    return
+                self._stop.wait(self.poll_seconds)
+                continue
+            with self._leased_lock:
+                self._leased.add(raw_input)
+            if debug:
+                print(f"Leased {raw_input} as {self.worker}")
+            yield raw_input
+
+    def done(self, raw_input, scan_errors):
+        with self._leased_lock:
+            self._leased.discard(raw_input)
+        self.queue.ack(raw_input, self.worker, scan_errors)
+
+    def close(self):
+        # Whatever is still leased (the run was interrupted) goes straight
+        # back to the queue instead of waiting for its lease to run out
+        self._stop.set()
+        self._heartbeat.join()
+        with self._leased_lock:
+            leased, self._leased = self._leased, set()
+        for raw_input in leased:
+            self.queue.release(raw_input, self.worker)